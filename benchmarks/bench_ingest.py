@@ -0,0 +1,53 @@
+"""
+    Compare bulk and row by row ingest of a synthetic NEM12 file
+
+    python benchmarks/bench_ingest.py --years 2
+"""
+
+import os
+import tempfile
+import time
+import click
+import context  # noqa
+import metering.loader
+from metering import load_nem_data, dispose_db_engine
+from nem12 import write_nem12
+
+NMI = "QB00000001"
+
+
+@click.command()
+@click.option("--years", default=2, help="Years of data to generate")
+@click.option("--interval", default=5, help="Interval length in minutes")
+@click.option("--batch-size", default=metering.loader.BATCH_SIZE)
+def main(years, interval, batch_size):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        nem_file = os.path.join(tmp_dir, "synthetic.csv")
+        num_reads = write_nem12(
+            nem_file, days=365 * years, nmi=NMI, interval_m=interval
+        )
+        click.echo(f"Generated {num_reads} readings over {years} years")
+
+        # Only time the readings insert, not the rollups
+        metering.loader.refresh_dirty_days = lambda *args: None
+
+        for meter_id, mode, size in [(1, "row by row", 0), (2, "bulk", batch_size)]:
+            started = time.perf_counter()
+            inserted, skipped = load_nem_data(meter_id, NMI, nem_file, size)
+            elapsed = time.perf_counter() - started
+            rate = num_reads / elapsed
+            msg = f"{mode:>10}: {elapsed:7.2f}s {rate:9.0f} reads/s"
+            click.echo(f"{msg} ({inserted} inserted, {skipped} skipped)")
+
+            # Reloading the same file should skip every reading
+            started = time.perf_counter()
+            inserted, skipped = load_nem_data(meter_id, NMI, nem_file, size)
+            elapsed = time.perf_counter() - started
+            msg = f"{'reload':>10}: {elapsed:7.2f}s"
+            click.echo(f"{msg} ({inserted} inserted, {skipped} skipped)")
+            dispose_db_engine(meter_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+    Compare profiling readings into intervals with NumPy and energy_shaper
+
+    python benchmarks/bench_intervals.py --readings 50000
+"""
+
+import random
+import time
+from datetime import datetime, timedelta
+import click
+import context  # noqa
+from energy_shaper import group_into_profiled_intervals
+from metering.intervals import profile_intervals, iter_profiled_readings
+from metering.intervals import to_epoch
+
+
+def random_readings(num_reads: int, seed: int = 2):
+    """ Generate interval readings of mixed lengths, up to half an hour """
+    rand = random.Random(seed)
+    readings = []
+    start = datetime(2018, 1, 1)
+    for _ in range(num_reads):
+        end = start + timedelta(minutes=rand.choice([5, 5, 15, 30, 30]))
+        readings.append((start, end, rand.random()))
+        start = end
+    return readings
+
+
+@click.command()
+@click.option("--readings", default=50000, help="Readings to profile")
+@click.option("--interval", default=5, help="Interval length in minutes")
+def main(readings, interval):
+    reads = random_readings(readings)
+    # The database returns epoch seconds directly
+    starts = to_epoch(r[0] for r in reads)
+    ends = to_epoch(r[1] for r in reads)
+    values = [r[2] for r in reads]
+
+    started = time.perf_counter()
+    expected = list(group_into_profiled_intervals(reads, interval_m=interval))
+    python_time = time.perf_counter() - started
+
+    started = time.perf_counter()
+    interval_ends, totals = profile_intervals(starts, ends, values, interval)
+    numpy_time = time.perf_counter() - started
+
+    profiled = list(iter_profiled_readings(interval_ends, totals, interval))
+    if profiled != expected:
+        raise click.ClickException("NumPy and energy_shaper results differ")
+    speedup = python_time / numpy_time
+    msg = f"energy_shaper {python_time:.3f}s, numpy {numpy_time:.3f}s"
+    click.echo(f"{msg} ({speedup:.0f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
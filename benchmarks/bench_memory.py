@@ -0,0 +1,80 @@
+"""
+    Compare peak memory of streaming ingest with reading the whole NEM12 file
+
+    python benchmarks/bench_memory.py --years 1 --years 4
+"""
+
+import os
+import resource
+import tempfile
+import time
+from multiprocessing import get_context
+import click
+import context  # noqa
+import metering.loader
+from nemreader import read_nem_file
+from energy_shaper import split_into_daily_intervals
+from metering import load_nem_data, dispose_db_engine
+from nem12 import write_nem12
+
+NMI = "QB00000001"
+
+
+def peak_rss_mb() -> float:
+    """ Peak resident set size of this process in MB (Linux reports KB) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def read_whole_file(nem_file: str):
+    """ The previous ingest first step, reading every channel into memory """
+    m = read_nem_file(nem_file)
+    for reads in m.readings[NMI].values():
+        list(split_into_daily_intervals(reads))
+
+
+def stream_file(nem_file: str, rollups: bool):
+    """ Load the file into a meter database with the streaming reader """
+    if not rollups:
+        metering.loader.refresh_dirty_days = lambda *args: None
+    load_nem_data(1, NMI, nem_file)
+    dispose_db_engine(1)
+    if os.path.exists("data/meter_1.db"):
+        os.remove("data/meter_1.db")
+
+
+def measure(mode: str, nem_file: str):
+    """ Run one ingest mode in this process, returning the time and peak RSS """
+    baseline = peak_rss_mb()
+    started = time.perf_counter()
+    if mode == "whole file":
+        read_whole_file(nem_file)
+    else:
+        stream_file(nem_file, rollups=mode == "rollups")
+    return time.perf_counter() - started, baseline, peak_rss_mb()
+
+
+@click.command()
+@click.option("--years", default=[1, 2, 4], multiple=True, help="File sizes to try")
+@click.option("--interval", default=5, help="Interval length in minutes")
+def main(years, interval):
+    # Each run gets a fresh process so peak memory is not carried over
+    mp = get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        for num_years in years:
+            nem_file = os.path.join(tmp_dir, f"synthetic_{num_years}.csv")
+            num_reads = write_nem12(
+                nem_file, days=365 * num_years, nmi=NMI, interval_m=interval
+            )
+            size_mb = os.path.getsize(nem_file) / 1024 / 1024
+            click.echo(f"{num_years} years: {num_reads} readings, {size_mb:.0f} MB")
+            # Streaming is timed with and without refreshing the rollups
+            for mode in ["whole file", "streaming", "rollups"]:
+                with mp.Pool(1) as pool:
+                    elapsed, baseline, peak = pool.apply(measure, (mode, nem_file))
+                msg = f"{mode:>12}: {elapsed:7.2f}s peak RSS {peak:6.0f} MB"
+                click.echo(f"{msg} ({peak - baseline:+.0f} MB)")
+
+
+if __name__ == "__main__":
+    main()
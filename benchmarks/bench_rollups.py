@@ -0,0 +1,120 @@
+"""
+    Compare bulk and row by row writes of the daily and monthly rollups
+
+    python benchmarks/bench_rollups.py --years 2
+"""
+
+import os
+import tempfile
+import time
+import click
+import context  # noqa
+import metering.analyse
+import metering.loader
+from metering import load_nem_data, dispose_db_engine
+from metering import Dailies
+from metering import update_daily_total, update_monthly_total
+from metering import update_daily_segments
+from nem12 import write_nem12
+
+NMI = "QB00000001"
+
+
+def rowwise_daily_totals(session, rows):
+    for row in rows:
+        update_daily_total(session, **row)
+
+
+def rowwise_missing_daily_totals(session, rows):
+    for row in rows:
+        exists = session.query(Dailies).filter(Dailies.day == row["day"]).first()
+        if exists is None:
+            update_daily_total(session, **row)
+
+
+def rowwise_monthly_totals(session, rows):
+    for row in rows:
+        update_monthly_total(session, **row)
+
+
+def rowwise_daily_segments(session, rows):
+    for row in rows:
+        update_daily_segments(session, **row)
+
+
+def timed(writer, elapsed: dict):
+    """ Wrap a writer to add the time spent in it to elapsed """
+
+    def wrapper(session, rows):
+        started = time.perf_counter()
+        writer(session, rows)
+        session.commit()
+        elapsed["write"] += time.perf_counter() - started
+
+    return wrapper
+
+
+def refresh_all(meter_id):
+    metering.analyse.refresh_daily_stats(meter_id)
+    metering.analyse.refresh_daily_segments(meter_id)
+    metering.analyse.refresh_monthly_stats(meter_id)
+
+
+@click.command()
+@click.option("--years", default=2, help="Years of data to generate")
+@click.option("--interval", default=30, help="Interval length in minutes")
+@click.option("--repeat", default=2, help="Refreshes to time, after the first")
+def main(years, interval, repeat):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        nem_file = os.path.join(tmp_dir, "synthetic.csv")
+        num_reads = write_nem12(
+            nem_file, days=365 * years, nmi=NMI, interval_m=interval
+        )
+        click.echo(f"Generated {num_reads} readings over {years} years")
+
+        # Load the readings without the rollups, which are timed separately
+        refresh_dirty_days = metering.loader.refresh_dirty_days
+        metering.loader.refresh_dirty_days = lambda *args: None
+        load_nem_data(1, NMI, nem_file)
+        load_nem_data(2, NMI, nem_file)
+        metering.loader.refresh_dirty_days = refresh_dirty_days
+
+        bulk = {
+            name: getattr(metering.analyse, name)
+            for name in [
+                "save_daily_totals",
+                "add_missing_daily_totals",
+                "save_monthly_totals",
+                "save_daily_segments",
+            ]
+        }
+        rowwise = {
+            "save_daily_totals": rowwise_daily_totals,
+            "add_missing_daily_totals": rowwise_missing_daily_totals,
+            "save_monthly_totals": rowwise_monthly_totals,
+            "save_daily_segments": rowwise_daily_segments,
+        }
+
+        for meter_id, mode, writers in [(1, "row by row", rowwise), (2, "bulk", bulk)]:
+            elapsed = {"write": 0.0}
+            for name, writer in writers.items():
+                setattr(metering.analyse, name, timed(writer, elapsed))
+
+            # The first refresh inserts, later refreshes update existing rows
+            for run in range(repeat + 1):
+                elapsed["write"] = 0.0
+                started = time.perf_counter()
+                refresh_all(meter_id)
+                total = time.perf_counter() - started
+                label = "insert" if run == 0 else "update"
+                msg = f"{mode:>10} {label}: {total:7.2f}s"
+                click.echo(f"{msg} ({elapsed['write']:.3f}s writing)")
+            dispose_db_engine(meter_id)
+
+        for name, writer in bulk.items():
+            setattr(metering.analyse, name, writer)
+
+
+if __name__ == "__main__":
+    main()
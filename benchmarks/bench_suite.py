@@ -0,0 +1,232 @@
+"""
+    Time ingest, each rollup and the JSON endpoints, and flag regressions
+
+    python benchmarks/bench_suite.py --years 2 --nmis 2 --save-baseline
+    python benchmarks/bench_suite.py --years 2 --nmis 2
+"""
+
+import json
+import os
+import resource
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from multiprocessing import get_context
+import click
+import context  # noqa
+from nem12 import write_nem12
+
+BASELINE_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baselines.json"
+)
+START = datetime(2017, 7, 1)
+ROLLUPS = [
+    "refresh_daily_stats",
+    "refresh_daily_segments",
+    "refresh_monthly_stats",
+    "refresh_interval_totals",
+]
+MIN_REGRESSION_S = 0.005  # Ignore slowdowns smaller than timer noise
+MIN_REGRESSION_MB = 10  # Ignore memory growth smaller than allocator noise
+
+
+def peak_rss_mb() -> float:
+    """ Peak resident set size of this process in MB (Linux reports KB) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_endpoints(days: int) -> dict:
+    """ The JSON endpoints to time, as URLs under a meter, over the last year """
+    from energy.meters import get_financial_year
+
+    end = START + timedelta(days=days)
+    start = end - timedelta(days=365)
+    fin_year = get_financial_year(start)
+
+    def energy_data(span_days):
+        return f"{start:%Y-%m-%d}/{start + timedelta(days=span_days):%Y-%m-%d}"
+
+    return {
+        "energy_data day": f"{energy_data(1)}/energy_data.json",
+        "energy_data week": f"{energy_data(7)}/energy_data.json",
+        "energy_data year": f"{energy_data(365)}/energy_data.json",
+        "monthly_totals": "usage_overview/monthly_totals.json",
+        "usage_stats": "usage_overview/stats.json",
+        "fy daily_totals": f"usage_fy/{fin_year}/daily_totals.json",
+        "month daily_totals": f"usage_mth/{start.year}/{start.month}/daily_totals.json",
+        "monthly_bills": f"usage_fy/{fin_year}/monthly_bills.json",
+    }
+
+
+def run_ingest(meter_ids, nmis, nem_file: str) -> float:
+    """ Load each NMI into its own meter, without the rollups """
+    import metering.loader
+    from metering import load_nem_data, dispose_db_engine
+
+    metering.loader.refresh_dirty_days = lambda *args: None
+    started = time.perf_counter()
+    for meter_id, nmi in zip(meter_ids, nmis):
+        load_nem_data(meter_id, nmi, nem_file)
+        dispose_db_engine(meter_id)
+    return time.perf_counter() - started
+
+
+def run_rollup(name: str, meter_ids) -> float:
+    """ Build one of the rollups for every meter from scratch """
+    import metering.analyse
+    from metering import dispose_db_engine
+
+    refresh = getattr(metering.analyse, name)
+    started = time.perf_counter()
+    for meter_id in meter_ids:
+        refresh(meter_id)
+        dispose_db_engine(meter_id)
+    return time.perf_counter() - started
+
+
+def setup_site(meter_ids):
+    """ Add a public meter to the site database for each NMI """
+    from energy import app, db
+    from energy.models import Meter, User
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.abspath('app.db')}"
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(user_id=1, username="bench"))
+        for meter_id in meter_ids:
+            db.session.add(
+                Meter(meter_id=meter_id, user_id=1, meter_name="", sharing="public")
+            )
+        db.session.commit()
+
+
+def run_endpoint(url: str, meter_ids, repeat: int) -> float:
+    """ Return the median time to answer a request, once warmed up """
+    from energy import app
+    from energy.charts import clear_bill_cache
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{os.path.abspath('app.db')}"
+    client = app.test_client()
+    elapsed = []
+    for run in range(repeat + 1):
+        for meter_id in meter_ids:
+            clear_bill_cache()  # Time calculating the bills, not the cache
+            started = time.perf_counter()
+            response = client.get(f"/meters/{meter_id}/{url}")
+            if response.status_code != 200:
+                raise RuntimeError(f"{url} returned {response.status_code}")
+            if run:
+                elapsed.append(time.perf_counter() - started)
+    return statistics.median(elapsed)
+
+
+def measure(func, *args):
+    """ Run a stage in this process, returning its result and peak RSS """
+    baseline = peak_rss_mb()
+    result = func(*args)
+    return result, baseline, peak_rss_mb()
+
+
+def get_baseline_key(years, interval, channels, nmis) -> str:
+    """ Baselines are only compared between runs on the same data """
+    return f"{years}y_{interval}m_{'+'.join(channels)}_{nmis}nmi"
+
+
+def format_change(name: str, result: dict, baseline: dict, tolerance: float):
+    """ Describe the change from the baseline, and whether it regressed """
+    if name not in baseline:
+        return "", False
+    base = baseline[name]
+    change = result["seconds"] / base["seconds"] - 1
+    slower = result["seconds"] - base["seconds"] > MIN_REGRESSION_S
+    regressed = slower and change > tolerance
+    # Peak RSS includes the imports, so compare what each stage added to it
+    growth = result["growth_mb"] - base["growth_mb"]
+    regressed |= growth > max(base["growth_mb"] * tolerance, MIN_REGRESSION_MB)
+    return f"{change:+6.0%}" + (" REGRESSED" if regressed else ""), regressed
+
+
+@click.command()
+@click.option("--years", default=1, help="Years of data to generate")
+@click.option("--interval", default=5, help="Interval length in minutes")
+@click.option("--channels", default="E1,E2,B1", help="Channels of each NMI")
+@click.option("--nmis", default=1, help="Meters to generate and load")
+@click.option("--repeat", default=5, help="Requests to time for each endpoint")
+@click.option("--baseline-file", default=BASELINE_FILE)
+@click.option("--save-baseline", is_flag=True, help="Store this run as the baseline")
+@click.option("--tolerance", default=0.25, help="Allowed slowdown or growth")
+def main(
+    years, interval, channels, nmis, repeat, baseline_file, save_baseline, tolerance
+):
+    channels = channels.split(",")
+    nmi_names = [f"QB{n:08d}" for n in range(1, nmis + 1)]
+    meter_ids = list(range(1, nmis + 1))
+    days = 365 * years
+    key = get_baseline_key(years, interval, channels, nmis)
+
+    baselines = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            baselines = json.load(f)
+    baseline = baselines.get(key, {})
+
+    # Each stage gets a fresh process so peak memory is not carried over
+    mp = get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        nem_file = os.path.join(tmp_dir, "synthetic.csv")
+        num_reads = write_nem12(
+            nem_file,
+            start=START,
+            days=days,
+            nmi=nmi_names,
+            channels=channels,
+            interval_m=interval,
+        )
+        click.echo(f"{key}: {num_reads} readings")
+
+        stages = [("ingest", run_ingest, (meter_ids, nmi_names, nem_file))]
+        units = {"ingest": (num_reads, "reads/s")}
+        for name in ROLLUPS:
+            stages.append((name, run_rollup, (name, meter_ids)))
+            units[name] = (days * nmis, "days/s")
+        stages.append(("setup site", setup_site, (meter_ids,)))
+        for name, url in get_endpoints(days).items():
+            stages.append((name, run_endpoint, (url, meter_ids, repeat)))
+            units[name] = (1, "req/s")
+
+        results = {}
+        regressions = []
+        for name, func, args in stages:
+            with mp.Pool(1) as pool:
+                elapsed, start_mb, peak_mb = pool.apply(measure, (func,) + args)
+            if name not in units:
+                continue
+            results[name] = {
+                "seconds": elapsed,
+                "peak_mb": peak_mb,
+                "growth_mb": peak_mb - start_mb,
+            }
+            count, unit = units[name]
+            change, regressed = format_change(name, results[name], baseline, tolerance)
+            if regressed:
+                regressions.append(name)
+            msg = f"{name:>24}: {elapsed:8.3f}s {count / elapsed:10.0f} {unit:<7}"
+            msg += f" peak RSS {peak_mb:5.0f} MB ({peak_mb - start_mb:+4.0f} MB)"
+            click.echo(f"{msg} {change}")
+
+    if save_baseline:
+        baselines[key] = results
+        with open(baseline_file, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        click.echo(f"Saved baseline {key} to {baseline_file}")
+    elif not baseline:
+        click.echo("No baseline for this data, save one with --save-baseline")
+    if regressions:
+        click.echo(f"Regressed: {', '.join(regressions)}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+    benchmarks.nem12
+    ~~~~~~~~~
+    Generate synthetic NEM12 files for benchmarking
+"""
+
+import math
+import random
+from datetime import datetime, timedelta
+from typing import Sequence, Union
+
+
+def daily_values(day: datetime, num_intervals: int, rand: random.Random):
+    """ Return a day of interval values with a morning and evening peak """
+    values = []
+    for i in range(num_intervals):
+        hour = 24 * i / num_intervals
+        shape = 0.2 + 0.3 * math.exp(-((hour - 7.5) ** 2) / 4)
+        shape += 0.6 * math.exp(-((hour - 18.5) ** 2) / 6)
+        values.append(round(shape * rand.uniform(0.5, 1.5) / (num_intervals / 48), 3))
+    return values
+
+
+def write_nem12(
+    file_path: str,
+    start: datetime = datetime(2017, 7, 1),
+    days: int = 365,
+    nmi: Union[str, Sequence[str]] = "QB00000001",
+    channels=("E1", "B1"),
+    interval_m: int = 5,
+    seed: int = 1,
+):
+    """ Write a deterministic NEM12 file and return the number of readings
+
+    :param nmi: An NMI, or several to write one after another in the file
+    """
+    rand = random.Random(seed)
+    nmis = [nmi] if isinstance(nmi, str) else list(nmi)
+    num_intervals = 24 * 60 // interval_m
+    with open(file_path, "w") as f:
+        f.write("100,NEM12,201801010000,MDP1,Retailer1\n")
+        for meter_nmi in nmis:
+            for ch_name in channels:
+                f.write(
+                    f"200,{meter_nmi},E1B1,1,{ch_name},N1,METSER1,kWh,{interval_m},\n"
+                )
+                for d in range(days):
+                    day = start + timedelta(days=d)
+                    values = ",".join(
+                        str(x) for x in daily_values(day, num_intervals, rand)
+                    )
+                    f.write(f"300,{day:%Y%m%d},{values},A,,,{day:%Y%m%d}000000,\n")
+        f.write("900\n")
+    return days * num_intervals * len(channels) * len(nmis)
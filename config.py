@@ -8,4 +8,10 @@ ALLOWED_EXTENSIONS = set(['csv'])
 WTF_CSRF_ENABLED = False
 BCRYPT_LOG_ROUNDS = 12
 DEBUG_TB_ENABLED = False
-DEBUG_TB_INTERCEPT_REDIRECTS = False
\ No newline at end of file
+DEBUG_TB_INTERCEPT_REDIRECTS = False
+PERSIST_MONTHLY_BILLS = False
+IMPORT_WORKERS = 2
+PLOT_CACHE_DIR = 'data/plots'
+PLOT_CACHE_MAX_BYTES = 50 * 1024 * 1024
+PRERENDER_PLOTS = True
+DEBUG_METRICS = False
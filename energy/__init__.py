@@ -11,8 +11,11 @@ from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 
+from .encoding import FastJSONProvider
+
 app = Flask(__name__)
 app.config.from_object("config")
+app.json = FastJSONProvider(app)
 
 db = SQLAlchemy(app)
 
@@ -30,6 +33,7 @@ from energy.meters import meters  # noqa
 
 app.register_blueprint(meters, url_prefix="/meters")
 
+from energy import metrics  # noqa
 from energy.views import *
 
 
@@ -1,11 +1,18 @@
 import arrow
+from collections import OrderedDict
 from datetime import datetime
-from metering import get_load_energy_readings
+from threading import Lock
+from typing import Dict, Tuple
+import numpy as np
+from metering import get_interval_arrays, get_grouped_interval_arrays
 from metering import get_daily_energy_readings
 from metering import get_monthly_energy_readings
+from metering import get_monthly_energy_readings_range
 from metering import get_data_range, get_month_ranges
+from metering import get_monthly_bills, save_monthly_bill
+from metering.intervals import downsample_lttb
+from metering import timed
 from energy_shaper import split_into_profiled_intervals
-from energy_shaper import group_into_profiled_intervals
 from qldtariffs import financial_year_ending
 from qldtariffs import get_daily_charges, get_monthly_charges
 from qldtariffs import electricity_charges_general
@@ -13,15 +20,85 @@ from qldtariffs import electricity_charges_tou
 from qldtariffs import electricity_charges_tou_demand
 from .usage import average_daily_peak_demand
 
+# Chart bucket lengths in minutes, finest first
+CHART_RESOLUTIONS = {"5m": 5, "30m": 30, "1h": 60, "1d": 24 * 60}
+MAX_CHART_POINTS = 2000
 
-def monthly_bill_data(meter_id: int, year: int, month: int):
-    """ Get billing data for a given month """
+# Calculated bills keyed by (meter, year, month, totals version, tariff year)
+BILL_CACHE_SIZE = 1024
+_bill_cache: OrderedDict = OrderedDict()
+_bill_cache_lock = Lock()
 
-    month_start = datetime(year, month, 1)
-    period_desc = month_start.strftime("%Y %b")
-    fy = str(financial_year_ending(month_start))
 
+def clear_bill_cache(meter_id=None):
+    """ Forget cached bills for a meter, or for all meters """
+    with _bill_cache_lock:
+        if meter_id is None:
+            _bill_cache.clear()
+            return
+        for key in [key for key in _bill_cache if key[0] == int(meter_id)]:
+            del _bill_cache[key]
+
+
+def monthly_bill_data(meter_id: int, year: int, month: int, persist: bool = False):
+    """ Get billing data for a given month
+
+    :param persist: Also store the calculated bill in the meter database
+    """
     mth = get_monthly_energy_readings(meter_id, year, month)
+    return get_monthly_bill(meter_id, year, month, mth, persist)
+
+
+def monthly_bills_data(meter_id: int, months, persist: bool = False):
+    """ Get billing data for several months, using stored bills if current
+
+    :param months: (year, month) tuples in order
+    """
+    if not months:
+        return
+    start = datetime(*months[0], 1)
+    end = datetime(*months[-1], 1)
+    monthlies = get_monthly_energy_readings_range(meter_id, start, end)
+    stored = get_monthly_bills(meter_id, start, end) if persist else {}
+
+    for year, month in months:
+        fy = str(financial_year_ending(datetime(year, month, 1)))
+        stored_fy, bill = stored.get((year, month), (None, None))
+        if stored_fy == fy:
+            yield dict(bill)
+        else:
+            mth = monthlies.get((year, month))
+            yield get_monthly_bill(meter_id, year, month, mth, persist)
+
+
+def get_monthly_bill(meter_id: int, year: int, month: int, mth, persist: bool):
+    """ Get the bill for a month's totals from the cache, or calculate it """
+
+    fy = str(financial_year_ending(datetime(year, month, 1)))
+    version = mth.version if mth else None
+    key = (int(meter_id), year, month, version, fy)
+
+    with _bill_cache_lock:
+        bill = _bill_cache.get(key)
+        if bill is not None:
+            _bill_cache.move_to_end(key)
+    if bill is None:
+        bill = calculate_monthly_bill(year, month, fy, mth)
+        with _bill_cache_lock:
+            _bill_cache[key] = bill
+            while len(_bill_cache) > BILL_CACHE_SIZE:
+                _bill_cache.popitem(last=False)
+        if persist and mth:
+            save_monthly_bill(meter_id, year, month, version, fy, bill)
+    # Callers add their own keys to the result
+    return dict(bill)
+
+
+@timed("qldtariffs")
+def calculate_monthly_bill(year: int, month: int, fy: str, mth):
+    """ Calculate the tariff charges for a month's totals """
+
+    period_desc = datetime(year, month, 1).strftime("%Y %b")
     if mth:
         num_days = mth.num_days
         load_total = mth.load_total
@@ -131,10 +208,13 @@ def get_monthly_chart_data(meter_id, start_date, end_date):
     chartdata["demand"] = []
 
     start, end = get_data_range(meter_id)
+    monthlies = get_monthly_energy_readings_range(meter_id, start, end)
 
     for year, month, _ in get_month_ranges(start, end):
 
-        mth = get_monthly_energy_readings(meter_id, year, month)
+        mth = monthlies.get((year, month))
+        if mth is None:
+            continue
         dTime = arrow.get(datetime(year, month, 1))
         ts = int(dTime.timestamp * 1000)
         usage_total = mth.load_total
@@ -153,12 +233,48 @@ def get_interval_chart_data(meter_id, start_date, end_date):
     chartdata["label"] = "Energy Profile"
     chartdata["consumption"] = []
 
-    reads = list(get_load_energy_readings(meter_id, start_date, end_date))
-    split_reads = group_into_profiled_intervals(reads, interval_m=30)
-    for r in split_reads:
-        dTime = arrow.get(r[0])
-        ts = int(dTime.timestamp * 1000)
-        impWh = r[2]
-        chartdata["consumption"].append([ts, impWh])
+    interval_ends, totals = get_interval_arrays(
+        meter_id, "load", start_date, end_date, interval_m=30
+    )
+    # Points are at the start of each interval
+    timestamps = (interval_ends - 30 * 60) * 1000
+    for ts, total in zip(timestamps.tolist(), totals.tolist()):
+        chartdata["consumption"].append([ts, total])
 
     return chartdata
+
+
+def choose_resolution(
+    start_date: datetime, end_date: datetime, max_points: int = MAX_CHART_POINTS
+) -> str:
+    """ Pick the finest resolution that keeps a chart under max_points
+    """
+    span_m = (end_date - start_date).total_seconds() / 60
+    for resolution, bucket_m in CHART_RESOLUTIONS.items():
+        if span_m / bucket_m <= max_points:
+            return resolution
+    return resolution
+
+
+def get_power_series(
+    meter_id, start_date, end_date, ch_groups, resolution="5m", max_points=None
+) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """ Return the average kW in each bucket for several channel groups
+
+    :param ch_groups: The channel groups, from the CHANNEL_GROUPS
+    :param resolution: The bucket length, one of CHART_RESOLUTIONS
+    :param max_points: Optionally downsample further to this many points
+    :return: Bucket ends in epoch milliseconds and the kW in each bucket,
+             keyed by group name
+    """
+    bucket_m = CHART_RESOLUTIONS[resolution]
+    grouped = get_grouped_interval_arrays(
+        meter_id, ch_groups, start_date, end_date, bucket_m
+    )
+    series = {}
+    for ch_group, (interval_ends, totals) in grouped.items():
+        power = totals / (bucket_m / 60)
+        if max_points:
+            interval_ends, power = downsample_lttb(interval_ends, power, max_points)
+        series[ch_group] = (interval_ends * 1000, power)
+    return series
@@ -0,0 +1,63 @@
+"""
+    energy.encoding
+    ~~~~~~~~~
+    Encode JSON responses with orjson or simplejson when they are installed
+"""
+
+import numpy as np
+from flask.json.provider import DefaultJSONProvider
+from metering import timed
+
+try:
+    import orjson
+except ImportError:  # Falls back to simplejson or the standard library
+    orjson = None
+
+try:
+    import simplejson
+except ImportError:
+    simplejson = None
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """ A JSON provider that also encodes numpy arrays
+
+    Arrays are written straight from their buffers by orjson, which is much
+    faster than the standard library for the long series charts return.
+    Dates are still passed to Flask so they are encoded the same either way.
+    """
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, np.ndarray):
+            return o.tolist()
+        if isinstance(o, np.generic):
+            return o.item()
+        if isinstance(o, tuple):  # Named tuples, like the tariff charges
+            return list(o)
+        return DefaultJSONProvider.default(o)
+
+    @timed("json")
+    def dumps(self, obj, **kwargs) -> str:
+        if orjson is not None and set(kwargs) <= {"indent", "separators"}:
+            option = (
+                orjson.OPT_SERIALIZE_NUMPY
+                | orjson.OPT_NON_STR_KEYS
+                | orjson.OPT_PASSTHROUGH_DATETIME
+            )
+            if self.sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            if kwargs.get("indent"):
+                option |= orjson.OPT_INDENT_2
+            return orjson.dumps(obj, default=self.default, option=option).decode()
+
+        kwargs.setdefault("default", self.default)
+        kwargs.setdefault("ensure_ascii", self.ensure_ascii)
+        kwargs.setdefault("sort_keys", self.sort_keys)
+        if simplejson is not None:
+            # Encode like the standard library, named tuples as lists and
+            # decimals left to Flask, which encodes them as strings
+            return simplejson.dumps(
+                obj, use_decimal=False, namedtuple_as_object=False, **kwargs
+            )
+        return super().dumps(obj, **kwargs)
@@ -0,0 +1,192 @@
+"""
+    energy.jobs
+    ~~~~~~~~~
+    Load uploaded meter data in the background
+"""
+
+import datetime
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import List, Optional
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+from metering import load_nem_data
+
+from . import app, db
+from .models import ImportJob, get_meter_name
+from .plots import prerender_calendar_plot
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = Lock()
+_job_table_ready = False
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """ Return the shared worker pool, starting it on first use """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            workers = app.config.get("IMPORT_WORKERS", 2)
+            _executor = ThreadPoolExecutor(workers, thread_name_prefix="import")
+        return _executor
+
+
+def create_job_table():
+    """ Add the job table to app databases created before it existed """
+    global _job_table_ready
+    if not _job_table_ready:
+        ImportJob.__table__.create(db.engine, checkfirst=True)
+        _job_table_ready = True
+
+
+def queue_import(meter_id: int, upload) -> ImportJob:
+    """ Save an uploaded NEM file and queue it to be loaded
+
+    Files are loaded by a pool of IMPORT_WORKERS threads,
+    or straight away if IMPORT_WORKERS is 0.
+    :param upload: The uploaded file storage
+    """
+    create_job_table()
+    job = ImportJob(meter_id=meter_id, status="queued")
+    db.session.add(job)
+    db.session.commit()
+
+    # Each job gets its own file so a later upload can't replace it
+    filename = f"{meter_id}_{job.job_id}.csv"
+    job.file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
+    upload.save(job.file_path)
+    db.session.commit()
+
+    start_meter_jobs(meter_id)
+    return job
+
+
+def start_meter_jobs(meter_id: int):
+    """ Have a worker load the queued files for a meter """
+    if app.config.get("IMPORT_WORKERS", 2):
+        get_executor().submit(run_meter_jobs, meter_id)
+    else:
+        run_meter_jobs(meter_id)
+
+
+def run_meter_jobs(meter_id: int):
+    """ Run the queued jobs for a meter in order, until none are left
+
+    Jobs are claimed from the job table, so a meter has one running job
+    across all processes, and files are loaded in the order they were
+    uploaded, as the first reading saved wins. If the meter already has a
+    running job this returns, and that job's worker runs the rest.
+    """
+    with app.app_context():
+        while True:
+            job = claim_next_job(meter_id)
+            if job is None:
+                break
+            run_import(job)
+
+
+def claim_next_job(meter_id: int) -> Optional[ImportJob]:
+    """ Mark the oldest queued job for the meter as running and return it
+
+    :return: The job, or None if there is nothing queued or a job is running
+    """
+    next_id = (
+        db.session.query(func.min(ImportJob.job_id))
+        .filter_by(meter_id=meter_id, status="queued")
+        .scalar()
+    )
+    if next_id is None:
+        return None
+
+    # A single update, so only one worker can claim the job
+    other = aliased(ImportJob)
+    running = (
+        db.session.query(other.job_id)
+        .filter(other.meter_id == meter_id, other.status == "running")
+        .exists()
+    )
+    claimed = ImportJob.query.filter(
+        ImportJob.job_id == next_id, ImportJob.status == "queued", ~running
+    ).update(
+        {"status": "running", "started_at": datetime.datetime.now()},
+        synchronize_session=False,
+    )
+    db.session.commit()
+    if not claimed:
+        return None
+    return ImportJob.query.get(next_id)
+
+
+def run_import(job: ImportJob):
+    """ Load the file for a claimed import job and record the outcome """
+    job_id = job.job_id
+
+    def progress(inserted: int, skipped: int):
+        job.rows_inserted = inserted
+        job.rows_skipped = skipped
+        db.session.commit()
+
+    try:
+        nmi = get_meter_name(job.meter_id)
+        inserted, skipped = load_nem_data(
+            job.meter_id, nmi, job.file_path, progress=progress
+        )
+    except Exception as e:
+        logging.exception("Import job %s failed", job_id)
+        # The app session may have failed too, and the job must not stay running
+        db.session.rollback()
+        job = ImportJob.query.get(job_id)
+        job.status = "failed"
+        job.error = str(e)[0:255]
+    else:
+        job.status = "done"
+        job.rows_inserted = inserted
+        job.rows_skipped = skipped
+        os.remove(job.file_path)
+    job.finished_at = datetime.datetime.now()
+    db.session.commit()
+    logging.info(
+        "Import job %s for meter %s %s in %.1fs",
+        job_id,
+        job.meter_id,
+        job.status,
+        job.elapsed,
+    )
+    if job.status == "done" and app.config.get("PRERENDER_PLOTS", False):
+        prerender_calendar_plot(job.meter_id)
+
+
+def resume_import_jobs():
+    """ Requeue the jobs a restart interrupted, and start every queued job
+
+    Only call this before any workers are loading files, as running jobs are
+    assumed to have been interrupted. Loading a file again is safe, as the
+    readings it already saved are skipped.
+    """
+    with app.app_context():
+        create_job_table()
+        interrupted = ImportJob.query.filter_by(status="running").update(
+            {"status": "queued", "started_at": None}, synchronize_session=False
+        )
+        db.session.commit()
+        if interrupted:
+            logging.info("Requeued %s interrupted import jobs", interrupted)
+        queued = db.session.query(ImportJob.meter_id).filter_by(status="queued")
+        meter_ids = [meter_id for meter_id, in queued.distinct()]
+    for meter_id in meter_ids:
+        start_meter_jobs(meter_id)
+
+
+def get_import_job(meter_id: int, job_id: int) -> Optional[ImportJob]:
+    """ Return an import job for the meter """
+    create_job_table()
+    return ImportJob.query.filter_by(meter_id=meter_id, job_id=job_id).first()
+
+
+def get_import_jobs(meter_id: int, limit: int = 10) -> List[ImportJob]:
+    """ Return the most recent import jobs for the meter """
+    create_job_table()
+    jobs = ImportJob.query.filter_by(meter_id=meter_id)
+    return jobs.order_by(ImportJob.job_id.desc()).limit(limit).all()
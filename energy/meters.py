@@ -5,27 +5,21 @@
 """
 
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from functools import wraps
 from dateutil.relativedelta import relativedelta
-from io import BytesIO
 from typing import Optional, Tuple
 from collections import defaultdict
 from flask import Blueprint, render_template, redirect, url_for
-from flask import flash, jsonify, Response
+from flask import flash, jsonify, request, Response, make_response
 from flask_login import login_required, current_user
 from flask_wtf import FlaskForm
-import pandas as pd
-import calplot
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from werkzeug.utils import secure_filename
-from metering import load_nem_data
-from metering import get_load_energy_readings
 from metering import get_daily_energy_readings
-from metering import get_monthly_energy_readings
-from metering import get_data_range, get_month_ranges
-from metering import LOAD_CHS, CONTROL_CHS, GENERATION_CHS
-from metering import get_day_of_week_avg
-from energy_shaper import group_into_profiled_intervals
+from metering import get_monthly_energy_readings_range
+from metering import get_data_range, get_month_ranges, get_data_version
+from metering import get_db_location
+from metering import get_usage_stats
+from metering import export_meter_table, EXPORT_TABLES, EXPORT_FORMATS
 
 from . import app, db
 from .views import get_user_meters
@@ -34,7 +28,10 @@ from .forms import FileForm, MeterDetails
 from .models import get_meter_name
 from .models import User, Meter, delete_meter_data
 from .models import visible_meters
-from .charts import monthly_bill_data
+from .charts import monthly_bill_data, monthly_bills_data
+from .charts import CHART_RESOLUTIONS, choose_resolution, get_power_series
+from .jobs import queue_import, get_import_job, get_import_jobs
+from .plots import get_calendar_plot
 
 meters = Blueprint("meters", __name__, template_folder="templates")
 
@@ -78,6 +75,51 @@ def meter_editable(meter_id: int) -> bool:
     return False
 
 
+def meter_data_etag(meter_id: int) -> Tuple[str, Optional[datetime]]:
+    """ Return the ETag and last modified time of a meter's data """
+    data_version, data_modified = get_data_version(meter_id)
+    modified = int(data_modified.timestamp()) if data_modified else 0
+    return f"meter-{meter_id}-{data_version}-{modified}", data_modified
+
+
+def cached_by_data_version(view):
+    """ Answer conditional requests for meter data with 304 Not Modified
+
+    The response only changes when the meter data does, so the check is
+    made before the view runs any metering queries. Visibility is checked
+    first, and meters without a database are not found, so requests never
+    create a meter database.
+    """
+
+    @wraps(view)
+    def wrapper(meter_id, *args, **kwargs):
+        if not meter_visible(meter_id):
+            return "Not authorised to view this page", 403
+        if not os.path.exists(get_db_location(meter_id)):
+            return "No data for this meter", 404
+        etag, data_modified = meter_data_etag(meter_id)
+        if request.if_none_match:
+            not_modified = request.if_none_match.contains(etag)
+        elif request.if_modified_since and data_modified:
+            modified = data_modified.replace(microsecond=0, tzinfo=timezone.utc)
+            not_modified = modified <= request.if_modified_since
+        else:
+            not_modified = False
+        if not_modified:
+            response = Response(status=304)
+        else:
+            response = make_response(view(meter_id, *args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        if data_modified:
+            response.last_modified = data_modified.replace(tzinfo=timezone.utc)
+        response.cache_control.no_cache = True  # Revalidate each time
+        return response
+
+    return wrapper
+
+
 @meters.route("/<int:meter_id>/manage/details", methods=["GET", "POST"])
 @login_required
 def manage_meter(meter_id):
@@ -119,13 +161,9 @@ def manage_import(meter_id):
 
     form = FileForm()
     if form.validate_on_submit():
-        filename = secure_filename(str(meter_id) + ".csv")
-        file_path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        form.upload_file.data.save(file_path)
-
-        nmi = get_meter_name(meter_id)
-        load_nem_data(meter_id, nmi, file_path)
-        flash("Readings added", category="success")
+        job = queue_import(meter_id, form.upload_file.data)
+        msg = f"Import #{job.job_id} queued, readings will be added shortly"
+        flash(msg, category="success")
 
         return redirect(url_for("meters.manage_import", meter_id=meter_id))
     return render_template(
@@ -133,9 +171,32 @@ def manage_import(meter_id):
         id=meter_id,
         meter_name=get_meter_name(meter_id),
         form=form,
+        jobs=get_import_jobs(meter_id),
     )
 
 
+@meters.route("/<int:meter_id>/manage/import/jobs.json")
+@login_required
+def import_jobs(meter_id):
+    """ Return the status of recent import jobs as json """
+    if not meter_editable(meter_id):
+        return "Not authorised to manage this meter", 403
+    jobs = [job.to_dict() for job in get_import_jobs(meter_id)]
+    return jsonify({"jobs": jobs})
+
+
+@meters.route("/<int:meter_id>/manage/import/<int:job_id>.json")
+@login_required
+def import_job_status(meter_id, job_id):
+    """ Return the status of an import job as json """
+    if not meter_editable(meter_id):
+        return "Not authorised to manage this meter", 403
+    job = get_import_job(meter_id, job_id)
+    if job is None:
+        return "Import job not found", 404
+    return jsonify(job.to_dict())
+
+
 @meters.route("/<int:meter_id>/manage/export", methods=["GET", "POST"])
 @login_required
 def manage_export(meter_id):
@@ -157,6 +218,49 @@ def manage_export(meter_id):
         id=meter_id,
         meter_name=get_meter_name(meter_id),
         form=form,
+        tables=EXPORT_TABLES.keys(),
+        formats=EXPORT_FORMATS,
+    )
+
+
+EXPORT_MIMETYPES = {
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+@meters.route("/<int:meter_id>/export/<table>.<fmt>")
+def export_table(meter_id, table, fmt):
+    """ Download the readings, daily or monthly totals of a meter
+
+    Optional query parameters are start and end dates (end is exclusive)
+    and a comma separated list of channels to export readings for.
+    """
+    if not meter_visible(meter_id):
+        return "Not authorised to view this page", 403
+
+    filters = {}
+    try:
+        for arg in ["start", "end"]:
+            if request.args.get(arg):
+                filters[arg] = datetime.strptime(request.args[arg], "%Y-%m-%d")
+    except ValueError:
+        return "Dates must be in the format YYYY-MM-DD", 400
+    if request.args.get("channels"):
+        filters["channels"] = request.args["channels"].split(",")
+
+    try:
+        data = export_meter_table(meter_id, table, fmt, **filters)
+    except ValueError as e:
+        return str(e), 404
+    except ImportError as e:
+        return str(e), 501
+    filename = f"meter_{meter_id}_{table}.{fmt}"
+    return Response(
+        data,
+        mimetype=EXPORT_MIMETYPES[fmt],
+        headers={"Content-disposition": f"attachment; filename={filename}"},
     )
 
 
@@ -220,10 +324,12 @@ def usage_overview(meter_id: int):
 
 
 @meters.route("/<int:meter_id>/usage_overview/monthly_totals.json")
+@cached_by_data_version
 def monthly_totals(meter_id):
     """ Get monthly energy totals for overview chart """
 
     start, end = get_data_range(meter_id)
+    monthlies = get_monthly_energy_readings_range(meter_id, start, end)
 
     load_data = []
     control_data = []
@@ -232,7 +338,9 @@ def monthly_totals(meter_id):
 
         day_dt = datetime(year, month, 1)
         day_ts = f"{day_dt:%Y %b}"  # day_dt.isoformat()
-        mth = get_monthly_energy_readings(meter_id, year, month)
+        mth = monthlies.get((year, month))
+        if mth is None:
+            continue
         daily_load = mth.load_total / mth.num_days
         load_data.append((day_ts, daily_load))
         daily_control = mth.control_total / mth.num_days
@@ -252,8 +360,9 @@ def monthly_totals(meter_id):
 
 
 @meters.route("/<int:meter_id>/usage_overview/stats.json")
+@cached_by_data_version
 def usage_stats(meter_id: int):
-    """ Show billing for all months """
+    """ Get daily usage stats by day of week, month and season """
 
     if not meter_visible(meter_id):
         return "Not authorised to view this page", 403
@@ -268,33 +377,29 @@ def usage_stats(meter_id: int):
 
     start, end = get_data_range(meter_id)
 
-    # Get period for calculating meter stats
+    # Stats are stored by month, so use the 12 months up to the latest data
     stats_end = end
-    stats_start = stats_end - relativedelta(months=12)
+    stats_start = stats_end - relativedelta(months=11)
     if stats_start < start:
         stats_start = start
 
-    # Calculate meter stats
-    stats = {}
-    stats["day_avgs"] = get_day_of_week_avg(1, stats_start, stats_end)
-
+    stats = get_usage_stats(meter_id, stats_start, stats_end)
     return jsonify(stats)
 
 
 @meters.route("/<int:meter_id>/<start>/<end>/calendar_plot.png")
+@cached_by_data_version
 def calendar_png(meter_id, start, end):
+    """ Get a calendar plot of daily usage """
+    if not meter_visible(meter_id):
+        return "Not authorised to view this page", 403
+
     start_dt = datetime.strptime(start, "%Y-%m-%d")
     end_dt = datetime.strptime(end, "%Y-%m-%d")
-    reads = list(get_load_energy_readings(1, start_dt, end_dt, channels=LOAD_CHS))
-    headings = ["period_start", "usage"]
-    rows = [[x.start, x.usage] for x in reads]
-    df = pd.DataFrame(data=rows, columns=headings)
-    df.set_index("period_start", inplace=True)
-    plot = calplot.calplot(pd.Series(df.usage), daylabels="MTWTFSS")
-    fig = plot[0]
-    output = BytesIO()
-    FigureCanvas(fig).print_png(output)
-    return Response(output.getvalue(), mimetype="image/png")
+    image = get_calendar_plot(meter_id, start_dt, end_dt)
+    if image is None:
+        return "No data for this period", 404
+    return Response(image, mimetype="image/png")
 
 
 def get_financial_year(dt: datetime) -> str:
@@ -353,6 +458,7 @@ def usage_fy(meter_id, fin_year):
 
 
 @meters.route("/<int:meter_id>/usage_fy/<fin_year>/monthly_bills.json")
+@cached_by_data_version
 def monthly_bills(meter_id, fin_year):
     """ Return the monthly bill costs as json """
     if not meter_visible(meter_id):
@@ -365,8 +471,11 @@ def monthly_bills(meter_id, fin_year):
 
     fy_totals = defaultdict(int)
     month_data = []
-    for year, month, _ in get_month_ranges(rpt_start, rpt_end):
-        mth = monthly_bill_data(meter_id, year, month)
+    months = [(year, month) for year, month, _ in get_month_ranges(rpt_start, rpt_end)]
+    persist = app.config.get("PERSIST_MONTHLY_BILLS", False)
+    for mth in monthly_bills_data(meter_id, months, persist):
+        year = mth["year"]
+        month = mth["month"]
         mth["month_url"] = url_for(
             "meters.usage_monthly", meter_id=meter_id, year=year, month=month
         )
@@ -402,6 +511,7 @@ def monthly_bills(meter_id, fin_year):
 
 
 @meters.route("/<int:meter_id>/usage_fy/<fin_year>/daily_totals.json")
+@cached_by_data_version
 def fy_daily_totals(meter_id, fin_year):
     if not meter_visible(meter_id):
         return "Not authorised to view this page", 403
@@ -486,7 +596,8 @@ def usage_monthly(meter_id, year, month):
         next_month = None
     fin_yr = get_financial_year(rpt_start)
 
-    mth = monthly_bill_data(meter_id, rpt_start.year, rpt_start.month)
+    persist = app.config.get("PERSIST_MONTHLY_BILLS", False)
+    mth = monthly_bill_data(meter_id, rpt_start.year, rpt_start.month, persist)
 
     daily_reads = get_daily_energy_readings(meter_id, rpt_start, rpt_end)
 
@@ -508,6 +619,7 @@ def usage_monthly(meter_id, year, month):
 
 
 @meters.route("/<int:meter_id>/usage_mth/<int:year>/<int:month>/daily_totals.json")
+@cached_by_data_version
 def month_day_data(meter_id, year, month):
     if not meter_visible(meter_id):
         return "Not authorised to view this page", 403
@@ -564,59 +676,59 @@ def usage_daily(meter_id, year, month, day):
 
 
 @meters.route("/<int:meter_id>/<start>/<end>/energy_data.json")
+@cached_by_data_version
 def energy_data(meter_id, start, end):
+    """ Get interval power data for the chart
+
+    Optional query parameters are a resolution (5m, 30m, 1h, 1d or auto)
+    and a maximum number of points to downsample each series to.
+    """
     if not meter_visible(meter_id):
         return "Not authorised to view this page", 403
 
     start_dt = datetime.strptime(start, "%Y-%m-%d")
     end_dt = datetime.strptime(end, "%Y-%m-%d")
 
-    chartdata = dict()
+    resolution = request.args.get("resolution", "auto")
+    if resolution == "auto":
+        resolution = choose_resolution(start_dt, end_dt)
+    if resolution not in CHART_RESOLUTIONS:
+        return f"Resolution must be one of {', '.join(CHART_RESOLUTIONS)}", 400
+    max_points = request.args.get("points", None, type=int)
 
-    # Add general consumption
-    load_data = []
-    reads = list(
-        get_load_energy_readings(meter_id, start_dt, end_dt, channels=LOAD_CHS)
+    ch_groups = ["load", "control", "generation"]
+    series = get_power_series(
+        meter_id, start_dt, end_dt, ch_groups, resolution, max_points
     )
-    split_reads = group_into_profiled_intervals(reads, interval_m=5)
-    for read in split_reads:
-        read_ts = read.end.isoformat()
-        load_data.append((read_ts, read.usage / (5 / 60)))
+
+    chartdata = dict()
+    chartdata["resolution"] = resolution
+
+    # Series are sent as columns of epoch milliseconds and kW
+    timestamps, power = series["load"]
     chartdata["consumption"] = {
         "label": "General",
         "color": "#FFA500",
-        "data": load_data,
+        "x": timestamps,
+        "y": power,
     }
 
-    # Controlled load
-    load_data = []
-    reads = list(
-        get_load_energy_readings(meter_id, start_dt, end_dt, channels=CONTROL_CHS)
-    )
-    split_reads = group_into_profiled_intervals(reads, interval_m=5)
-    for read in split_reads:
-        if read.usage:
-            read_ts = read.end.isoformat()
-            load_data.append((read_ts, read.usage / (5 / 60)))
+    # Controlled load, only while it is on
+    timestamps, power = series["control"]
     chartdata["controlled"] = {
         "label": "Controlled Load",
         "color": "#FAB57F",
-        "data": load_data,
+        "x": timestamps[power != 0],
+        "y": power[power != 0],
     }
 
     # Add generation
-    load_data = []
-    reads = list(
-        get_load_energy_readings(meter_id, start_dt, end_dt, channels=GENERATION_CHS)
-    )
-    split_reads = group_into_profiled_intervals(reads, interval_m=5)
-    for read in split_reads:
-        read_ts = read.end.isoformat()
-        load_data.append((read_ts, -read.usage / (5 / 60)))
+    timestamps, power = series["generation"]
     chartdata["generation"] = {
         "label": "Generation",
         "color": "#006400",
-        "data": load_data,
+        "x": timestamps,
+        "y": -power,
     }
 
     return jsonify(chartdata)
@@ -0,0 +1,58 @@
+"""
+    energy.metrics
+    ~~~~~~~~~
+    Report the SQL and metering time spent on each request
+"""
+
+import json
+import logging
+from flask import abort, jsonify, request
+from metering import start_request, finish_request, record, get_histograms
+from . import app
+
+logger = logging.getLogger(__name__)
+
+
+def format_server_timing(metrics) -> str:
+    """ Format request totals as a Server-Timing header value """
+    timings = [f"total;dur={metrics.elapsed * 1000:.1f}"]
+    for name, count in sorted(metrics.counts.items()):
+        duration = metrics.durations[name] * 1000
+        timings.append(f'{name};dur={duration:.1f};desc="{count} calls"')
+    return ", ".join(timings)
+
+
+@app.before_request
+def start_request_metrics():
+    start_request()
+
+
+@app.after_request
+def report_request_metrics(response):
+    """ Add a Server-Timing header and log the request totals
+
+    Streamed responses are reported before their body is generated.
+    """
+    metrics = finish_request()
+    if metrics is None:
+        return response
+    record(f"request.{request.endpoint}", metrics.elapsed)
+    response.headers["Server-Timing"] = format_server_timing(metrics)
+    log_entry = {
+        "method": request.method,
+        "path": request.path,
+        "endpoint": request.endpoint,
+        "status": response.status_code,
+        "ms": round(metrics.elapsed * 1000, 3),
+        "timings": metrics.to_dict(),
+    }
+    logger.info(json.dumps(log_entry))
+    return response
+
+
+@app.route("/debug/metrics")
+def debug_metrics():
+    """ Return histograms of the time spent in requests, SQL and metering """
+    if not app.config.get("DEBUG_METRICS", False):
+        abort(404)
+    return jsonify(get_histograms())
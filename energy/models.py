@@ -8,6 +8,10 @@ from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy import Column, String, DateTime, Float, Integer
 
 from werkzeug.security import generate_password_hash, check_password_hash
+from metering import get_db_location, dispose_db_engine
+from metering import get_archived_partitions, get_archive_location
+from .charts import clear_bill_cache
+from .plots import clear_plot_cache
 
 from . import db, app
 
@@ -23,11 +27,56 @@ class Meter(db.Model):
     meter_name = Column(String(20))
 
 
+class ImportJob(db.Model):
+    """ A NEM file waiting to be, or that has been, loaded for a meter """
+
+    __tablename__ = "import_job"
+    job_id = Column(Integer, primary_key=True, autoincrement=True)
+    meter_id = Column(Integer, ForeignKey("meter.meter_id"), index=True)
+    file_path = Column(String(255))
+    status = Column(String(7), default="queued")  # queued/running/done/failed
+    rows_inserted = Column(Integer, default=0)
+    rows_skipped = Column(Integer, default=0)
+    error = Column(String(255))
+    queued_at = Column(DateTime, default=datetime.datetime.now)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+    @property
+    def elapsed(self):
+        """ Seconds spent running the job so far """
+        if not self.started_at:
+            return None
+        finished_at = self.finished_at or datetime.datetime.now()
+        return (finished_at - self.started_at).total_seconds()
+
+    def to_dict(self) -> dict:
+        """ The job status as returned by the API """
+        return {
+            "job_id": self.job_id,
+            "meter_id": self.meter_id,
+            "status": self.status,
+            "rows_inserted": self.rows_inserted,
+            "rows_skipped": self.rows_skipped,
+            "rows_processed": (self.rows_inserted or 0) + (self.rows_skipped or 0),
+            "error": self.error,
+            "queued_at": self.queued_at.isoformat() if self.queued_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "elapsed": self.elapsed,
+        }
+
+
 def delete_meter_data(meter_id):
     """ Delete meter and all data """
     Meter.query.filter(Meter.meter_id == meter_id).delete()
     db.session.commit()
-    db_loc = f"data/meter_{meter_id}.db"
+    dispose_db_engine(meter_id)
+    clear_bill_cache(meter_id)
+    clear_plot_cache(meter_id)
+    for name in get_archived_partitions(meter_id):
+        os.remove(get_archive_location(meter_id, name))
+    db_loc = get_db_location(meter_id)
     if os.path.isfile(db_loc):
         os.remove(db_loc)
 
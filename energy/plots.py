@@ -0,0 +1,133 @@
+"""
+    energy.plots
+    ~~~~~~~~~
+    Render usage plots as images, with an on-disk cache
+"""
+
+import glob
+import logging
+import os
+import tempfile
+from datetime import datetime, timedelta
+from io import BytesIO
+from threading import Lock
+from typing import Optional
+import pandas as pd
+import calplot
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+from metering import get_daily_energy_readings, get_data_range, get_data_version
+
+from . import app
+
+PLOT_CACHE_DIR = "data/plots"
+PLOT_CACHE_MAX_BYTES = 50 * 1024 * 1024
+
+# pyplot keeps global state, so only render one figure at a time
+_render_lock = Lock()
+_cache_lock = Lock()
+
+
+def render_calendar_plot(meter_id: int, start: datetime, end: datetime):
+    """ Render a calendar heatmap of daily usage from the daily totals
+
+    :param end: The end of the period, exclusive
+    :return: The PNG image, or None if there is no data
+    """
+    dailies = get_daily_energy_readings(meter_id, start, end - timedelta(days=1))
+    dailies = [d for d in dailies if not d.estimated]
+    if not dailies:
+        return None
+    days = pd.DatetimeIndex([d.day for d in dailies])
+    usage = pd.Series([d.load_total for d in dailies], index=days)
+    with _render_lock:
+        fig, _ = calplot.calplot(usage, daylabels="MTWTFSS")
+        output = BytesIO()
+        FigureCanvas(fig).print_png(output)
+        plt.close(fig)
+    return output.getvalue()
+
+
+def get_cache_dir() -> str:
+    """ Return the directory rendered plots are stored in """
+    return app.config.get("PLOT_CACHE_DIR", PLOT_CACHE_DIR)
+
+
+def get_calendar_plot(meter_id: int, start: datetime, end: datetime):
+    """ Get the calendar plot from the cache, or render and store it
+
+    Cached images are keyed on the meter, range and data version.
+    """
+    data_version, _ = get_data_version(meter_id)
+    prefix = f"calendar_{meter_id}_{start:%Y%m%d}_{end:%Y%m%d}_"
+    file_path = os.path.join(get_cache_dir(), f"{prefix}v{data_version}.png")
+    try:
+        with open(file_path, "rb") as f:
+            image = f.read()
+        os.utime(file_path)  # Mark as recently used
+        return image
+    except FileNotFoundError:
+        pass
+
+    image = render_calendar_plot(meter_id, start, end)
+    if image is not None:
+        store_plot(file_path, image, stale=f"{prefix}v*.png")
+    return image
+
+
+def store_plot(file_path: str, image: bytes, stale: Optional[str] = None):
+    """ Save a rendered plot, replacing stale versions and evicting old plots
+
+    :param stale: Pattern of earlier versions of the plot to remove
+    """
+    cache_dir = os.path.dirname(file_path)
+    with _cache_lock:
+        os.makedirs(cache_dir, exist_ok=True)
+        if stale:
+            for old_path in glob.glob(os.path.join(cache_dir, stale)):
+                os.remove(old_path)
+        # Write to a temporary file first so readers never see part of a plot
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(image)
+        os.replace(tmp_path, file_path)
+        max_bytes = app.config.get("PLOT_CACHE_MAX_BYTES", PLOT_CACHE_MAX_BYTES)
+        evict_plots(cache_dir, max_bytes)
+
+
+def evict_plots(cache_dir: str, max_bytes: int):
+    """ Remove the least recently used plots until the cache fits """
+    plots = []
+    for file_path in glob.glob(os.path.join(cache_dir, "*.png")):
+        stat = os.stat(file_path)
+        plots.append((stat.st_mtime, stat.st_size, file_path))
+    total = sum(size for _, size, _ in plots)
+    for _, size, file_path in sorted(plots):
+        if total <= max_bytes:
+            break
+        os.remove(file_path)
+        total -= size
+
+
+def clear_plot_cache(meter_id: int):
+    """ Remove every cached plot for a meter """
+    with _cache_lock:
+        pattern = os.path.join(get_cache_dir(), f"calendar_{meter_id}_*.png")
+        for file_path in glob.glob(pattern):
+            os.remove(file_path)
+
+
+def prerender_calendar_plot(meter_id: int):
+    """ Render the calendar plot shown on the usage overview page
+
+    The overview requests the plot for the whole data range.
+    """
+    first_record, last_record = get_data_range(meter_id)
+    if not last_record:
+        return
+    start = datetime(first_record.year, first_record.month, first_record.day)
+    end = datetime(last_record.year, last_record.month, last_record.day)
+    try:
+        get_calendar_plot(meter_id, start, end)
+    except Exception:
+        logging.exception("Pre-rendering calendar plot for meter %s failed", meter_id)
@@ -12,6 +12,7 @@ var layout = {
         x: 0, y: 1.2
     },
     xaxis: {
+        type: 'date',
         showgrid: true,
     },
     yaxis: {
@@ -33,21 +34,11 @@ function onDataSetReceived(data) {
 
 function onDataReceived(series) {
     // Push the new data onto our existing data array
-
-    var x = [];
-    var y = [];
-    for (var i = 0; i < series.data.length; i++) {
-        row = series.data[i];
-        xVal = row[0]
-        yVal = row[1]
-        x.push(xVal);
-        y.push(yVal);
-    }
-
+    // Series come as columns, with x in epoch milliseconds
     var trace = {
         type: 'bar',
-        x: x,
-        y: y,
+        x: series.x,
+        y: series.y,
         name: series.label
     };
     if ("color" in series) {
@@ -1,10 +1,13 @@
 import os
+import csv
+import io
 import uuid
 import datetime
 
 import arrow
 from statistics import mean
 from flask import render_template, url_for, jsonify, redirect, flash, request, Response
+from flask import stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 from flask_wtf import FlaskForm
 from werkzeug.utils import secure_filename
@@ -16,6 +19,7 @@ from qldtariffs import electricity_charges_tou_demand
 from metering import load_nem_data
 from metering import get_data_range, get_month_ranges
 from metering import get_daily_energy_readings
+from metering import iter_export_chunks, get_export_columns
 from . import app, db
 from .models import User, Meter, delete_meter_data
 from .models import get_meter_name
@@ -88,12 +92,26 @@ def new_meter():
     return render_template("new_meter.html", form=form)
 
 
+def export_meter_data(user_id):
+    """ Stream the readings of every meter the user manages as one CSV """
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(["meter_id"] + get_export_columns("readings"))
+    for meter_id, _, _ in get_user_meters(user_id):
+        for chunk in iter_export_chunks(meter_id, "readings"):
+            writer.writerows((meter_id,) + row for row in chunk)
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue()
+
+
 @app.route("/export")
 @login_required
 def export_data():
     user_id, user_name = get_user_details()
     return Response(
-        export_meter_data(user_id),
+        stream_with_context(export_meter_data(user_id)),
         mimetype="text/csv",
         headers={"Content-disposition": "attachment; filename=data-export.csv"},
     )
@@ -1,9 +1,19 @@
 import os
 import logging
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import click
 from metering import refresh_daily_stats
 from metering import refresh_monthly_stats
 from metering import refresh_daily_segments
+from metering import refresh_interval_totals
+from metering import get_data_range, get_stale_range, backfill_rollups
+from metering import get_stored_meter_ids, bump_data_version
+from metering import get_db_location
+from metering import export_meter_table, EXPORT_TABLES, EXPORT_FORMATS
+from metering import get_db_engine, get_partition_names, PARTITION_LAYOUTS
+from metering import partition_readings as metering_partition_readings
+from metering import archive_partition, restore_partition, get_archived_partitions
 from config import UPLOAD_FOLDER, DATABASE
 
 
@@ -43,16 +53,169 @@ def first_run():
 
 @cli.command()
 @click.option("--meterid", default=1, help="The meter ID")
-def update_metering(meterid):
+@click.option("--full", is_flag=True, help="Recalculate all days, not just new data")
+def update_metering(meterid, full):
+    if not os.path.exists(get_db_location(meterid)):
+        click.echo(f"No data for meter {meterid}")
+        return
+    if full:
+        start, end = get_data_range(meterid)
+    else:
+        start, end = get_stale_range(meterid)
+    if not start or not end:
+        click.echo(f"No data for meter {meterid}")
+        return
+    if not full:
+        click.echo(f"Building any missing rollups for meter {meterid}")
+        backfill_rollups(meterid)
     click.echo(f"Refreshing daily stats for meter {meterid}")
-    refresh_daily_stats(meterid)
+    refresh_daily_stats(meterid, start, end)
     click.echo(f"Refreshing daily segments for meter {meterid}")
-    # refresh_daily_segments(meterid)
+    refresh_daily_segments(meterid, start, end)
     click.echo(f"Refreshing monthly stats for meter {meterid}")
-    refresh_monthly_stats(meterid)
+    refresh_monthly_stats(meterid, start, end)
+    click.echo(f"Refreshing interval totals for meter {meterid}")
+    refresh_interval_totals(meterid, start, end)
+    bump_data_version(meterid)
     click.echo("Done!")
 
 
+def refresh_meter(meter_id: int, full: bool):
+    """ Refresh all the rollups for a meter, in a worker process
+
+    :return: The meter, the seconds taken and an error message if it failed
+    """
+    started = time.perf_counter()
+    try:
+        if full:
+            start, end = get_data_range(meter_id)
+        else:
+            start, end = get_stale_range(meter_id)
+        if not start or not end:
+            return meter_id, time.perf_counter() - started, "No data"
+        if not full:
+            backfill_rollups(meter_id)
+        refresh_daily_stats(meter_id, start, end)
+        refresh_daily_segments(meter_id, start, end)
+        refresh_monthly_stats(meter_id, start, end)
+        refresh_interval_totals(meter_id, start, end)
+        bump_data_version(meter_id)
+    except Exception as e:
+        logging.exception("Refreshing meter %s failed", meter_id)
+        return meter_id, time.perf_counter() - started, str(e)
+    return meter_id, time.perf_counter() - started, None
+
+
+def get_all_meter_ids(from_dir: bool):
+    """ Return the meters with a database file, from the Meter table or data dir """
+    if from_dir:
+        return get_stored_meter_ids()
+    from energy import app
+    from energy.models import Meter
+
+    with app.app_context():
+        meter_ids = [meter.meter_id for meter in Meter.query.order_by(Meter.meter_id)]
+    # Meters with no readings loaded have no database to refresh
+    return [m for m in meter_ids if os.path.exists(get_db_location(m))]
+
+
+@cli.command()
+@click.option("--workers", default=os.cpu_count(), help="Meters refreshed at once")
+@click.option("--full", is_flag=True, help="Recalculate all days, not just new data")
+@click.option("--from-dir", is_flag=True, help="Find meters in the data directory")
+def update_all(workers, full, from_dir):
+    """ Refresh the rollups for every meter in parallel """
+    meter_ids = get_all_meter_ids(from_dir)
+    click.echo(f"Refreshing {len(meter_ids)} meters with {workers} workers")
+
+    started = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(refresh_meter, m, full) for m in meter_ids]
+        for future in as_completed(futures):
+            meter_id, elapsed, error = future.result()
+            results.append((meter_id, elapsed, error))
+            status = error if error else "Done"
+            click.echo(f"Meter {meter_id}: {elapsed:.1f}s {status}")
+    wall_time = time.perf_counter() - started
+
+    refreshed = [r for r in results if not r[2]]
+    failed = [r for r in results if r[2]]
+    busy_time = sum(r[1] for r in results)
+    click.echo(f"{len(refreshed)} meters refreshed, {len(failed)} not refreshed")
+    if refreshed:
+        slowest = max(refreshed, key=lambda r: r[1])
+        click.echo(f"Slowest was meter {slowest[0]} at {slowest[1]:.1f}s")
+    click.echo(f"Took {wall_time:.1f}s for {busy_time:.1f}s of refreshing")
+    for meter_id, _, error in sorted(failed):
+        click.echo(f"  Meter {meter_id}: {error}")
+
+
+@cli.command()
+def resume_imports():
+    """ Load the uploads that were queued or running when the site stopped """
+    from energy import app
+    from energy.jobs import resume_import_jobs
+
+    app.config["IMPORT_WORKERS"] = 0  # Load them before returning
+    resume_import_jobs()
+    click.echo("Done!")
+
+
+@cli.command()
+@click.option("--meterid", default=1, help="The meter ID")
+@click.option("--by", default="year", type=click.Choice(PARTITION_LAYOUTS))
+def partition_readings(meterid, by):
+    """ Move a meter's readings into a table per year or month """
+    names = metering_partition_readings(meterid, by)
+    click.echo(f"Meter {meterid} readings moved into {len(names)} partitions")
+
+
+@cli.command()
+@click.option("--meterid", default=1, help="The meter ID")
+@click.option("--before", type=int, required=True, help="Archive years before this")
+def archive_readings(meterid, before):
+    """ Move partitions of old readings out of the meter database """
+    with get_db_engine(meterid).connect() as conn:
+        names = get_partition_names(conn)
+    for name in names:
+        if int(name.split("_")[1]) < before:
+            path = archive_partition(meterid, name)
+            click.echo(f"Archived {name} to {path}")
+
+
+@cli.command()
+@click.option("--meterid", default=1, help="The meter ID")
+@click.argument("partitions", nargs=-1)
+def restore_readings(meterid, partitions):
+    """ Move archived partitions back into the meter database """
+    for name in partitions or get_archived_partitions(meterid):
+        restore_partition(meterid, name)
+        click.echo(f"Restored {name}")
+
+
+@cli.command()
+@click.option("--meterid", default=1, help="The meter ID")
+@click.option("--table", default="readings", type=click.Choice(list(EXPORT_TABLES)))
+@click.option("--format", "fmt", default="csv", type=click.Choice(EXPORT_FORMATS))
+@click.option("--start", type=click.DateTime(["%Y-%m-%d"]), help="First day")
+@click.option("--end", type=click.DateTime(["%Y-%m-%d"]), help="Day after the last")
+@click.option("--channel", multiple=True, help="Only export these channels")
+@click.argument("output", type=click.Path(dir_okay=False))
+def export(meterid, table, fmt, start, end, channel, output):
+    """ Export meter data to a CSV, Parquet or Arrow file """
+    filters = {"start": start, "end": end, "channels": list(channel)}
+    data = export_meter_table(meterid, table, fmt, **filters)
+    if fmt == "csv":
+        f = open(output, "w", newline="")
+    else:
+        f = open(output, "wb")
+    with f:
+        for chunk in data:
+            f.write(chunk)
+    click.echo(f"Exported meter {meterid} {table} to {output}")
+
+
 if __name__ == "__main__":
     LOG_FORMAT = "%(asctime)s %(name)-12s %(levelname)-8s %(message)s"
     logging.basicConfig(level="INFO", format=LOG_FORMAT)
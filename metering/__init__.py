@@ -4,27 +4,61 @@
     Define the meter data models
 """
 
-from metering.models import get_db_engine
+from metering.metrics import timed, start_request, finish_request
+from metering.metrics import record, get_histograms, clear_histograms
+from metering.metrics import RequestMetrics
+
+from metering.models import get_db_engine, get_db_session, get_db_location
+from metering.models import dispose_db_engine, get_engine_stats
+from metering.models import get_stored_meter_ids
 from metering.models import Readings, Dailies, Monthlies
-from metering.models import save_energy_reading
+from metering.models import get_readings_tables, get_partition_names
+from metering.models import rebuild_channel_info
+from metering.models import save_energy_reading, save_energy_readings
+from metering.models import save_each_energy_reading
 from metering.models import update_daily_total
+from metering.models import save_daily_totals, add_missing_daily_totals
 from metering.models import get_load_energy_readings
+from metering.models import get_reading_arrays, get_load_energy_arrays
+from metering.models import get_grouped_energy_readings
+from metering.models import IntervalTotals, get_interval_totals
+from metering.models import get_grouped_interval_totals
+from metering.models import has_interval_totals, save_interval_totals
 from metering.models import get_data_range
+from metering.models import MeterInfo, ChannelInfo
+from metering.models import get_meter_info, update_channel_info
+from metering.models import get_data_version, bump_data_version
 from metering.models import get_daily_energy_readings
 from metering.models import get_monthly_energy_readings
-from metering.models import update_monthly_total
+from metering.models import get_monthly_energy_readings_range
+from metering.models import update_monthly_total, save_monthly_totals
+from metering.models import MonthlyBills, get_monthly_bills, save_monthly_bill
 
 from metering.models import DailySegments
-from metering.models import update_daily_segments
+from metering.models import update_daily_segments, save_daily_segments
+from metering.models import DayStats, get_day_stats, has_day_stats, save_day_stats
 
 
 from metering.analyse import refresh_daily_stats
-from metering.analyse import refresh_daily_segments
+from metering.analyse import refresh_daily_segments, get_daily_segments
 from metering.analyse import get_month_ranges
 from metering.analyse import refresh_monthly_stats
+from metering.analyse import refresh_dirty_days, get_stale_range
+from metering.analyse import backfill_rollups
+from metering.analyse import refresh_interval_totals, get_interval_arrays
+from metering.analyse import get_grouped_interval_arrays
 
 from metering.analyse import LOAD_CHS, CONTROL_CHS, GENERATION_CHS
+from metering.analyse import STATS_BIN_WIDTH
+from metering.analyse import CHANNEL_GROUPS, INTERVAL_RESOLUTIONS
 
 from metering.loader import load_nem_data
 
-from metering.stats import get_day_of_week_avg
+from metering.stats import get_day_of_week_avg, get_usage_stats
+
+from metering.partitions import partition_readings, PARTITION_LAYOUTS
+from metering.partitions import archive_partition, restore_partition
+from metering.partitions import get_archived_partitions, get_archive_location
+
+from metering.export import export_meter_table, iter_export_chunks
+from metering.export import get_export_columns, EXPORT_TABLES, EXPORT_FORMATS
@@ -5,35 +5,60 @@
 """
 
 import logging
-from datetime import datetime, timedelta
-from typing import List, Tuple, Optional
+from collections import defaultdict
+from functools import lru_cache
+from datetime import datetime, date, timedelta
+from typing import Dict, Iterable, List, Set, Tuple, Optional
 from statistics import mean
 from dateutil.relativedelta import relativedelta
 from qldtariffs import get_daily_usages
 from qldtariffs import financial_year_ending
-from sqlalchemy.orm import sessionmaker
-from . import get_db_engine
+from sqlalchemy import func
+import numpy as np
+from . import get_db_session
 from . import Dailies
 from . import get_data_range
-from . import get_load_energy_readings
+from . import get_load_energy_arrays, get_reading_arrays
+from . import get_grouped_energy_readings
 from . import get_daily_energy_readings
-from . import update_daily_total
-from . import update_daily_segments
-from . import update_monthly_total
+from . import save_daily_totals, add_missing_daily_totals
+from . import DailySegments, save_daily_segments
+from . import save_monthly_totals
+from . import save_day_stats, has_day_stats
+from . import get_grouped_interval_totals, has_interval_totals
+from . import save_interval_totals
+from .intervals import segment_totals, from_epoch
+from .intervals import profile_intervals, resample_intervals
+from .metrics import timed
 
 LOAD_CHS = ["E1", "11"]
 CONTROL_CHS = ["E2", "41"]
 GENERATION_CHS = ["B1", "71"]
-
-
+MAX_REFRESH_DAYS = 31  # Days of readings read at once when refreshing rollups
+STATS_BIN_WIDTH = 0.1  # kWh per histogram bin of the day of week stats
+INTERVAL_RESOLUTIONS = [5, 30, 60]  # Minutes of the stored interval totals
+# The stored daily segments split each day evenly across the A to H columns
+_SEGMENT_COLUMNS = [c.name for c in DailySegments.__table__.columns if c.name != "day"]
+_SEGMENT_M = 24 * 60 // len(_SEGMENT_COLUMNS)
+assert _SEGMENT_M * len(_SEGMENT_COLUMNS) == 24 * 60
+CHANNEL_GROUPS = {
+    "load": LOAD_CHS,
+    "control": CONTROL_CHS,
+    "generation": GENERATION_CHS,
+}
+
+
+@timed()
 def refresh_daily_stats(
-    meter_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None
+    meter_id: int,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    estimate: bool = True,
 ):
-    """ Update the daily totals after loading new readings """
+    """ Update the daily totals after loading new readings
 
-    engine = get_db_engine(meter_id)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    :param estimate: Add estimates for the rest of the month after end
+    """
 
     # Get start and end of available data
     if not start or not end:
@@ -43,21 +68,23 @@ def refresh_daily_stats(
     msg += f' from {start.strftime("%Y%m%d")} to {end.strftime("%Y%m%d")}'
     logging.info(msg)
 
+    # Read and profile all channel groups in a single pass
+    records = get_grouped_energy_readings(meter_id, start, end, CHANNEL_GROUPS)
+
     # Get General Consumption Stats
-    records = list(get_load_energy_readings(meter_id, start, end, channels=LOAD_CHS))
-    daily_regional = list(get_daily_usages(records, tou_timings="qld-regional"))
-    daily_south_east = list(get_daily_usages(records, tou_timings="qld-south-east"))
+    # The peak and shoulder times of each tariff timing are defined by
+    # qldtariffs, so the profiled load is summarised once for each timing
+    load = records["load"]
+    daily_regional = list(get_daily_usages(load, tou_timings="qld-regional"))
+    daily_south_east = list(get_daily_usages(load, tou_timings="qld-south-east"))
 
     # Get Controlled Load Stats
-    records = list(get_load_energy_readings(meter_id, start, end, channels=CONTROL_CHS))
-    daily_control = list(get_daily_usages(records))
+    daily_control = list(get_daily_usages(records["control"]))
 
     # Get Generation Stats
-    records = list(
-        get_load_energy_readings(meter_id, start, end, channels=GENERATION_CHS)
-    )
-    daily_generation = list(get_daily_usages(records))
+    daily_generation = list(get_daily_usages(records["generation"]))
 
+    rows = []
     for i, day_ergon in enumerate(daily_regional):
 
         day = day_ergon.day
@@ -76,21 +103,30 @@ def refresh_daily_stats(
         except IndexError:
             generation_total = 0
 
-        update_daily_total(
-            session,
-            day,
-            load_total,
-            controlled_total,
-            generation_total,
-            load_peak,
-            load_shoulder,
-            load_peak2,
-            load_shoulder2,
+        rows.append(
+            daily_total_row(
+                day,
+                load_total,
+                controlled_total,
+                generation_total,
+                load_peak,
+                load_shoulder,
+                load_peak2,
+                load_shoulder2,
+            )
         )
-    session.commit()
+    session = get_db_session(meter_id)
+    try:
+        save_daily_totals(session, rows)
+        session.commit()
+    finally:
+        session.close()
+
+    if not daily_regional or not estimate:
+        return
 
     # Estimate values to complete the financial year
-    est_end = datetime(end.year, end.month + 1, 1)
+    est_end = datetime(end.year, end.month, 1) + relativedelta(months=1)
     add_daily_estimates(
         meter_id,
         end,
@@ -119,21 +155,16 @@ def add_daily_estimates(
 ):
     """ Update the daily totals after loading new readings """
 
-    engine = get_db_engine(meter_id)
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
     msg = f"Adding daily estimates for meter {meter_id}"
     msg += f' from {start.strftime("%Y%m%d")} to {end.strftime("%Y%m%d")}'
     logging.info(msg)
 
+    # Only add estimates for days that are not already populated
+    rows = []
     est_day = start
     while est_day < end:
-        # Update with estimate if not already populated
-        r = session.query(Dailies).filter(Dailies.day == est_day).first()
-        if r is None:
-            update_daily_total(
-                session,
+        rows.append(
+            daily_total_row(
                 est_day,
                 load_total,
                 controlled_total,
@@ -144,18 +175,46 @@ def add_daily_estimates(
                 load_shoulder2,
                 estimated=True,
             )
+        )
         est_day += timedelta(days=1)
-    session.commit()
+    session = get_db_session(meter_id)
+    try:
+        add_missing_daily_totals(session, rows)
+        session.commit()
+    finally:
+        session.close()
 
 
+def daily_total_row(
+    day,
+    load_total,
+    control_total,
+    export_total,
+    load_peak1,
+    load_shoulder1,
+    load_peak2,
+    load_shoulder2,
+    estimated: bool = False,
+) -> dict:
+    """ Return a row for the bulk daily totals writers """
+    return {
+        "day": day,
+        "load_total": load_total,
+        "control_total": control_total,
+        "export_total": export_total,
+        "load_peak1": load_peak1,
+        "load_shoulder1": load_shoulder1,
+        "load_peak2": load_peak2,
+        "load_shoulder2": load_shoulder2,
+        "estimated": estimated,
+    }
+
+
+@timed()
 def refresh_daily_segments(
     meter_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None
 ):
-    """ Update the daily totals after loading new readings """
-
-    engine = get_db_engine(meter_id)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    """ Update the time of day segment totals after loading new readings """
 
     # Get start and end of available data
     if not start or not end:
@@ -165,38 +224,126 @@ def refresh_daily_segments(
     msg += f' from {start.strftime("%Y%m%d")} to {end.strftime("%Y%m%d")}'
     logging.info(msg)
 
-    # Get General Consumption Stats
-    load_records = list(
-        get_load_energy_readings(meter_id, start, end, channels=LOAD_CHS)
-    )
+    interval_ends, totals = get_load_energy_arrays(meter_id, start, end, LOAD_CHS)
+    days, segments = segment_totals(interval_ends, totals, 5, _SEGMENT_M)
+    rows = [
+        dict(zip(_SEGMENT_COLUMNS, day_segments), day=day)
+        for day, day_segments in zip(from_epoch(days), segments.tolist())
+    ]
+    session = get_db_session(meter_id)
+    try:
+        save_daily_segments(session, rows)
+        session.commit()
+    finally:
+        session.close()
 
-    day_summary = {}
-    for read in load_records:
-        read_start = read[0]
-        day = read_start.date()
-
-        if day not in day_summary.keys():
-            day_seg = {
-                "a": 0.0,
-                "b": 0.0,
-                "c": 0.0,
-                "d": 0.0,
-                "e": 0.0,
-                "f": 0.0,
-                "g": 0.0,
-                "h": 0.0,
-            }
-            day_summary[day] = day_seg
-        else:
-            day_seg = day_summary[day]
-        tod = get_time_of_day_segment(read_start).lower()
-        val = read[2]
-        day_summary[day][tod] += val
 
-    for day in day_summary.keys():
-        day_seg = day_summary[day]
-        update_daily_segments(session, day, **day_seg)
-    session.commit()
+@timed()
+def get_daily_segments(
+    meter_id: int,
+    start: datetime,
+    end: datetime,
+    segment_m: int = _SEGMENT_M,
+    channels: List[str] = LOAD_CHS,
+) -> Tuple[List[datetime], np.ndarray]:
+    """ Get usage totals for segments of any length in each day
+
+    :param segment_m: The segment length in minutes, which must divide a day
+    :return: Each day, and a row of its segment totals
+    """
+    interval_ends, totals = get_load_energy_arrays(meter_id, start, end, channels)
+    days, segments = segment_totals(interval_ends, totals, 5, segment_m)
+    return from_epoch(days), segments
+
+
+@timed()
+def refresh_interval_totals(
+    meter_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None
+):
+    """ Update the stored interval totals of each channel group
+
+    The range is widened to whole days, so no interval is only partly summed.
+    """
+
+    # Get start and end of available data
+    if not start or not end:
+        start, end = get_data_range(meter_id)
+    if not start or not end:
+        return
+    start = datetime(start.year, start.month, start.day)
+    if end != datetime(end.year, end.month, end.day):
+        end = datetime(end.year, end.month, end.day) + timedelta(days=1)
+
+    msg = f"Calculating interval totals for meter {meter_id}"
+    msg += f' from {start.strftime("%Y%m%d")} to {end.strftime("%Y%m%d")}'
+    logging.info(msg)
+
+    all_channels = [ch for channels in CHANNEL_GROUPS.values() for ch in channels]
+    piece_start = start
+    while piece_start < end:
+        piece_end = min(piece_start + timedelta(days=MAX_REFRESH_DAYS), end)
+        ch_names, starts, ends, values = get_reading_arrays(
+            meter_id, piece_start, piece_end, all_channels
+        )
+        session = get_db_session(meter_id)
+        try:
+            for group, channels in CHANNEL_GROUPS.items():
+                in_group = np.isin(ch_names, channels)
+                if not in_group.any():
+                    continue
+                interval_ends, totals = profile_intervals(
+                    starts[in_group], ends[in_group], values[in_group], interval_m=5
+                )
+                for interval_m in INTERVAL_RESOLUTIONS:
+                    if interval_m == 5:
+                        group_ends, group_totals = interval_ends, totals
+                    else:
+                        group_ends, group_totals = resample_intervals(
+                            interval_ends, totals, interval_m
+                        )
+                    save_interval_totals(
+                        session, group, interval_m, group_ends, group_totals
+                    )
+            session.commit()
+        finally:
+            session.close()
+        piece_start = piece_end
+
+
+def get_interval_arrays(
+    meter_id: int, ch_group: str, start: datetime, end: datetime, interval_m: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """ Get the usage of a channel group in intervals of any length
+
+    :return: Interval ends in epoch seconds and the usage in each interval
+    """
+    return get_grouped_interval_arrays(meter_id, [ch_group], start, end, interval_m)[
+        ch_group
+    ]
+
+
+@timed()
+def get_grouped_interval_arrays(
+    meter_id: int,
+    ch_groups: List[str],
+    start: datetime,
+    end: datetime,
+    interval_m: int,
+) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """ Get the usage of several channel groups in intervals of any length
+
+    Read from the stored interval totals at the longest length that divides
+    interval_m. Meters loaded before they existed have none until
+    backfill_rollups builds them.
+    :return: Interval ends in epoch seconds and the usage in each interval,
+             keyed by group name
+    """
+    stored_m = max(m for m in INTERVAL_RESOLUTIONS if interval_m % m == 0)
+    grouped = get_grouped_interval_totals(meter_id, ch_groups, start, end, stored_m)
+    if interval_m > stored_m:
+        for ch_group, (interval_ends, totals) in grouped.items():
+            grouped[ch_group] = resample_intervals(interval_ends, totals, interval_m)
+    return grouped
 
 
 def get_time_of_day_segment(dt: datetime) -> str:
@@ -218,20 +365,42 @@ def get_time_of_day_segment(dt: datetime) -> str:
     return "H"
 
 
-def refresh_monthly_stats(meter_id):
-    """ Update the daily totals after loading new readings """
+@timed()
+def refresh_monthly_stats(
+    meter_id: int, start: Optional[datetime] = None, end: Optional[datetime] = None
+):
+    """ Update the monthly totals after loading new readings """
 
     logging.info("Calculating monthly stats for meter %s", meter_id)
-    engine = get_db_engine(meter_id)
-    Session = sessionmaker(bind=engine)
-    session = Session()
 
-    start, end = get_data_range(meter_id)
-    for year, month, _ in get_month_ranges(start, end):
+    # Get start and end of available data
+    if not start or not end:
+        start, end = get_data_range(meter_id)
+    months = get_month_ranges(start, end)
+    if not months:
+        return
+
+    # Read the daily totals for every month at once
+    first_year, first_month, _ = months[0]
+    last_year, last_month, _ = months[-1]
+    range_start = datetime(first_year, first_month, 1)
+    range_end = datetime(last_year, last_month, 1) + relativedelta(months=1)
+    month_dailies = defaultdict(list)
+    for day in get_daily_energy_readings(meter_id, range_start, range_end):
+        month_dailies[(day.day.year, day.day.month)].append(day)
+
+    rows = []
+    stats_rows = []
+    for year, month, _ in months:
         month_start = datetime(year, month, 1)
         month_end = month_start + relativedelta(months=1) - timedelta(days=1)
         num_days = month_end.day
-        daily_totals = list(get_daily_energy_readings(meter_id, month_start, month_end))
+        daily_totals = [
+            day for day in month_dailies[(year, month)] if day.day <= month_end
+        ]
+        if not daily_totals:
+            continue
+        stats_rows += day_stats_rows(year, month, daily_totals)
 
         days = 0
         load_total = 0
@@ -267,22 +436,131 @@ def refresh_monthly_stats(meter_id):
             # Readings are probably not interval readings
             demand = demand * 2
 
-        update_monthly_total(
-            session,
-            year,
-            month,
-            num_days,
-            load_total,
-            control_total,
-            export_total,
-            demand,
-            load_peak1,
-            load_shoulder1,
-            load_peak2,
-            load_shoulder2,
+        rows.append(
+            {
+                "year": year,
+                "month": month,
+                "num_days": num_days,
+                "load_total": load_total,
+                "control_total": control_total,
+                "export_total": export_total,
+                "demand": demand,
+                "load_peak1": load_peak1,
+                "load_shoulder1": load_shoulder1,
+                "load_peak2": load_peak2,
+                "load_shoulder2": load_shoulder2,
+            }
         )
 
+    session = get_db_session(meter_id)
+    try:
+        save_monthly_totals(session, rows)
+        save_day_stats(session, stats_rows)
         session.commit()
+    finally:
+        session.close()
+
+
+def day_stats_rows(year: int, month: int, daily_totals: List[Dailies]) -> List[dict]:
+    """ Summarise the actual daily load totals of a month by day of week
+
+    Every day of the week gets a row, so days no longer in the month are cleared.
+    """
+    rows = []
+    for weekday in range(7):
+        totals = [
+            day.load_total
+            for day in daily_totals
+            if day.day.weekday() == weekday and day.load_total and not day.estimated
+        ]
+        hist: Dict[int, int] = defaultdict(int)
+        for total in totals:
+            hist[int(total // STATS_BIN_WIDTH)] += 1
+        rows.append(
+            {
+                "year": year,
+                "month": month,
+                "weekday": weekday,
+                "num_days": len(totals),
+                "load_sum": sum(totals),
+                "load_sum_sq": sum(total * total for total in totals),
+                "load_hist": dict(hist),
+            }
+        )
+    return rows
+
+
+@timed()
+def refresh_dirty_days(meter_id: int, dirty_days: Dict[str, Set[date]]):
+    """ Update only the rollups affected by new readings
+
+    :param dirty_days: The days that were loaded, keyed by channel
+    """
+    days = set()
+    for ch_days in dirty_days.values():
+        days.update(ch_days)
+    if not days:
+        return
+    backfill_rollups(meter_id)
+
+    load_touched = any(ch in LOAD_CHS for ch in dirty_days.keys())
+    months = set((day.year, day.month) for day in days)
+    for start, end in get_day_spans(days):
+        # Refresh long spans in pieces so only a month of readings is in memory
+        piece_start = start
+        while piece_start < end:
+            piece_end = min(piece_start + timedelta(days=MAX_REFRESH_DAYS), end)
+            refresh_daily_stats(meter_id, piece_start, piece_end, piece_end == end)
+            if load_touched:
+                refresh_daily_segments(meter_id, piece_start, piece_end)
+            refresh_interval_totals(meter_id, piece_start, piece_end)
+            piece_start = piece_end
+        # Estimates may have been added from the end of the span
+        months.add((end.year, end.month))
+
+    for year, month in sorted(months):
+        month_start = datetime(year, month, 1)
+        refresh_monthly_stats(meter_id, month_start, month_start)
+
+
+def backfill_rollups(meter_id: int):
+    """ Build the rollups added since the meter's readings were loaded """
+    start, end = get_data_range(meter_id)
+    if not start or not end:
+        return
+    if not has_interval_totals(meter_id):
+        refresh_interval_totals(meter_id, start, end)
+    if not has_day_stats(meter_id):
+        refresh_monthly_stats(meter_id, start, end)
+
+
+def get_day_spans(days: Iterable[date]) -> List[Tuple[datetime, datetime]]:
+    """ Group days into contiguous (start, end) ranges, where end is exclusive """
+    spans: list = []
+    for day in sorted(days):
+        day_start = datetime(day.year, day.month, day.day)
+        if spans and spans[-1][1] == day_start:
+            spans[-1] = (spans[-1][0], day_start + timedelta(days=1))
+        else:
+            spans.append((day_start, day_start + timedelta(days=1)))
+    return spans
+
+
+def get_stale_range(meter_id: int) -> Tuple[datetime, datetime]:
+    """ Get the range of readings newer than the last actual daily total """
+    session = get_db_session(meter_id)
+    try:
+        last_actual = (
+            session.query(func.max(Dailies.day))
+            .filter(Dailies.estimated.isnot(True))
+            .scalar()
+        )
+    finally:
+        session.close()
+    start, end = get_data_range(meter_id)
+    if last_actual and start and last_actual > start:
+        start = last_actual
+    return start, end
 
 
 def average_daily_peak_demand(peak_usage_kWh):
@@ -292,14 +570,24 @@ def average_daily_peak_demand(peak_usage_kWh):
     return peak_usage_kWh * peak_ratio
 
 
-def get_month_ranges(start: datetime, end: datetime) -> List[Tuple[int, int]]:
+def get_month_ranges(start: datetime, end: datetime) -> List[Tuple[int, int, int]]:
     """ Get billing months in time range """
-    periods: list = []
-    day = start
-    while day <= end:
-        fy = financial_year_ending(day)
-        period = (day.year, day.month, fy)
-        if period not in periods:
-            periods.append(period)
-        day += timedelta(days=1)
-    return sorted(periods)
+    if end < start:
+        return []
+    # The last whole day step from the start that is still in range
+    last = start + timedelta(days=(end - start).days)
+    return list(_month_ranges(start.year, start.month, last.year, last.month))
+
+
+@lru_cache(maxsize=256)
+def _month_ranges(
+    start_year: int, start_month: int, end_year: int, end_month: int
+) -> Tuple[Tuple[int, int, int], ...]:
+    """ Get the (year, month, financial year) of each month between two months """
+    periods = []
+    year, month = start_year, start_month
+    while (year, month) <= (end_year, end_month):
+        fy = financial_year_ending(datetime(year, month, 1))
+        periods.append((year, month, fy))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return tuple(periods)
@@ -0,0 +1,192 @@
+"""
+    metering.export
+    ~~~~~~~~~
+    Stream meter data out as CSV, Parquet or Arrow IPC
+"""
+
+import csv
+import io
+from datetime import datetime
+from typing import Iterator, List, Optional
+from sqlalchemy import select
+from sqlalchemy import DateTime, Float, Integer, Boolean
+
+from . import get_db_engine, get_readings_tables
+from . import Readings, Dailies, Monthlies
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only needed for the columnar formats
+    pa = None
+
+EXPORT_TABLES = {"readings": Readings, "daily": Dailies, "monthly": Monthlies}
+EXPORT_FORMATS = ["csv", "parquet", "arrow"]
+EXPORT_CHUNK_ROWS = 10000  # Rows fetched from the database at a time
+
+
+def get_export_columns(table: str) -> List[str]:
+    """ Get the names of the exported columns of a table """
+    return [col.name for col in EXPORT_TABLES[table].__table__.columns]
+
+
+def iter_export_chunks(
+    meter_id,
+    table: str = "readings",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    channels: Optional[List[str]] = None,
+    chunk_rows: int = EXPORT_CHUNK_ROWS,
+) -> Iterator[List[tuple]]:
+    """ Read the rows of a meter table in chunks, in primary key order
+
+    Partitioned readings are read one partition after another.
+    :param start: Include readings starting, or days and months from, this time
+    :param end: Exclude readings starting, or days and months from, this time
+    :param channels: Only include readings for these channels
+    """
+    model = EXPORT_TABLES[table]
+    with get_db_engine(meter_id).connect() as conn:
+        if model is Readings:
+            stmts = []
+            for readings in get_readings_tables(conn, start, end):
+                stmt = select(readings)
+                if channels:
+                    stmt = stmt.where(readings.c.ch_name.in_(channels))
+                if start:
+                    stmt = stmt.where(readings.c.read_start >= start)
+                if end:
+                    stmt = stmt.where(readings.c.read_start < end)
+                stmts.append(stmt.order_by(readings.c.ch_name, readings.c.read_start))
+        elif model is Dailies:
+            stmt = select(Dailies.__table__)
+            if start:
+                stmt = stmt.where(Dailies.day >= start)
+            if end:
+                stmt = stmt.where(Dailies.day < end)
+            stmts = [stmt.order_by(Dailies.day)]
+        else:
+            stmt = select(Monthlies.__table__)
+            month_key = Monthlies.year * 100 + Monthlies.month
+            if start:
+                stmt = stmt.where(month_key >= start.year * 100 + start.month)
+            if end:
+                stmt = stmt.where(month_key < end.year * 100 + end.month)
+            stmts = [stmt.order_by(Monthlies.year, Monthlies.month)]
+
+        # Rows are fetched from the cursor a chunk at a time, so memory stays flat
+        for stmt in stmts:
+            result = conn.execution_options(stream_results=True).execute(stmt)
+            for chunk in result.partitions(chunk_rows):
+                yield [tuple(row) for row in chunk]
+
+
+def export_csv(
+    meter_id, table: str = "readings", header: bool = True, **filters
+) -> Iterator[str]:
+    """ Export a meter table as CSV text, a chunk of rows at a time """
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    if header:
+        writer.writerow(get_export_columns(table))
+    for chunk in iter_export_chunks(meter_id, table, **filters):
+        writer.writerows(chunk)
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+    if output.tell():
+        yield output.getvalue()
+
+
+class _ChunkSink:
+    """ A write only file that collects what is written until it is drained """
+
+    closed = False
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def get_arrow_schema(table: str):
+    """ Get the Arrow schema for a meter table """
+    fields = []
+    for col in EXPORT_TABLES[table].__table__.columns:
+        if isinstance(col.type, DateTime):
+            arrow_type = pa.timestamp("s")
+        elif isinstance(col.type, Float):
+            arrow_type = pa.float64()
+        elif isinstance(col.type, Integer):
+            arrow_type = pa.int64()
+        elif isinstance(col.type, Boolean):
+            arrow_type = pa.bool_()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(col.name, arrow_type))
+    return pa.schema(fields)
+
+
+def export_columnar(
+    meter_id, table: str = "readings", fmt: str = "parquet", **filters
+) -> Iterator[bytes]:
+    """ Export a meter table as Parquet or an Arrow IPC stream
+
+    Each chunk of rows is written as its own row group or record batch,
+    and the bytes are yielded as soon as they are written.
+    """
+    schema = get_arrow_schema(table)
+    sink = _ChunkSink()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema)
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    for chunk in iter_export_chunks(meter_id, table, **filters):
+        columns = list(zip(*chunk))
+        batch = pa.record_batch(
+            [pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+            schema=schema,
+        )
+        if fmt == "parquet":
+            writer.write_batch(batch)
+        else:
+            writer.write(batch)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def export_meter_table(meter_id, table: str = "readings", fmt: str = "csv", **filters):
+    """ Export a meter table in any of the EXPORT_FORMATS
+
+    The table and format are checked before any rows are read.
+    :return: An iterator of the file contents, as text for CSV or else bytes
+    """
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Can't export unknown table {table}")
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Can't export to unknown format {fmt}")
+    if fmt != "csv" and pa is None:
+        raise ImportError("pyarrow is required to export Parquet or Arrow files")
+    if fmt == "csv":
+        return export_csv(meter_id, table, **filters)
+    return export_columnar(meter_id, table, fmt, **filters)
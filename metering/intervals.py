@@ -0,0 +1,184 @@
+"""
+    metering.intervals
+    ~~~~~~~~~
+    Vectorised splitting and grouping of readings into profiled intervals
+"""
+
+from datetime import datetime
+from typing import Iterable, List, Tuple
+import numpy as np
+from energy_shaper import PROFILE_DEFAULT, Reading
+from energy_shaper.splitter import transform_load_shape
+
+DAY_S = 24 * 60 * 60
+
+
+def to_epoch(dts: Iterable[datetime]) -> np.ndarray:
+    """ Convert naive datetimes to an array of epoch seconds """
+    return np.array(list(dts), dtype="datetime64[s]").astype(np.int64)
+
+
+def from_epoch(seconds: np.ndarray) -> List[datetime]:
+    """ Convert an array of epoch seconds to naive datetimes """
+    return np.asarray(seconds).astype("datetime64[s]").astype(object).tolist()
+
+
+def split_pieces(
+    starts: np.ndarray, ends: np.ndarray, counts: np.ndarray, step_s: int
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ Split each reading into counts pieces of step_s, the last may be shorter
+
+    Readings with a count of one are returned unchanged.
+    :return: The reading index, piece number, start and end of each piece
+    """
+    record = np.repeat(np.arange(len(starts)), counts)
+    first_piece = np.repeat(np.cumsum(counts) - counts, counts)
+    piece = np.arange(len(record)) - first_piece
+    piece_starts = starts[record] + piece * step_s
+    piece_ends = np.minimum(piece_starts + step_s, ends[record])
+    single = counts[record] == 1
+    piece_ends[single] = ends[record][single]
+    return record, piece, piece_starts, piece_ends
+
+
+def group_end_offsets(interval_m: int) -> np.ndarray:
+    """ Minutes to add to reach the end of the interval, by minute of hour """
+    offsets = []
+    for minute in range(60):
+        offset = 0
+        while (minute + offset) % 60 % interval_m != 0:
+            offset += 1
+        offsets.append(offset)
+    return np.array(offsets, dtype=np.int64)
+
+
+def profile_intervals(
+    starts: np.ndarray,
+    ends: np.ndarray,
+    values: np.ndarray,
+    interval_m: int = 30,
+    profile: List[float] = PROFILE_DEFAULT,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """ Group readings into profiled intervals
+
+    Gives the same results as energy_shaper.group_into_profiled_intervals
+    :param starts: Reading start times in epoch seconds
+    :param ends: Reading end times in epoch seconds
+    :param values: Reading values
+    :param interval_m: The interval length in minutes
+    :param profile: The profile to use to scale daily readings
+    :return: The end of each interval in epoch seconds and its total
+    """
+    if interval_m > 60.0:
+        raise ValueError("Interval must be 60m or less ")
+    interval_s = interval_m * 60
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if not len(starts):
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+    # Split readings longer than a day into days first
+    durations = ends - starts
+    counts = np.where(durations > DAY_S, -(-durations // DAY_S), 1)
+    record, _, starts, ends = split_pieces(starts, ends, counts, DAY_S)
+    values = values[record] / counts[record]
+
+    # Daily readings get the load profile, anything else over the
+    # interval length is split evenly
+    minutes = (ends - starts) // 60
+    whole_day = minutes == 24 * 60
+    day_intervals = 24 * 60 // interval_m
+    counts = np.where(minutes > interval_m, -(-(ends - starts) // interval_s), 1)
+    counts[whole_day] = day_intervals
+    record, piece, _, ends = split_pieces(starts, ends, counts, interval_s)
+    scaled_profile = np.array(transform_load_shape(profile, day_intervals))
+    values = np.where(
+        whole_day[record],
+        scaled_profile[np.minimum(piece, day_intervals - 1)] * values[record],
+        values[record] / counts[record],
+    )
+
+    # Sum into groups by the end of the interval they fall in
+    minute_of_hour = (ends // 60) % 60
+    group_ends = ends + group_end_offsets(interval_m)[minute_of_hour] * 60
+    interval_ends, group = np.unique(group_ends, return_inverse=True)
+    totals = np.bincount(group.ravel(), weights=values, minlength=len(interval_ends))
+    return interval_ends, totals
+
+
+def iter_profiled_readings(interval_ends: np.ndarray, totals: np.ndarray, interval_m):
+    """ Yield the grouped intervals as energy_shaper Readings """
+    interval_s = interval_m * 60
+    starts = from_epoch(interval_ends - interval_s)
+    ends = from_epoch(interval_ends)
+    for start, end, total in zip(starts, ends, totals.tolist()):
+        yield Reading(start, end, total)
+
+
+def resample_intervals(
+    interval_ends: np.ndarray, totals: np.ndarray, bucket_m: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """ Sum profiled intervals into larger buckets
+
+    :param bucket_m: The bucket length in minutes, a multiple of the interval
+    :return: The end of each bucket in epoch seconds and its total
+    """
+    bucket_s = bucket_m * 60
+    bucket_ends = -(-np.asarray(interval_ends, dtype=np.int64) // bucket_s) * bucket_s
+    ends, group = np.unique(bucket_ends, return_inverse=True)
+    return ends, np.bincount(group.ravel(), weights=totals, minlength=len(ends))
+
+
+def downsample_lttb(
+    x: np.ndarray, y: np.ndarray, threshold: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """ Reduce a series to threshold points with Largest-Triangle-Three-Buckets
+
+    Keeps the first and last points and the most visually significant point
+    from each bucket in between.
+    """
+    num_points = len(x)
+    if threshold >= num_points or threshold < 3:
+        return x, y
+    x_f = np.asarray(x, dtype=np.float64)
+    y_f = np.asarray(y, dtype=np.float64)
+    every = (num_points - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, num_points)
+        avg_x = x_f[end:next_end].mean()
+        avg_y = y_f[end:next_end].mean()
+        areas = np.abs(
+            (x_f[a] - avg_x) * (y_f[start:end] - y_f[a])
+            - (x_f[a] - x_f[start:end]) * (avg_y - y_f[a])
+        )
+        a = start + int(np.argmax(areas))
+        selected.append(a)
+    selected.append(num_points - 1)
+    return x[selected], y[selected]
+
+
+def segment_totals(
+    interval_ends: np.ndarray, totals: np.ndarray, interval_m: int, segment_m: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """ Sum profiled intervals into segments of each day, by interval start
+
+    :param segment_m: The segment length in minutes, which must divide a day
+    :return: The start of each day in epoch seconds, and its segment totals
+    """
+    if (24 * 60) % segment_m:
+        raise ValueError("Segment length must divide a day evenly")
+    num_segments = 24 * 60 // segment_m
+    starts = np.asarray(interval_ends, dtype=np.int64) - interval_m * 60
+    days, day_index = np.unique(starts // DAY_S, return_inverse=True)
+    segment = (starts % DAY_S) // (segment_m * 60)
+    sums = np.bincount(
+        day_index.ravel() * num_segments + segment,
+        weights=totals,
+        minlength=len(days) * num_segments,
+    )
+    return days * DAY_S, sums.reshape(len(days), num_segments)
@@ -5,50 +5,130 @@
 """
 
 import logging
+from collections import defaultdict
+from itertools import islice
+from typing import Callable, Iterable, Iterator, Optional, Tuple
 from nemreader import read_nem_file
-from sqlalchemy.orm import sessionmaker
 from energy_shaper import split_into_daily_intervals
-from . import get_db_engine
-from . import save_energy_reading
-from . import refresh_daily_stats
-from . import refresh_monthly_stats
+from . import get_db_session
+from . import save_energy_readings, save_each_energy_reading
+from . import update_channel_info, bump_data_version
+from . import refresh_dirty_days
+from .nem_stream import get_nem_version, get_nem12_nmis, iter_nem12_channels
+from .metrics import timed
 
+BATCH_SIZE = 5000  # Readings written per bulk insert
 
-def load_nem_data(meter_id: int, nmi: str, nem_file):
-    """ Load data from NEM file and save to database """
 
-    engine = get_db_engine(meter_id)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+@timed()
+def load_nem_data(
+    meter_id: int,
+    nmi: str,
+    nem_file,
+    batch_size: int = BATCH_SIZE,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> Tuple[int, int]:
+    """ Load data from NEM file and save to database
+
+    :param batch_size: Readings per bulk insert, or 0 to save row by row
+                       in batches of BATCH_SIZE
+    :param progress: Called with the readings inserted and skipped so far
+                     after each batch is committed
+    :return: The number of readings inserted and skipped
+    """
+
+    session = get_db_session(meter_id)
 
     logging.info("Processing NEM file for Meter %s", meter_id)
-    m = read_nem_file(nem_file)
+    inserted = 0
+    skipped = 0
+    dirty_days = defaultdict(set)  # Days with new readings for each channel
     try:
-        channels = m.readings[nmi]
-    except KeyError:
-        first_nmi = list(m.readings.keys())[0]
-        logging.warning("NMI of %s not found, using %s instead", nmi, first_nmi)
-        channels = m.readings[first_nmi]
-
-    for ch_name in channels.keys():
-        logging.info("Loading data for Meter %s Channel %s", meter_id, ch_name)
-        reads = split_into_daily_intervals(channels[ch_name])
-        for i, read in enumerate(reads):
-            read_start = read[0]
-            read_end = read[1]
-            read_val = read[2]
-            try:
-                quality_method = read[4]
-            except IndexError:
-                quality_method = None
-            save_energy_reading(
-                session, ch_name, read_start, read_end, read_val, quality_method
-            )
-
-            if i == 0:
-                first_read = read_start
-            last_read = read_end
-
-    session.commit()
-    refresh_daily_stats(meter_id, first_read, last_read)
-    refresh_monthly_stats(meter_id)
+        for ch_name, ch_reads in read_nem_channels(nmi, nem_file):
+            logging.info("Loading data for Meter %s Channel %s", meter_id, ch_name)
+            rows = reading_rows(ch_name, split_into_daily_intervals(ch_reads))
+            # Each batch is committed with its channel summary, so the
+            # batches already saved are kept if a later one fails
+            for chunk in chunked(rows, batch_size or BATCH_SIZE):
+                if batch_size:
+                    ins, skip = save_energy_readings(session, chunk)
+                else:
+                    ins, skip = save_each_energy_reading(session, chunk)
+                if ins:
+                    # Skipped readings already lie within the channel's range
+                    first = min(row["read_start"] for row in chunk)
+                    last = max(row["read_end"] for row in chunk)
+                    update_channel_info(session, {ch_name: (ins, first, last)})
+                session.commit()
+                inserted += ins
+                skipped += skip
+                if ins:
+                    days = set(row["read_start"].date() for row in chunk)
+                    dirty_days[ch_name].update(days)
+                if progress:
+                    progress(inserted, skipped)
+    finally:
+        session.close()
+        logging.info(
+            "Meter %s: %s readings inserted, %s skipped", meter_id, inserted, skipped
+        )
+        # Refresh the rollups of the saved batches, even if a later one failed
+        refresh_dirty_days(meter_id, dirty_days)
+        if inserted:
+            bump_data_version(meter_id)
+    return inserted, skipped
+
+
+def read_nem_channels(nmi: str, nem_file) -> Iterator[Tuple[str, Iterable]]:
+    """ Yield each channel for the NMI with an iterable of its readings
+
+    NEM12 files are streamed so only one batch of readings is held
+    in memory at a time. NEM13 files hold a few manual reads per channel
+    so are read in full.
+    """
+    if get_nem_version(nem_file) == "NEM13":
+        m = read_nem_file(nem_file)
+        if not m.readings:
+            raise ValueError("No meter readings found in NEM file")
+        if nmi not in m.readings:
+            first_nmi = list(m.readings.keys())[0]
+            logging.warning("NMI of %s not found, using %s instead", nmi, first_nmi)
+            nmi = first_nmi
+        yield from m.readings[nmi].items()
+        return
+
+    nmis = get_nem12_nmis(nem_file)
+    if not nmis:
+        raise ValueError("No meter readings found in NEM file")
+    if nmi not in nmis:
+        logging.warning("NMI of %s not found, using %s instead", nmi, nmis[0])
+        nmi = nmis[0]
+    for block_nmi, ch_name, reads in iter_nem12_channels(nem_file):
+        if block_nmi == nmi:
+            yield ch_name, reads
+
+
+def reading_rows(ch_name: str, reads: Iterable):
+    """ Convert split readings into rows for bulk insert """
+    for read in reads:
+        try:
+            quality_method = read[4]
+        except IndexError:
+            quality_method = None
+        yield {
+            "ch_name": ch_name,
+            "read_start": read[0],
+            "read_end": read[1],
+            "read_value": read[2],
+            "quality_method": quality_method,
+        }
+
+
+def chunked(iterable: Iterable, size: int):
+    """ Yield lists of up to size items from iterable """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,156 @@
+"""
+    metering.metrics
+    ~~~~~~~~~
+    Count and time SQL statements and metering calls, per request and overall
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from functools import wraps
+from threading import Lock
+from typing import Dict, Optional
+from weakref import WeakKeyDictionary
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of the histogram buckets in milliseconds
+HISTOGRAM_BUCKETS_MS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+# Process wide histograms of name -> (bucket counts, total count, total ms)
+_histograms: Dict[str, list] = {}
+_histograms_lock = Lock()
+
+# Totals for the request being handled on each thread, if any
+_local = threading.local()
+
+# Name SQL timings are recorded under for each engine, or app_sql if unknown
+_engine_labels: WeakKeyDictionary = WeakKeyDictionary()
+
+
+class RequestMetrics:
+    """ The number of calls and time spent in each timed name for a request """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.counts: Dict[str, int] = defaultdict(int)
+        self.durations: Dict[str, float] = defaultdict(float)
+
+    def add(self, name: str, seconds: float):
+        self.counts[name] += 1
+        self.durations[name] += seconds
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def to_dict(self) -> dict:
+        return {
+            name: {"count": count, "ms": round(self.durations[name] * 1000, 3)}
+            for name, count in sorted(self.counts.items())
+        }
+
+
+def start_request() -> RequestMetrics:
+    """ Start collecting the totals for a request on this thread """
+    _local.request = RequestMetrics()
+    return _local.request
+
+
+def finish_request() -> Optional[RequestMetrics]:
+    """ Stop collecting for the request on this thread and return its totals """
+    metrics = getattr(_local, "request", None)
+    _local.request = None
+    return metrics
+
+
+def record(name: str, seconds: float):
+    """ Add a call to the current request, and its time to the histogram """
+    metrics = getattr(_local, "request", None)
+    if metrics is not None:
+        metrics.add(name, seconds)
+    bucket = bisect_left(HISTOGRAM_BUCKETS_MS, seconds * 1000)
+    with _histograms_lock:
+        hist = _histograms.get(name)
+        if hist is None:
+            hist = _histograms[name] = [[0] * (len(HISTOGRAM_BUCKETS_MS) + 1), 0, 0.0]
+        hist[0][bucket] += 1
+        hist[1] += 1
+        hist[2] += seconds * 1000
+
+
+def get_histograms() -> Dict[str, dict]:
+    """ Return the histogram of each timed name, with cumulative buckets """
+    with _histograms_lock:
+        histograms = [
+            (name, list(bucket_counts), count, total_ms)
+            for name, (bucket_counts, count, total_ms) in _histograms.items()
+        ]
+    result = {}
+    for name, bucket_counts, count, total_ms in sorted(histograms):
+        buckets = {}
+        cumulative = 0
+        for bound, bucket_count in zip(HISTOGRAM_BUCKETS_MS + ["+Inf"], bucket_counts):
+            cumulative += bucket_count
+            buckets[str(bound)] = cumulative
+        result[name] = {
+            "count": count,
+            "sum_ms": round(total_ms, 3),
+            "buckets": buckets,
+        }
+    return result
+
+
+def clear_histograms():
+    """ Forget all recorded timings """
+    with _histograms_lock:
+        _histograms.clear()
+
+
+def timed(name: Optional[str] = None):
+    """ Decorate a function to record the time spent in each call
+
+    :param name: The name to record under, by default the function's
+    """
+
+    def decorator(func):
+        label = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                record(label, time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+def label_engine(engine: Engine, label: str):
+    """ Record the SQL statements run by an engine under label """
+    _engine_labels[engine] = label
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Rows are fetched afterwards, so this is the time to the first row
+    started = conn.info["query_started"].pop()
+    record(_engine_labels.get(conn.engine, "app_sql"), time.perf_counter() - started)
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # Failed statements never reach after_cursor_execute
+    if context.connection is not None:
+        started = context.connection.info.get("query_started")
+        if started:
+            started.pop()
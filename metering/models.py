@@ -5,32 +5,175 @@
 """
 
 import os
-from datetime import datetime, timedelta
-from typing import Tuple, List
-from sqlalchemy import create_engine
-from sqlalchemy import func
-from sqlalchemy import Column, String, DateTime, Float, Integer, Boolean
+import time
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta, timezone
+from threading import RLock
+from typing import Dict, Tuple, List, Optional
+from sqlalchemy import create_engine, inspect, select, text
+from sqlalchemy import MetaData, Table
+from sqlalchemy import case, cast, func, or_
+from sqlalchemy import Column, String, DateTime, Float, Integer, Boolean, Index
+from sqlalchemy import PickleType
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
-from energy_shaper import group_into_profiled_intervals
+from sqlalchemy.pool import QueuePool
+import numpy as np
 import calendar
+from .intervals import profile_intervals, iter_profiled_readings, to_epoch
+from .metrics import timed, record, label_engine
 
 # Initialize the database
 Base = declarative_base()
 
+DB_DIR = "data"
+MAX_CACHED_ENGINES = 32  # Meter databases kept open at once
+POOL_SIZE = 5
+POOL_MAX_OVERFLOW = 10
+PARTITION_BY = None  # Reading tables of new meters: None, "year" or "month"
+
+# Process wide registry of meter_id -> (engine, sessionmaker), oldest first
+_engines: OrderedDict = OrderedDict()
+_engines_lock = RLock()
+_engine_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+# Data range of each meter, with the data version it was read at
+_meter_summaries: Dict[str, tuple] = {}
+_meter_summaries_lock = RLock()
+
+# Reading tables of partitioned meters, named readings_YYYY or readings_YYYY_MM
+_partition_metadata = MetaData()
+_partition_lock = RLock()
+
+
+def get_db_location(meter_id) -> str:
+    """ Return the path of the meter database file """
+    return os.path.join(DB_DIR, f"meter_{meter_id}.db")
+
+
+def get_stored_meter_ids() -> List[int]:
+    """ Return the IDs of the meters that have a database file """
+    if not os.path.isdir(DB_DIR):
+        return []
+    meter_ids = []
+    for filename in os.listdir(DB_DIR):
+        name, ext = os.path.splitext(filename)
+        if ext == ".db" and name.startswith("meter_") and name[6:].isdigit():
+            meter_ids.append(int(name[6:]))
+    return sorted(meter_ids)
+
+
+def _get_db_registry_entry(meter_id):
+    """ Return the cached engine and sessionmaker, creating them if required """
+    key = str(meter_id)
+    with _engines_lock:
+        entry = _engines.get(key)
+        if entry is not None:
+            _engines.move_to_end(key)
+            _engine_stats["hits"] += 1
+            return entry
+
+        _engine_stats["misses"] += 1
+        started = time.perf_counter()
+        if not os.path.exists(DB_DIR):
+            os.makedirs(DB_DIR)
+        engine = create_engine(
+            f"sqlite:///{get_db_location(meter_id)}",
+            connect_args={"check_same_thread": False},
+            poolclass=QueuePool,
+            pool_size=POOL_SIZE,
+            max_overflow=POOL_MAX_OVERFLOW,
+        )
+        label_engine(engine, "meter_sql")
+        Base.metadata.create_all(engine)
+        add_missing_columns(engine)
+        add_missing_indexes(engine)
+        add_missing_meter_info(engine)
+        record("meter_engine", time.perf_counter() - started)
+        entry = (engine, sessionmaker(bind=engine))
+        _engines[key] = entry
+
+        # Evict the least recently used meters
+        while len(_engines) > MAX_CACHED_ENGINES:
+            _, (old_engine, _) = _engines.popitem(last=False)
+            old_engine.dispose()
+            _engine_stats["evictions"] += 1
+        return entry
+
+
+def add_missing_columns(engine):
+    """ Add columns introduced since a meter database was first created """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = set(col["name"] for col in inspector.get_columns(table.name))
+            for col in table.columns:
+                if col.name in existing:
+                    continue
+                col_def = f"{col.name} {col.type.compile(dialect=engine.dialect)}"
+                if col.default is not None and col.default.is_scalar:
+                    col_def += f" DEFAULT {col.default.arg!r}"
+                conn.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN {col_def}")
+
+
+def add_missing_indexes(engine):
+    """ Add indexes introduced since a meter database was first created """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = set(ix["name"] for ix in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
+            if table.name == "readings" and has_rowid(conn, table.name):
+                if ROWID_COVERING_INDEX not in existing:
+                    columns = ", ".join(ROWID_COVERING_COLUMNS)
+                    conn.exec_driver_sql(
+                        f"CREATE INDEX {ROWID_COVERING_INDEX} ON readings ({columns})"
+                    )
+
+
+def has_rowid(conn, table_name: str) -> bool:
+    """ Return if a table was created with a rowid, as older databases were """
+    sql = conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (table_name,),
+    ).scalar()
+    return "WITHOUT ROWID" not in sql.upper()
+
 
 def get_db_engine(meter_id):
-    """ Create database and return engine """
-    db_name = f"meter_{meter_id}.db"
-    db_dir = "data"
-    if not os.path.exists(db_dir):
-        os.makedirs(db_dir)
-    db_loc = os.path.join(db_dir, db_name)
-    engine = create_engine(f"sqlite:///{db_loc}?check_same_thread=False")
-    Base.metadata.create_all(engine)
+    """ Return the engine for the meter database, creating it if required """
+    engine, _ = _get_db_registry_entry(meter_id)
     return engine
 
 
+def get_db_session(meter_id):
+    """ Return a new session for the meter database """
+    _, Session = _get_db_registry_entry(meter_id)
+    return Session()
+
+
+def dispose_db_engine(meter_id):
+    """ Close all connections to a meter database and forget the engine """
+    with _engines_lock:
+        entry = _engines.pop(str(meter_id), None)
+    if entry is not None:
+        engine, _ = entry
+        engine.dispose()
+    with _meter_summaries_lock:
+        _meter_summaries.pop(str(meter_id), None)
+
+
+def get_engine_stats() -> dict:
+    """ Return the engine registry cache counters """
+    with _engines_lock:
+        stats = dict(_engine_stats)
+        stats["cached"] = len(_engines)
+    return stats
+
+
 class Readings(Base):
     __tablename__ = "readings"
     ch_name = Column(String, primary_key=True)
@@ -39,17 +182,253 @@ class Readings(Base):
     read_value = Column(Float)
     quality_method = Column(String)
 
+    # Rows are stored in primary key order, so reading a channel's time range
+    # needs no lookups. The time leading index covers scans across channels
+    # and the earliest reading, the end index the latest.
+    __table_args__ = (
+        Index("ix_readings_time", read_start, ch_name, read_end, read_value),
+        Index("ix_readings_end", read_end),
+        {"sqlite_with_rowid": False},
+    )
 
-def get_data_range(meter_id) -> Tuple[datetime, datetime]:
-    """ Get the minimum and maximum date ranges with data
+
+# Databases created with a rowid table keep the primary key in a separate
+# index without read_value, so get a covering index for channel range scans
+ROWID_COVERING_INDEX = "ix_readings_channel_time"
+ROWID_COVERING_COLUMNS = ["ch_name", "read_start", "read_end", "read_value"]
+
+
+def get_partition_name(partition_by: str, read_start: datetime) -> str:
+    """ Return the name of the table a reading is stored in when partitioned """
+    if partition_by == "month":
+        return f"readings_{read_start.year}_{read_start.month:02d}"
+    return f"readings_{read_start.year}"
+
+
+def get_partition_period(name: str) -> Tuple[datetime, datetime]:
+    """ Return the range of reading start times held by a partition """
+    parts = [int(part) for part in name.split("_")[1:]]
+    if len(parts) == 1:
+        return datetime(parts[0], 1, 1), datetime(parts[0] + 1, 1, 1)
+    start = datetime(parts[0], parts[1], 1)
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+
+def get_partition_table(name: str) -> Table:
+    """ Return the readings table of a partition, with its own index names """
+    with _partition_lock:
+        table = _partition_metadata.tables.get(name)
+        if table is None:
+            table = Readings.__table__.to_metadata(_partition_metadata, name=name)
+            for index in table.indexes:
+                index.name = index.name.replace("readings", name, 1)
+        return table
+
+
+def get_partition_names(conn) -> List[str]:
+    """ Return the partitions in a meter database, oldest first """
+    names = conn.execute(
+        text(
+            "SELECT name FROM sqlite_master WHERE type = 'table' "
+            "AND name LIKE 'readings!_%' ESCAPE '!'"
+        )
+    ).scalars()
+    return sorted(names)
+
+
+def get_readings_tables(
+    conn, start: Optional[datetime] = None, end: Optional[datetime] = None
+) -> List[Table]:
+    """ Return the tables holding readings that start in the range, oldest first
+
+    Meters that are not partitioned keep every reading in the readings table.
+    :param conn: A session or connection to the meter database
+    """
+    if not conn.execute(select(MeterInfo.partition_by)).scalar():
+        return [Readings.__table__]
+    tables = []
+    for name in get_partition_names(conn):
+        period_start, period_end = get_partition_period(name)
+        if (end and period_start >= end) or (start and period_end <= start):
+            continue
+        tables.append(get_partition_table(name))
+    return tables
+
+
+def group_by_partition(session, rows: List[dict]) -> List[Tuple[Table, List[dict]]]:
+    """ Split readings by the table they are stored in, creating it if required """
+    partition_by = session.execute(select(MeterInfo.partition_by)).scalar()
+    if not partition_by:
+        return [(Readings.__table__, rows)]
+    partitions = defaultdict(list)
+    for row in rows:
+        partitions[get_partition_name(partition_by, row["read_start"])].append(row)
+    groups = []
+    for name, partition_rows in partitions.items():
+        table = get_partition_table(name)
+        table.create(session.connection(), checkfirst=True)
+        groups.append((table, partition_rows))
+    return groups
+
+
+class MeterInfo(Base):
+    __tablename__ = "meter_info"
+    info_id = Column(Integer, primary_key=True, default=1)  # Only ever one row
+    last_ingest = Column(DateTime)
+    # Incremented whenever readings or their rollups change
+    data_version = Column(Integer, default=0)
+    data_modified = Column(DateTime)  # UTC
+    # Readings are split into a table per "year" or "month" if set
+    partition_by = Column(String)
+
+
+class ChannelInfo(Base):
+    __tablename__ = "channel_info"
+    ch_name = Column(String, primary_key=True)
+    num_readings = Column(Integer)
+    first_reading = Column(DateTime)  # Earliest read_start
+    last_reading = Column(DateTime)  # Latest read_end
+
+
+def add_missing_meter_info(engine):
+    """ Summarise the readings of databases created before the info tables
+
+    New databases get the PARTITION_BY layout.
     """
-    engine = get_db_engine(meter_id)
     Session = sessionmaker(bind=engine)
     session = Session()
+    if session.query(MeterInfo).first() is None:
+        rebuild_channel_info(session)
+        # Readings already stored stay in the table they are in
+        existing = session.query(ChannelInfo).first() is not None
+        partition_by = None if existing else PARTITION_BY
+        session.add(MeterInfo(info_id=1, partition_by=partition_by))
+        session.commit()
+    session.close()
+
+
+def rebuild_channel_info(session):
+    """ Summarise the channels from the readings tables """
+    session.query(ChannelInfo).delete()
+    for table in get_readings_tables(session):
+        channels = session.query(
+            table.c.ch_name,
+            func.count(),
+            func.min(table.c.read_start),
+            func.max(table.c.read_end),
+        ).group_by(table.c.ch_name)
+        loaded = {ch_name: (num, first, last) for ch_name, num, first, last in channels}
+        add_channel_info(session, loaded)
+
+
+def update_channel_info(session, loaded: Dict[str, Tuple[int, datetime, datetime]]):
+    """ Add newly inserted readings to the channel summaries
+
+    :param loaded: The number of readings inserted for each channel,
+                   and the earliest start and latest end amongst them
+    """
+    add_channel_info(session, loaded)
+    session.merge(MeterInfo(info_id=1, last_ingest=datetime.now()))
 
-    min_date = session.query(func.min(Readings.read_start)).scalar()
-    max_date = session.query(func.max(Readings.read_end)).scalar()
-    return min_date, max_date
+
+def add_channel_info(session, loaded: Dict[str, Tuple[int, datetime, datetime]]):
+    """ Add readings to the count and time range of each channel """
+    table = ChannelInfo.__table__
+    rows = [
+        {
+            "ch_name": ch_name,
+            "num_readings": num_readings,
+            "first_reading": first_reading,
+            "last_reading": last_reading,
+        }
+        for ch_name, (num_readings, first_reading, last_reading) in loaded.items()
+        if num_readings
+    ]
+    if rows:
+        stmt = sqlite_insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["ch_name"],
+            set_={
+                "num_readings": table.c.num_readings + stmt.excluded.num_readings,
+                "first_reading": func.min(
+                    table.c.first_reading, stmt.excluded.first_reading
+                ),
+                "last_reading": func.max(
+                    table.c.last_reading, stmt.excluded.last_reading
+                ),
+            },
+        )
+        session.execute(stmt, rows)
+
+
+@timed()
+def get_meter_info(meter_id) -> dict:
+    """ Get the data range, readings per channel and last ingest of a meter """
+    session = get_db_session(meter_id)
+    try:
+        meter_info = session.query(MeterInfo).first()
+        channels = session.query(ChannelInfo).order_by(ChannelInfo.ch_name).all()
+    finally:
+        session.close()
+    first_record, last_record = get_data_range(meter_id)
+    return {
+        "first_record": first_record,
+        "last_record": last_record,
+        "last_ingest": meter_info.last_ingest if meter_info else None,
+        "channels": {ch.ch_name: ch.num_readings for ch in channels},
+    }
+
+
+@timed()
+def get_data_range(meter_id) -> Tuple[datetime, datetime]:
+    """ Get the minimum and maximum date ranges with data
+    """
+    first_record, last_record, _, _ = get_meter_summary(meter_id)
+    return first_record, last_record
+
+
+def get_data_version(meter_id) -> Tuple[int, datetime]:
+    """ Get the meter data version and when it last changed, in UTC """
+    _, _, data_version, data_modified = get_meter_summary(meter_id)
+    return data_version, data_modified
+
+
+def get_meter_summary(meter_id) -> tuple:
+    """ Get the data range, data version and time it changed for a meter
+
+    Read from the meter info tables. The version is always read, and the
+    range is cached until it changes, as each write of readings bumps it.
+    """
+    key = str(meter_id)
+    session = get_db_session(meter_id)
+    try:
+        data_version, data_modified = session.query(
+            MeterInfo.data_version, MeterInfo.data_modified
+        ).first()
+        data_version = data_version or 0
+        with _meter_summaries_lock:
+            cached = _meter_summaries.get(key)
+        if cached and cached[0] == data_version:
+            first_record, last_record = cached[1]
+        else:
+            first_record, last_record = session.query(
+                func.min(ChannelInfo.first_reading), func.max(ChannelInfo.last_reading)
+            ).one()
+            with _meter_summaries_lock:
+                _meter_summaries[key] = (data_version, (first_record, last_record))
+    finally:
+        session.close()
+    return first_record, last_record, data_version, data_modified
+
+
+def bump_data_version(meter_id):
+    """ Record that the meter's readings or rollups have changed """
+    session = get_db_session(meter_id)
+    meter_info = session.query(MeterInfo).first()
+    meter_info.data_version = (meter_info.data_version or 0) + 1
+    meter_info.data_modified = datetime.now(timezone.utc).replace(tzinfo=None)
+    session.commit()
+    session.close()
 
 
 def save_energy_reading(
@@ -59,30 +438,132 @@ def save_energy_reading(
     read_end: datetime,
     read_value,
     quality_method,
+    table: Optional[Table] = None,
 ):
-    """ Save reading to database """
+    """ Save reading to database
+
+    :param table: The readings table it belongs in, if already known
+    """
+
+    row = {
+        "ch_name": ch_name,
+        "read_start": read_start,
+        "read_end": read_end,
+        "read_value": read_value,
+        "quality_method": quality_method,
+    }
+    if table is None:
+        [(table, _)] = group_by_partition(session, [row])
 
     # Check existing records
-    r = (
-        session.query(Readings)
-        .filter(
-            Readings.ch_name == ch_name,
-            Readings.read_start == read_start,
-            Readings.read_end == read_end,
+    r = session.execute(
+        select(table.c.ch_name).where(
+            table.c.ch_name == ch_name,
+            table.c.read_start == read_start,
+            table.c.read_end == read_end,
         )
-        .first()
-    )
+    ).first()
     if r is not None:
         return False
 
-    read = Readings(
-        ch_name=ch_name,
-        read_start=read_start,
-        read_end=read_end,
-        read_value=read_value,
-        quality_method=quality_method,
+    session.execute(table.insert(), row)
+
+
+def save_energy_readings(session, rows: List[dict]) -> Tuple[int, int]:
+    """ Bulk insert readings, skipping any that already exist
+
+    :param rows: Dicts with ch_name, read_start, read_end, read_value
+                 and quality_method keys
+    :return: The number of rows inserted and skipped
+    """
+    if not rows:
+        return 0, 0
+    inserted = 0
+    for table, partition_rows in group_by_partition(session, rows):
+        stmt = sqlite_insert(table).on_conflict_do_nothing(
+            index_elements=["ch_name", "read_start", "read_end"]
+        )
+        result = session.execute(stmt, partition_rows)
+        inserted += max(result.rowcount, 0)
+    return inserted, len(rows) - inserted
+
+
+def save_each_energy_reading(session, rows: List[dict]) -> Tuple[int, int]:
+    """ Insert readings one at a time, skipping any that already exist
+
+    :return: The number of rows inserted and skipped
+    """
+    inserted = 0
+    for table, partition_rows in group_by_partition(session, rows):
+        for row in partition_rows:
+            if save_energy_reading(session, table=table, **row) is not False:
+                inserted += 1
+    return inserted, len(rows) - inserted
+
+
+@timed()
+def get_reading_arrays(
+    meter_id,
+    read_start: datetime,
+    read_end: datetime,
+    channels: List[str] = ["E1", "11"],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """ Get the raw readings as columns
+
+    :return: Channel names, start and end times in epoch seconds, and values
+    """
+
+    session = get_db_session(meter_id)
+
+    # Partitions hold consecutive periods, so are read one after the other
+    res = []
+    try:
+        for table in get_readings_tables(session, read_start, read_end):
+            # Let SQLite convert the timestamps rather than parsing each in Python
+            res += (
+                session.query(
+                    table.c.ch_name,
+                    cast(func.strftime("%s", table.c.read_start), Integer),
+                    cast(func.strftime("%s", table.c.read_end), Integer),
+                    func.coalesce(table.c.read_value, 0.0),
+                )
+                .filter(
+                    table.c.ch_name.in_(channels),
+                    table.c.read_start >= read_start,
+                    table.c.read_end <= read_end,
+                )
+                .order_by(table.c.read_start)
+                .all()
+            )
+    finally:
+        session.close()
+    if not res:
+        empty = np.array([], dtype=np.int64)
+        return np.array([], dtype=object), empty, empty, np.array([])
+    ch_names, starts, ends, values = zip(*res)
+    return (
+        np.array(ch_names, dtype=object),
+        np.array(starts, dtype=np.int64),
+        np.array(ends, dtype=np.int64),
+        np.array(values, dtype=np.float64),
+    )
+
+
+def get_load_energy_arrays(
+    meter_id,
+    read_start: datetime,
+    read_end: datetime,
+    channels: List[str] = ["E1", "11"],
+    interval_m: int = 5,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """ Get profiled energy readings as columns
+
+    :return: Interval ends in epoch seconds and the usage in each interval
+    """
+    _, starts, ends, values = get_reading_arrays(
+        meter_id, read_start, read_end, channels
     )
-    session.add(read)
+    return profile_intervals(starts, ends, values, interval_m)
 
 
 def get_load_energy_readings(
@@ -90,27 +571,136 @@ def get_load_energy_readings(
     read_start: datetime,
     read_end: datetime,
     channels: List[str] = ["E1", "11"],
+    interval_m: int = 5,
 ):
-    """ Get energy readings """
+    """ Get energy readings, profiled into intervals of interval_m minutes """
+    interval_ends, totals = get_load_energy_arrays(
+        meter_id, read_start, read_end, channels, interval_m
+    )
+    return iter_profiled_readings(interval_ends, totals, interval_m)
 
-    engine = get_db_engine(meter_id)
-    Session = sessionmaker(bind=engine)
-    session = Session()
 
-    # Filter existing records
-    res = (
-        session.query(Readings)
-        .filter(
-            Readings.ch_name.in_(channels),
-            Readings.read_start >= read_start,
-            Readings.read_end <= read_end,
+def get_grouped_energy_readings(
+    meter_id,
+    read_start: datetime,
+    read_end: datetime,
+    channel_groups: Dict[str, List[str]],
+) -> Dict[str, list]:
+    """ Get profiled energy readings for several channel groups in one scan
+
+    :param channel_groups: Lists of channels to combine, keyed by group name
+    :return: The profiled 5 minute readings, keyed by group name
+    """
+    all_channels = [ch for channels in channel_groups.values() for ch in channels]
+    ch_names, starts, ends, values = get_reading_arrays(
+        meter_id, read_start, read_end, all_channels
+    )
+
+    readings = {}
+    for group, channels in channel_groups.items():
+        in_group = np.isin(ch_names, channels)
+        interval_ends, totals = profile_intervals(
+            starts[in_group], ends[in_group], values[in_group], interval_m=5
         )
-        .all()
+        readings[group] = list(iter_profiled_readings(interval_ends, totals, 5))
+    return readings
+
+
+class IntervalTotals(Base):
+    __tablename__ = "interval_totals"
+
+    # Profiled usage of a channel group in the interval ending at interval_end
+    ch_group = Column(String, primary_key=True)
+    interval_m = Column(Integer, primary_key=True)
+    interval_end = Column(Integer, primary_key=True)  # Epoch seconds
+    total = Column(Float)
+
+    __table_args__ = ({"sqlite_with_rowid": False},)
+
+
+def get_interval_totals(
+    meter_id, ch_group: str, read_start: datetime, read_end: datetime, interval_m: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """ Get the stored interval totals of a channel group as columns
+
+    :return: Interval ends in epoch seconds and the usage in each interval
+    """
+    return get_grouped_interval_totals(
+        meter_id, [ch_group], read_start, read_end, interval_m
+    )[ch_group]
+
+
+@timed()
+def get_grouped_interval_totals(
+    meter_id,
+    ch_groups: List[str],
+    read_start: datetime,
+    read_end: datetime,
+    interval_m: int,
+) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """ Get the stored interval totals of several channel groups in one scan
+
+    :return: Interval ends in epoch seconds and the usage in each interval,
+             keyed by group name
+    """
+    start_s, end_s = to_epoch([read_start, read_end]).tolist()
+    stmt = (
+        select(
+            IntervalTotals.ch_group, IntervalTotals.interval_end, IntervalTotals.total
+        )
+        .where(
+            IntervalTotals.ch_group.in_(ch_groups),
+            IntervalTotals.interval_m == interval_m,
+            IntervalTotals.interval_end > start_s,
+            IntervalTotals.interval_end <= end_s,
+        )
+        .order_by(IntervalTotals.ch_group, IntervalTotals.interval_end)
+    )
+    # Plain rows from the connection skip the ORM's per row overhead
+    with get_db_engine(meter_id).connect() as conn:
+        res = conn.execute(stmt).all()
+
+    groups = np.array([row[0] for row in res], dtype=object)
+    interval_ends = np.array([row[1] for row in res], dtype=np.int64)
+    totals = np.array([row[2] for row in res], dtype=np.float64)
+    grouped = {}
+    for ch_group in ch_groups:
+        in_group = groups == ch_group
+        grouped[ch_group] = (interval_ends[in_group], totals[in_group])
+    return grouped
+
+
+def has_interval_totals(meter_id) -> bool:
+    """ Check if the interval totals have been built for the meter """
+    session = get_db_session(meter_id)
+    built = session.query(IntervalTotals.ch_group).first() is not None
+    session.close()
+    return built
+
+
+def save_interval_totals(
+    session,
+    ch_group: str,
+    interval_m: int,
+    interval_ends: np.ndarray,
+    totals: np.ndarray,
+):
+    """ Insert or update the totals of many intervals at once """
+    rows = [
+        {
+            "ch_group": ch_group,
+            "interval_m": interval_m,
+            "interval_end": interval_end,
+            "total": total,
+        }
+        for interval_end, total in zip(interval_ends.tolist(), totals.tolist())
+    ]
+    upsert_rows(
+        session,
+        IntervalTotals.__table__,
+        rows,
+        ["ch_group", "interval_m", "interval_end"],
     )
-    readings = []
-    for r in res:
-        readings.append((r.read_start, r.read_end, r.read_value))
-    return group_into_profiled_intervals(readings, interval_m=5)
 
 
 class Dailies(Base):
@@ -137,19 +727,21 @@ class Dailies(Base):
         return False
 
 
+@timed()
 def get_daily_energy_readings(meter_id, read_start: datetime, read_end: datetime):
     """ Get energy readings """
 
-    engine = get_db_engine(meter_id)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    session = get_db_session(meter_id)
 
     # Filter existing records
-    res = (
-        session.query(Dailies)
-        .filter(Dailies.day >= read_start, Dailies.day <= read_end)
-        .all()
-    )
+    try:
+        res = (
+            session.query(Dailies)
+            .filter(Dailies.day >= read_start, Dailies.day <= read_end)
+            .all()
+        )
+    finally:
+        session.close()
     return res
 
 
@@ -193,6 +785,47 @@ def update_daily_total(
         r.estimated = estimated
 
 
+def save_daily_totals(session, rows: List[dict]):
+    """ Insert or update many daily totals at once
+
+    :param rows: Dicts with a value for every Dailies column
+    """
+    upsert_rows(session, Dailies.__table__, rows, ["day"])
+
+
+def add_missing_daily_totals(session, rows: List[dict]) -> int:
+    """ Insert daily totals for days that do not have one yet
+
+    :return: The number of days added
+    """
+    if not rows:
+        return 0
+    days = [row["day"] for row in rows]
+    existing = set(
+        day
+        for day, in session.query(Dailies.day).filter(
+            Dailies.day >= min(days), Dailies.day <= max(days)
+        )
+    )
+    missing = [row for row in rows if row["day"] not in existing]
+    if missing:
+        session.execute(sqlite_insert(Dailies.__table__), missing)
+    return len(missing)
+
+
+def upsert_rows(session, table, rows: List[dict], index_elements: List[str]):
+    """ Insert rows, updating the other columns of any that already exist """
+    if not rows:
+        return
+    stmt = sqlite_insert(table)
+    update_cols = [col for col in rows[0].keys() if col not in index_elements]
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={col: stmt.excluded[col] for col in update_cols},
+    )
+    session.execute(stmt, rows)
+
+
 class Monthlies(Base):
     __tablename__ = "monthly_totals"
 
@@ -210,6 +843,8 @@ class Monthlies(Base):
     # SEQ Peak Times
     load_peak2 = Column(Float)
     load_shoulder2 = Column(Float)
+    # Incremented whenever the totals change
+    version = Column(Integer, default=0)
 
     @property
     def fin_yr(self) -> str:
@@ -243,22 +878,47 @@ class Monthlies(Base):
         return self.load_total / self.num_days
 
 
+@timed()
 def get_monthly_energy_readings(meter_id, year: int, month: int):
     """ Get energy readings """
 
-    engine = get_db_engine(meter_id)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    session = get_db_session(meter_id)
 
     # Filter existing records
-    res = (
-        session.query(Monthlies)
-        .filter(Monthlies.year == year, Monthlies.month == month)
-        .first()
-    )
+    try:
+        res = (
+            session.query(Monthlies)
+            .filter(Monthlies.year == year, Monthlies.month == month)
+            .first()
+        )
+    finally:
+        session.close()
     return res
 
 
+@timed()
+def get_monthly_energy_readings_range(
+    meter_id, start: datetime, end: datetime
+) -> Dict[Tuple[int, int], "Monthlies"]:
+    """ Get all monthly totals between two dates in a single query
+
+    :return: The monthly totals keyed by (year, month)
+    """
+
+    session = get_db_session(meter_id)
+
+    start_key = start.year * 100 + start.month
+    end_key = end.year * 100 + end.month
+    try:
+        res = session.query(Monthlies).filter(
+            Monthlies.year * 100 + Monthlies.month >= start_key,
+            Monthlies.year * 100 + Monthlies.month <= end_key,
+        )
+        return {(r.year, r.month): r for r in res}
+    finally:
+        session.close()
+
+
 def update_monthly_total(
     session,
     year,
@@ -305,6 +965,89 @@ def update_monthly_total(
         r.load_shoulder1 = load_shoulder1
         r.load_peak2 = load_peak2
         r.load_shoulder2 = load_shoulder2
+        if session.is_modified(r):
+            r.version = (r.version or 0) + 1
+
+
+def save_monthly_totals(session, rows: List[dict]):
+    """ Insert or update many monthly totals at once
+
+    The version of each existing month is incremented if its totals change.
+    :param rows: Dicts with a value for every Monthlies column except version
+    """
+    if not rows:
+        return
+    table = Monthlies.__table__
+    stmt = sqlite_insert(table)
+    update_cols = [col for col in rows[0].keys() if col not in ["year", "month"]]
+    changed = or_(*[table.c[col].isnot(stmt.excluded[col]) for col in update_cols])
+    set_ = {col: stmt.excluded[col] for col in update_cols}
+    set_["version"] = case(
+        (changed, func.coalesce(table.c.version, 0) + 1), else_=table.c.version
+    )
+    stmt = stmt.on_conflict_do_update(index_elements=["year", "month"], set_=set_)
+    session.execute(stmt, [dict(row, version=0) for row in rows])
+
+
+class MonthlyBills(Base):
+    __tablename__ = "monthly_bills"
+
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    # The monthly totals version and tariff year the bill was calculated for
+    version = Column(Integer)
+    fin_year = Column(String)
+    bill = Column(PickleType)
+
+
+@timed()
+def get_monthly_bills(meter_id, start: datetime, end: datetime) -> dict:
+    """ Get the stored bills that are still current for the monthly totals
+
+    :return: The bill for each (year, month), with its tariff year
+    """
+
+    session = get_db_session(meter_id)
+
+    start_key = start.year * 100 + start.month
+    end_key = end.year * 100 + end.month
+    res = (
+        session.query(
+            MonthlyBills.year,
+            MonthlyBills.month,
+            MonthlyBills.fin_year,
+            MonthlyBills.bill,
+        )
+        .join(
+            Monthlies,
+            (Monthlies.year == MonthlyBills.year)
+            & (Monthlies.month == MonthlyBills.month)
+            & (Monthlies.version == MonthlyBills.version),
+        )
+        .filter(
+            MonthlyBills.year * 100 + MonthlyBills.month >= start_key,
+            MonthlyBills.year * 100 + MonthlyBills.month <= end_key,
+        )
+    )
+    try:
+        return {(year, month): (fin_year, bill) for year, month, fin_year, bill in res}
+    finally:
+        session.close()
+
+
+def save_monthly_bill(meter_id, year: int, month: int, version, fin_year, bill):
+    """ Store the calculated bill for a month """
+
+    session = get_db_session(meter_id)
+    try:
+        session.merge(
+            MonthlyBills(
+                year=year, month=month, version=version, fin_year=fin_year, bill=bill
+            )
+        )
+        session.commit()
+    finally:
+        session.close()
 
 
 class DailySegments(Base):
@@ -339,3 +1082,58 @@ def update_daily_segments(session, day, a, b, c, d, e, f, g, h):
         r.f = f
         r.g = g
         r.h = h
+
+
+def save_daily_segments(session, rows: List[dict]):
+    """ Insert or update many daily segment totals at once
+
+    :param rows: Dicts with a value for every DailySegments column
+    """
+    upsert_rows(session, DailySegments.__table__, rows, ["day"])
+
+
+class DayStats(Base):
+    __tablename__ = "day_stats"
+
+    # Actual daily load totals for each day of the week in a month
+    year = Column(Integer, primary_key=True)
+    month = Column(Integer, primary_key=True)
+    weekday = Column(Integer, primary_key=True)
+    num_days = Column(Integer)
+    load_sum = Column(Float)
+    load_sum_sq = Column(Float)
+    # Number of days in each bin of STATS_BIN_WIDTH kWh
+    load_hist = Column(PickleType)
+
+
+@timed()
+def get_day_stats(meter_id, start: datetime, end: datetime) -> List[DayStats]:
+    """ Get the day of week stats for the months in range """
+
+    session = get_db_session(meter_id)
+
+    start_key = start.year * 100 + start.month
+    end_key = end.year * 100 + end.month
+    res = session.query(DayStats).filter(
+        DayStats.year * 100 + DayStats.month >= start_key,
+        DayStats.year * 100 + DayStats.month <= end_key,
+    )
+    day_stats = res.all()
+    session.close()
+    return day_stats
+
+
+def has_day_stats(meter_id) -> bool:
+    """ Check if the day of week stats have been built for the meter """
+    session = get_db_session(meter_id)
+    built = session.query(DayStats.year).first() is not None
+    session.close()
+    return built
+
+
+def save_day_stats(session, rows: List[dict]):
+    """ Insert or update the day of week stats for many months at once
+
+    :param rows: Dicts with a value for every DayStats column
+    """
+    upsert_rows(session, DayStats.__table__, rows, ["year", "month", "weekday"])
@@ -0,0 +1,119 @@
+"""
+    metering.nem_stream
+    ~~~~~~~~~
+    Read NEM12 files one row at a time, without loading the whole file
+"""
+
+import csv
+import io
+import logging
+import zipfile
+from contextlib import contextmanager
+from itertools import groupby
+from typing import Iterator, List, Optional, Tuple
+from nemreader.nem_objects import Reading
+from nemreader.nem_reader import parse_200_row, parse_300_row, parse_400_row
+from nemreader.nem_reader import update_reading_events
+
+MINUTES_PER_DAY = 24 * 60
+
+
+@contextmanager
+def open_nem_rows(nem_file):
+    """ Open a NEM file, or a zip containing one, as an iterator of CSV rows """
+    if zipfile.is_zipfile(nem_file):
+        with zipfile.ZipFile(nem_file) as datafile:
+            files = datafile.namelist()
+            if len(files) > 1:
+                raise ValueError("Only zip files with one file are supported")
+            with datafile.open(files[0]) as raw:
+                yield csv.reader(io.TextIOWrapper(raw, encoding="utf-8"))
+    else:
+        with open(nem_file, newline="") as f:
+            yield csv.reader(f)
+
+
+def get_nem_version(nem_file) -> Optional[str]:
+    """ Return the version in the header row, if there is one """
+    with open_nem_rows(nem_file) as rows:
+        for row in rows:
+            if not row:
+                continue  # Some files start with an empty line
+            if row[0] == "100" and len(row) > 1:
+                return row[1]
+            return None
+    return None
+
+
+def get_nem12_nmis(nem_file) -> List[str]:
+    """ Return the NMIs in a NEM12 file, in the order they first appear """
+    nmis = []
+    with open_nem_rows(nem_file) as rows:
+        for row in rows:
+            if row and row[0] == "200" and row[1] not in nmis:
+                nmis.append(row[1])
+    return nmis
+
+
+def iter_nem12_readings(nem_file) -> Iterator[Tuple[str, str, Reading]]:
+    """ Yield the NMI, channel and reading for each interval in a NEM12 file
+
+    Each 300 row is held until the next row, in case a 400 row
+    follows it with quality details for some of its intervals.
+    """
+    nmi_d = None
+    day_reads: List[Reading] = []
+    with open_nem_rows(nem_file) as rows:
+        for row_num, row in enumerate(rows, start=1):
+            if not row:
+                continue
+            try:
+                record_indicator = int(row[0])
+                if record_indicator == 400:
+                    event_record = parse_400_row(row, nmi_d.interval_length)
+                    day_reads = update_reading_events(day_reads, event_record)
+                    continue
+
+                for read in day_reads:
+                    yield nmi_d.nmi, nmi_d.nmi_suffix, read
+                day_reads = []
+
+                if record_indicator == 200:
+                    nmi_d = parse_200_row(row)
+                elif record_indicator == 300:
+                    num_intervals = MINUTES_PER_DAY // nmi_d.interval_length
+                    if len(row) < num_intervals + 2:
+                        msg = "Skipping 300 record for %s %s %s on row %d. "
+                        msg += "It does not have the expected %s intervals"
+                        logging.error(
+                            msg,
+                            nmi_d.nmi,
+                            nmi_d.nmi_suffix,
+                            row[1],
+                            row_num,
+                            num_intervals,
+                        )
+                        continue
+                    interval_record = parse_300_row(
+                        row,
+                        nmi_d.interval_length,
+                        nmi_d.uom,
+                        nmi_d.meter_serial_number,
+                    )
+                    day_reads = interval_record.interval_values
+            except (KeyError, ValueError, AssertionError, IndexError, TypeError) as e:
+                raise ValueError(f"Unable to parse line {row_num}") from e
+
+        for read in day_reads:
+            yield nmi_d.nmi, nmi_d.nmi_suffix, read
+
+
+def iter_nem12_channels(nem_file) -> Iterator[Tuple[str, str, Iterator[Reading]]]:
+    """ Yield the NMI, channel and a generator of its readings for each block
+
+    Like itertools.groupby, each generator must be used before the next
+    block is requested.
+    """
+    records = iter_nem12_readings(nem_file)
+    for (nmi, ch_name), group in groupby(records, key=lambda r: (r[0], r[1])):
+        yield nmi, ch_name, (read for _, _, read in group)
@@ -0,0 +1,151 @@
+"""
+    metering.partitions
+    ~~~~~~~~~
+    Split meter readings into a table per year or month, and archive old ones
+"""
+
+import logging
+import os
+import re
+from typing import List
+from sqlalchemy import create_engine, func, select
+
+from . import get_db_engine, get_db_session, get_db_location
+from . import Readings, MeterInfo
+from . import get_partition_names, rebuild_channel_info, bump_data_version
+from .models import get_partition_name, get_partition_period, get_partition_table
+
+PARTITION_LAYOUTS = ["year", "month"]
+PARTITION_NAME = re.compile(r"readings_\d{4}(_\d{2})?")
+
+
+def get_archive_location(meter_id, name: str) -> str:
+    """ Return the path of the database an archived partition is moved to """
+    db_dir = os.path.dirname(get_db_location(meter_id))
+    return os.path.join(db_dir, "archive", f"meter_{meter_id}_{name}.db")
+
+
+def partition_readings(meter_id, partition_by: str = "year") -> List[str]:
+    """ Move a meter's readings into a table per year or month
+
+    Once partitioned, reads only scan the partitions in range and loading
+    an old period only touches the partitions it falls in.
+    :return: The names of the partitions
+    """
+    if partition_by not in PARTITION_LAYOUTS:
+        raise ValueError(f"Partition by one of {', '.join(PARTITION_LAYOUTS)}")
+    engine = get_db_engine(meter_id)
+    readings = Readings.__table__
+    with engine.begin() as conn:
+        if conn.execute(select(MeterInfo.partition_by)).scalar():
+            raise ValueError(f"Meter {meter_id} readings are already partitioned")
+        period = "%Y-%m" if partition_by == "month" else "%Y"
+        starts = conn.execute(
+            select(func.min(readings.c.read_start)).group_by(
+                func.strftime(period, readings.c.read_start)
+            )
+        ).scalars()
+        names = [get_partition_name(partition_by, start) for start in starts]
+        for name in names:
+            table = get_partition_table(name)
+            table.create(conn, checkfirst=True)
+            period_start, period_end = get_partition_period(name)
+            in_period = select(readings).where(
+                readings.c.read_start >= period_start,
+                readings.c.read_start < period_end,
+            )
+            conn.execute(table.insert().from_select(readings.columns, in_period))
+        conn.execute(readings.delete())
+        conn.execute(MeterInfo.__table__.update().values(partition_by=partition_by))
+    compact_readings(meter_id)
+    logging.info("Meter %s readings split into %s partitions", meter_id, len(names))
+    return names
+
+
+def archive_partition(meter_id, name: str) -> str:
+    """ Move a partition to its own database file, out of the meter database
+
+    Archived readings are no longer read, but the daily and monthly totals
+    calculated from them are kept.
+    :return: The path of the archive database
+    """
+    engine = get_db_engine(meter_id)
+    with engine.connect() as conn:
+        if name not in get_partition_names(conn):
+            raise ValueError(f"Meter {meter_id} has no partition {name}")
+    archive_path = get_archive_location(meter_id, name)
+    if os.path.exists(archive_path):
+        raise ValueError(f"Partition {name} has already been archived")
+    os.makedirs(os.path.dirname(archive_path), exist_ok=True)
+    archive_engine = create_engine(f"sqlite:///{archive_path}")
+    get_partition_table(name).create(archive_engine)
+    archive_engine.dispose()
+
+    with engine.connect() as conn:
+        conn.exec_driver_sql("ATTACH DATABASE ? AS archive", (archive_path,))
+        try:
+            with conn.begin():
+                conn.exec_driver_sql(
+                    f"INSERT INTO archive.{name} SELECT * FROM main.{name}"
+                )
+                conn.exec_driver_sql(f"DROP TABLE main.{name}")
+        finally:
+            conn.exec_driver_sql("DETACH DATABASE archive")
+    refresh_partition_info(meter_id)
+    compact_readings(meter_id)
+    logging.info("Meter %s partition %s archived to %s", meter_id, name, archive_path)
+    return archive_path
+
+
+def restore_partition(meter_id, name: str):
+    """ Move an archived partition back into the meter database """
+    if not PARTITION_NAME.fullmatch(name):
+        raise ValueError(f"{name} is not the name of a partition")
+    archive_path = get_archive_location(meter_id, name)
+    if not os.path.exists(archive_path):
+        raise ValueError(f"Partition {name} has not been archived")
+    engine = get_db_engine(meter_id)
+    get_partition_table(name).create(engine, checkfirst=True)
+    with engine.connect() as conn:
+        conn.exec_driver_sql("ATTACH DATABASE ? AS archive", (archive_path,))
+        try:
+            with conn.begin():
+                conn.exec_driver_sql(
+                    f"INSERT OR IGNORE INTO main.{name} SELECT * FROM archive.{name}"
+                )
+        finally:
+            conn.exec_driver_sql("DETACH DATABASE archive")
+    os.remove(archive_path)
+    refresh_partition_info(meter_id)
+    logging.info("Meter %s partition %s restored", meter_id, name)
+
+
+def get_archived_partitions(meter_id) -> List[str]:
+    """ Return the archived partitions of a meter, oldest first """
+    archive_dir = os.path.dirname(get_archive_location(meter_id, ""))
+    if not os.path.isdir(archive_dir):
+        return []
+    prefix = f"meter_{meter_id}_"
+    names = []
+    for filename in os.listdir(archive_dir):
+        name, ext = os.path.splitext(filename)
+        if ext != ".db" or not name.startswith(prefix):
+            continue
+        if PARTITION_NAME.fullmatch(name[len(prefix) :]):
+            names.append(name[len(prefix) :])
+    return sorted(names)
+
+
+def refresh_partition_info(meter_id):
+    """ Update the channel summaries after partitions were moved """
+    session = get_db_session(meter_id)
+    rebuild_channel_info(session)
+    session.commit()
+    session.close()
+    bump_data_version(meter_id)
+
+
+def compact_readings(meter_id):
+    """ Rebuild the meter database to free the space of moved readings """
+    with get_db_engine(meter_id).connect() as conn:
+        conn.exec_driver_sql("VACUUM")
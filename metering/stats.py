@@ -4,41 +4,103 @@
     Get stats
 """
 
-import logging
-from datetime import datetime, timedelta
-from typing import List, Tuple, Optional
-from statistics import mean
-from dateutil.relativedelta import relativedelta
-from qldtariffs import get_daily_usages
-from qldtariffs import financial_year_ending
-from sqlalchemy.orm import sessionmaker
-from calendar import day_abbr
-
-from . import Dailies
-from . import get_daily_energy_readings
-
-LOAD_CHS = ["E1", "11"]
-CONTROL_CHS = ["E2", "41"]
-GENERATION_CHS = ["B1", "71"]
-
-
-def get_day_of_week_avg(meter_id, start, end):
-
-    print("Test")
-    weekdays = {0: [], 1: [], 2: [], 3: [], 4: [], 5: [], 6: []}
-    days = get_daily_energy_readings(meter_id, start, end)
-    for day in days:
-        if day.load_total:
-            if not day.estimated:
-                weekdays[day.day.weekday()].append(day.load_total)
-
-    weekday_avgs = {}
-
-    for day in weekdays.keys():
-        weekday_avgs[day_abbr[day]] = mean(weekdays[day])
-
-        weekday_avgs["weekends"] = mean(weekdays[6] + weekdays[5])
-        weekday_avgs["weekdays"] = mean(
-            weekdays[0] + weekdays[1] + weekdays[2] + weekdays[3] + weekdays[4]
-        )
-    return weekday_avgs
+import math
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+from calendar import day_abbr, month_abbr
+
+from . import DayStats
+from . import get_day_stats
+from .analyse import STATS_BIN_WIDTH
+from .metrics import timed
+
+SEASONS = {
+    "summer": [12, 1, 2],
+    "autumn": [3, 4, 5],
+    "winter": [6, 7, 8],
+    "spring": [9, 10, 11],
+}
+
+
+def get_day_of_week_avg(meter_id, start, end) -> Dict[str, Optional[float]]:
+    """ Get the average daily load for each day of the week """
+    return get_usage_stats(meter_id, start, end)["day_avgs"]
+
+
+@timed()
+def get_usage_stats(meter_id, start: datetime, end: datetime) -> dict:
+    """ Get daily load stats by day of week, month and season
+
+    Stats come from the stored totals for each month, so reading them
+    costs the same however many days are in range. Meters loaded before
+    they were stored have none until backfill_rollups builds them.
+    """
+    cells = get_day_stats(meter_id, start, end)
+
+    weekdays = defaultdict(list)
+    months = defaultdict(list)
+    for cell in cells:
+        weekdays[cell.weekday].append(cell)
+        months[cell.month].append(cell)
+
+    day_of_week = {
+        day_abbr[day]: summarise_day_stats(weekdays[day]) for day in range(7)
+    }
+    day_of_week["weekdays"] = summarise_day_stats(
+        cell for day in range(5) for cell in weekdays[day]
+    )
+    day_of_week["weekends"] = summarise_day_stats(weekdays[5] + weekdays[6])
+
+    month = {month_abbr[m]: summarise_day_stats(months[m]) for m in range(1, 13)}
+    season = {
+        name: summarise_day_stats(cell for m in season_months for cell in months[m])
+        for name, season_months in SEASONS.items()
+    }
+
+    return {
+        "day_avgs": {key: stats["mean"] for key, stats in day_of_week.items()},
+        "day_of_week": day_of_week,
+        "month": month,
+        "season": season,
+    }
+
+
+def summarise_day_stats(cells: Iterable[DayStats]) -> dict:
+    """ Combine the stored totals into the stats for a group of days """
+    num_days = 0
+    load_sum = 0.0
+    load_sum_sq = 0.0
+    hist: Dict[int, int] = defaultdict(int)
+    for cell in cells:
+        num_days += cell.num_days
+        load_sum += cell.load_sum
+        load_sum_sq += cell.load_sum_sq
+        for load_bin, count in cell.load_hist.items():
+            hist[load_bin] += count
+
+    if not num_days:
+        return {"days": 0, "mean": None, "median": None, "p90": None, "stddev": None}
+    avg = load_sum / num_days
+    stddev = 0.0
+    if num_days > 1:
+        variance = (load_sum_sq - load_sum * avg) / (num_days - 1)
+        stddev = math.sqrt(max(variance, 0))
+    return {
+        "days": num_days,
+        "mean": avg,
+        "median": hist_quantile(hist, num_days, 0.5),
+        "p90": hist_quantile(hist, num_days, 0.9),
+        "stddev": stddev,
+    }
+
+
+def hist_quantile(hist: Dict[int, int], num_days: int, q: float) -> float:
+    """ Estimate a quantile from the histogram, to within half a bin """
+    rank = q * (num_days - 1)
+    seen = 0
+    for load_bin in sorted(hist.keys()):
+        seen += hist[load_bin]
+        if seen > rank:
+            break
+    return (load_bin + 0.5) * STATS_BIN_WIDTH
@@ -32,6 +32,10 @@ def setup_files():
 if __name__ == '__main__':
 
     setup_files()
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        # Only in the reloaded process that serves requests
+        from energy.jobs import resume_import_jobs
+        resume_import_jobs()
     with open('logging.yaml', 'rt') as f:
         config = yaml.safe_load(f.read())
     logging.config.dictConfig(config)
@@ -0,0 +1,55 @@
+import os
+import shutil
+import pytest
+from context import test_site
+from energy import app, db
+from energy.models import Meter, User
+from metering import dispose_db_engine, get_stored_meter_ids
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """ Run in an empty folder, closing any meter databases opened afterwards
+    """
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    for meter_id in get_stored_meter_ids():
+        dispose_db_engine(meter_id)
+    shutil.rmtree(tmp_path / "data", ignore_errors=True)
+
+
+@pytest.fixture
+def site(data_dir, monkeypatch):
+    """ An empty app database with one user, and an upload folder
+    """
+    db_uri = f"sqlite:///{data_dir / 'app.db'}"
+    monkeypatch.setitem(app.config, "SQLALCHEMY_DATABASE_URI", db_uri)
+    monkeypatch.setitem(app.config, "UPLOAD_FOLDER", "uploads")
+    os.makedirs("uploads")
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(user_id=1, username="user"))
+        db.session.commit()
+        db.session.remove()
+    yield test_site
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+    shutil.rmtree(data_dir / "uploads", ignore_errors=True)
+
+
+@pytest.fixture
+def add_meter(site):
+    """ Return a function that adds a meter for the user to the app database
+    """
+
+    def add(meter_id: int, meter_name: str = "Q1", sharing: str = "public"):
+        with app.app_context():
+            meter = Meter(
+                meter_id=meter_id, user_id=1, meter_name=meter_name, sharing=sharing
+            )
+            db.session.add(meter)
+            db.session.commit()
+            db.session.remove()
+
+    return add
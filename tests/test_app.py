@@ -1,4 +1,14 @@
+import json
+import sys
+from collections import namedtuple
+from datetime import date, datetime
+from decimal import Decimal
+import numpy as np
 from context import test_site
+from energy import app
+from metering import load_nem_data, dispose_db_engine, get_interval_arrays
+from metering import clear_histograms, get_monthly_energy_readings
+from benchmarks.nem12 import write_nem12
 
 
 def test_index():
@@ -9,3 +19,118 @@ def test_index():
 
     response = test_site.get("/about/")
     assert response.status_code == 200
+
+
+def test_energy_data(add_meter, monkeypatch):
+    """ Test chart series are sent as columns, with any JSON encoder
+    """
+    add_meter(917)
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=2, nmi="Q1", interval_m=30)
+    load_nem_data(917, "Q1", "a.csv")
+
+    url = "/meters/917/2018-01-01/2018-01-02/energy_data.json?resolution=30m"
+    data = test_site.get(url).get_json()
+    assert data["resolution"] == "30m"
+    consumption = data["consumption"]
+    assert len(consumption["x"]) == len(consumption["y"]) == 48
+    assert consumption["x"][0] == 1514766600000
+    interval_ends, totals = get_interval_arrays(
+        917, "load", datetime(2018, 1, 1), datetime(2018, 1, 2), 30
+    )
+    assert consumption["y"] == (totals * 2).tolist()
+    assert all(kw <= 0 for kw in data["generation"]["y"])
+
+    # The standard library encoder gives the same response
+    encoding = sys.modules["energy.encoding"]
+    monkeypatch.setattr(encoding, "orjson", None)
+    monkeypatch.setattr(encoding, "simplejson", None)
+    assert test_site.get(url).get_json() == data
+
+
+def test_json_encoders(monkeypatch):
+    """ Test each JSON encoder gives the same response
+    """
+    Charge = namedtuple("Charge", ["name", "cost"])
+    data = {
+        "bill": Charge("t11", Decimal("1.50")),
+        "day": date(2018, 1, 1),
+        "kw": np.array([0.5, 1.5]),
+        "total": np.float64(2.0),
+    }
+    # Fall back from orjson to simplejson to the standard library
+    encoding = sys.modules["energy.encoding"]
+    with app.app_context():
+        responses = [app.json.response(data).get_json()]
+        monkeypatch.setattr(encoding, "orjson", None)
+        responses.append(app.json.response(data).get_json())
+        monkeypatch.setattr(encoding, "simplejson", None)
+        responses.append(app.json.response(data).get_json())
+    assert responses[0] == {
+        "bill": ["t11", "1.50"],
+        "day": "Mon, 01 Jan 2018 00:00:00 GMT",
+        "kw": [0.5, 1.5],
+        "total": 2.0,
+    }
+    assert responses[1] == responses[2] == responses[0]
+
+
+def server_timings(response) -> dict:
+    """ Return each timing in the Server-Timing header by name
+    """
+    return {
+        timing.split(";")[0]: timing
+        for timing in response.headers["Server-Timing"].split(", ")
+    }
+
+
+def test_request_metrics(add_meter, monkeypatch, caplog):
+    """ Test requests report their SQL and metering time
+    """
+    add_meter(918)
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=2, nmi="Q1", interval_m=30)
+    load_nem_data(918, "Q1", "a.csv")
+    dispose_db_engine(918)
+    clear_histograms()
+
+    url = "/meters/918/2018-01-01/2018-01-02/energy_data.json"
+    with caplog.at_level("INFO", logger="energy.metrics"):
+        response = test_site.get(url)
+    timings = server_timings(response)
+    assert timings.keys() >= {"total", "app_sql", "meter_sql", "meter_engine", "json"}
+    assert timings["get_grouped_interval_arrays"].endswith('desc="1 calls"')
+    log_entry = json.loads(caplog.records[-1].getMessage())
+    assert log_entry["endpoint"] == "meters.energy_data"
+    assert log_entry["timings"]["meter_engine"]["count"] == 1
+
+    assert test_site.get("/debug/metrics").status_code == 404
+    monkeypatch.setitem(app.config, "DEBUG_METRICS", True)
+    histograms = test_site.get("/debug/metrics").get_json()
+    request_hist = histograms["request.meters.energy_data"]
+    assert request_hist["count"] == 1
+    assert request_hist["buckets"]["+Inf"] == 1
+    assert histograms["meter_sql"]["count"] > 1
+
+
+def test_monthly_totals(add_meter):
+    """ Test the monthly endpoints read every month's totals in one query
+    """
+    add_meter(930)
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=90, nmi="Q1", interval_m=30)
+    load_nem_data(930, "Q1", "a.csv")
+
+    response = test_site.get("/meters/930/usage_overview/monthly_totals.json")
+    assert response.status_code == 200
+    timings = server_timings(response)
+    assert timings["get_monthly_energy_readings_range"].endswith('desc="1 calls"')
+    expected = []
+    for month in [1, 2, 3, 4]:  # Estimates fill the month after the data
+        mth = get_monthly_energy_readings(930, 2018, month)
+        daily_load = mth.load_total / mth.num_days
+        expected.append([f"{datetime(2018, month, 1):%Y %b}", daily_load])
+    assert response.get_json()["consumption"]["data"] == expected
+
+    response = test_site.get("/meters/930/usage_fy/2017-18/monthly_bills.json")
+    assert response.status_code == 200
+    timings = server_timings(response)
+    assert timings["get_monthly_energy_readings_range"].endswith('desc="1 calls"')
+    assert "get_monthly_energy_readings" not in timings
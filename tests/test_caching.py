@@ -0,0 +1,96 @@
+import os
+import sqlite3
+import sys
+from datetime import datetime
+from context import test_site
+from energy import app
+from metering import load_nem_data, get_data_version
+from metering import bump_data_version, get_db_location
+from energy.plots import get_calendar_plot
+from benchmarks.nem12 import write_nem12
+
+
+def test_etag_from_data_version(add_meter, monkeypatch):
+    """ Test conditional requests get 304 until new readings are loaded
+    """
+    monkeypatch.setattr("metering.loader.refresh_dirty_days", lambda *args: None)
+    add_meter(910)
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=2, nmi="Q1")
+    load_nem_data(910, "Q1", "a.csv")
+    assert get_data_version(910)[0] == 1
+
+    url = "/meters/910/2018-01-01/2018-01-02/energy_data.json"
+    response = test_site.get(url)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    last_modified = response.headers["Last-Modified"]
+
+    # Not modified responses are answered without reading any meter data
+    meters = sys.modules["energy.meters"]
+    get_power_series = meters.get_power_series
+    monkeypatch.setattr(meters, "get_power_series", None)
+    response = test_site.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    response = test_site.get(url, headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+    monkeypatch.setattr(meters, "get_power_series", get_power_series)
+
+    write_nem12("b.csv", start=datetime(2018, 1, 2), days=2, nmi="Q1")
+    load_nem_data(910, "Q1", "b.csv")
+    response = test_site.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    etag = response.headers["ETag"]
+
+    # Writes that leave the file's size and modified time alone
+    path = get_db_location(910)
+    before = os.stat(path)
+    conn = sqlite3.connect(path)
+    conn.execute("UPDATE meter_info SET data_version = data_version + 1")
+    conn.commit()
+    conn.close()
+    os.utime(path, ns=(before.st_atime_ns, before.st_mtime_ns))
+    assert os.stat(path).st_size == before.st_size
+    response = test_site.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_calendar_plot_cache(data_dir, monkeypatch):
+    """ Test rendered plots are reused until the data version changes
+    """
+    monkeypatch.setitem(app.config, "PLOT_CACHE_DIR", str(data_dir / "plots"))
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=40, nmi="Q1", interval_m=30)
+    load_nem_data(911, "Q1", "a.csv")
+    start, end = datetime(2018, 1, 1), datetime(2018, 2, 10)
+    image = get_calendar_plot(911, start, end)
+    assert image.startswith(b"\x89PNG")
+
+    plots = sys.modules["energy.plots"]
+    render_calendar_plot = plots.render_calendar_plot
+    monkeypatch.setattr(plots, "render_calendar_plot", None)
+    assert get_calendar_plot(911, start, end) == image
+    monkeypatch.setattr(plots, "render_calendar_plot", render_calendar_plot)
+
+    # A new data version replaces the old plot, and old plots are evicted
+    bump_data_version(911)
+    assert get_calendar_plot(911, start, end) == image
+    assert len(os.listdir(data_dir / "plots")) == 1
+    monkeypatch.setitem(app.config, "PLOT_CACHE_MAX_BYTES", len(image) + 1)
+    get_calendar_plot(911, start, datetime(2018, 2, 1))
+    assert os.listdir(data_dir / "plots") == ["calendar_911_20180101_20180201_v2.png"]
+
+
+def test_etag_checks_visibility(add_meter):
+    """ Test hidden or empty meters are refused without creating a database
+    """
+    add_meter(919, sharing="private")
+    add_meter(920, meter_name="Q2")
+
+    for meter_id, status in [(919, 403), (920, 404), (12345, 403)]:
+        url = f"/meters/{meter_id}/2018-01-01/2018-01-02/energy_data.json"
+        assert test_site.get(url).status_code == status
+        url = f"/meters/{meter_id}/2018-01-01/2018-01-02/calendar_plot.png"
+        assert test_site.get(url).status_code == status
+        assert not os.path.exists(get_db_location(meter_id))
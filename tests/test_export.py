@@ -0,0 +1,69 @@
+import csv
+import io
+from datetime import datetime
+import pytest
+from context import test_site
+from metering import load_nem_data
+from metering import export_meter_table, iter_export_chunks, get_export_columns
+from benchmarks.nem12 import write_nem12
+
+
+def test_export_csv(data_dir):
+    """ Test exports are read in chunks and can be filtered
+    """
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=3, nmi="Q1", interval_m=30)
+    load_nem_data(913, "Q1", "a.csv")
+
+    chunks = list(iter_export_chunks(913, "readings", chunk_rows=100))
+    assert [len(chunk) for chunk in chunks] == [100, 100, 88]
+
+    data = "".join(export_meter_table(913, "readings", "csv", channels=["E1"]))
+    rows = list(csv.reader(io.StringIO(data)))
+    assert rows[0] == get_export_columns("readings")
+    assert rows[0][0:4] == ["ch_name", "read_start", "read_end", "read_value"]
+    assert len(rows) == 1 + 3 * 48
+    assert set(row[0] for row in rows[1:]) == {"E1"}
+
+    filters = {"start": datetime(2018, 1, 2), "end": datetime(2018, 1, 3)}
+    data = "".join(export_meter_table(913, "daily", "csv", **filters))
+    assert data.splitlines()[1].startswith("2018-01-02")
+    assert len(data.splitlines()) == 2
+
+    with pytest.raises(ValueError):
+        export_meter_table(913, "users", "csv")
+
+
+def test_export_parquet(data_dir):
+    """ Test columnar exports hold every row across several row groups
+    """
+    pq = pytest.importorskip("pyarrow.parquet")
+    ipc = pytest.importorskip("pyarrow.ipc")
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=3, nmi="Q1", interval_m=30)
+    load_nem_data(914, "Q1", "a.csv")
+
+    data = b"".join(export_meter_table(914, "readings", "parquet", chunk_rows=100))
+    parquet = pq.ParquetFile(io.BytesIO(data))
+    assert parquet.metadata.num_rows == 2 * 3 * 48
+    assert parquet.metadata.num_row_groups == 3
+    table = parquet.read()
+    assert table.column("read_start")[0].as_py() == datetime(2018, 1, 1)
+
+    data = b"".join(export_meter_table(914, "monthly", "arrow"))
+    assert ipc.open_stream(data).read_all().num_rows == 1
+
+
+def test_export_route(add_meter):
+    """ Test meter data is streamed from the export route
+    """
+    add_meter(915)
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=2, nmi="Q1", interval_m=30)
+    load_nem_data(915, "Q1", "a.csv")
+
+    response = test_site.get("/meters/915/export/readings.csv?channels=B1")
+    assert response.status_code == 200
+    assert response.mimetype == "text/csv"
+    assert len(response.data.splitlines()) == 1 + 2 * 48
+    response = test_site.get("/meters/915/export/readings.csv?start=01-01-2018")
+    assert response.status_code == 400
+    response = test_site.get("/meters/915/export/readings.xlsx")
+    assert response.status_code == 404
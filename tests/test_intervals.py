@@ -0,0 +1,101 @@
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta
+from context import test_site
+from energy_shaper import group_into_profiled_intervals
+from metering.intervals import profile_intervals, iter_profiled_readings
+from metering.intervals import to_epoch
+from metering.intervals import resample_intervals, downsample_lttb
+from metering.intervals import segment_totals, from_epoch
+from metering.analyse import get_time_of_day_segment
+
+
+def random_readings(num_reads: int, seed: int = 1):
+    """ Generate a mix of interval, daily and multi-day readings
+    """
+    rand = random.Random(seed)
+    readings = []
+    start = datetime(2018, 1, 1)
+    for _ in range(num_reads):
+        minutes = rand.choice([5, 5, 15, 30, 30, 90, 24 * 60, 3 * 24 * 60])
+        end = start + timedelta(minutes=minutes)
+        readings.append((start, end, rand.random()))
+        start = end
+    return readings
+
+
+def vectorised(readings, interval_m):
+    """ Profile readings using the vectorised path
+    """
+    starts = to_epoch(r[0] for r in readings)
+    ends = to_epoch(r[1] for r in readings)
+    values = [r[2] for r in readings]
+    interval_ends, totals = profile_intervals(starts, ends, values, interval_m)
+    return list(iter_profiled_readings(interval_ends, totals, interval_m))
+
+
+def test_profile_intervals_match():
+    """ Test vectorised profiling matches energy_shaper exactly
+    """
+    readings = random_readings(2000)
+    for interval_m in [5, 15, 30, 60]:
+        expected = list(group_into_profiled_intervals(readings, interval_m))
+        assert vectorised(readings, interval_m) == expected
+    assert vectorised([], 5) == []
+
+
+def test_profile_intervals_many():
+    """ Test profiling many short readings from epoch columns matches
+    """
+    half_hour = timedelta(minutes=30)
+    readings = [r for r in random_readings(50000, seed=2) if r[1] - r[0] <= half_hour]
+    # The database returns epoch seconds directly
+    starts = to_epoch(r[0] for r in readings)
+    ends = to_epoch(r[1] for r in readings)
+    values = [r[2] for r in readings]
+
+    expected = list(group_into_profiled_intervals(readings, interval_m=5))
+    interval_ends, totals = profile_intervals(starts, ends, values, interval_m=5)
+    assert list(iter_profiled_readings(interval_ends, totals, 5)) == expected
+
+
+def test_resample_and_downsample():
+    """ Test bucketing keeps the total and LTTB keeps the end points
+    """
+    readings = random_readings(500)
+    starts = to_epoch(r[0] for r in readings)
+    ends = to_epoch(r[1] for r in readings)
+    interval_ends, totals = profile_intervals(starts, ends, [r[2] for r in readings], 5)
+
+    hour_ends, hour_totals = resample_intervals(interval_ends, totals, 60)
+    assert (hour_ends % 3600 == 0).all()
+    assert abs(hour_totals.sum() - totals.sum()) < 1e-9
+    assert len(hour_ends) < len(interval_ends)
+
+    x, y = downsample_lttb(interval_ends, totals, 100)
+    assert len(x) == 100
+    assert x[0] == interval_ends[0] and x[-1] == interval_ends[-1]
+    assert (x[1:] > x[:-1]).all()
+
+
+def test_segment_totals_match():
+    """ Test vectorised segments match summing by get_time_of_day_segment
+    """
+    readings = random_readings(2000)
+    starts = to_epoch(r[0] for r in readings)
+    ends = to_epoch(r[1] for r in readings)
+    interval_ends, totals = profile_intervals(starts, ends, [r[2] for r in readings], 5)
+
+    expected = defaultdict(lambda: defaultdict(float))
+    for read in iter_profiled_readings(interval_ends, totals, 5):
+        day = datetime(read.start.year, read.start.month, read.start.day)
+        expected[day][get_time_of_day_segment(read.start).lower()] += read.usage
+
+    days, segments = segment_totals(interval_ends, totals, 5, 180)
+    assert from_epoch(days) == sorted(expected.keys())
+    for day, day_segments in zip(from_epoch(days), segments.tolist()):
+        assert day_segments == [expected[day][seg] for seg in "abcdefgh"]
+
+    days, hours = segment_totals(interval_ends, totals, 5, 60)
+    assert hours.shape == (len(days), 24)
+    assert abs(hours.sum(axis=1) - segments.sum(axis=1)).max() < 1e-9
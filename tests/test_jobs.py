@@ -0,0 +1,75 @@
+import io
+import os
+from datetime import datetime
+import pytest
+from werkzeug.datastructures import FileStorage
+from context import test_site
+from energy import app, db
+from energy.models import ImportJob
+from energy.jobs import queue_import, get_import_jobs
+from energy.jobs import claim_next_job, resume_import_jobs
+from benchmarks.nem12 import write_nem12
+
+
+def test_import_jobs(add_meter, monkeypatch):
+    """ Test import jobs record their outcome in the app database
+    """
+    monkeypatch.setitem(app.config, "IMPORT_WORKERS", 0)
+    add_meter(906)
+    write_nem12("nem12.csv", start=datetime(2018, 1, 1), days=3, nmi="Q1")
+    with app.app_context():
+        with open("nem12.csv", "rb") as f:
+            queue_import(906, FileStorage(io.BytesIO(f.read())))
+        queue_import(906, FileStorage(io.BytesIO(b"Not a NEM file")))
+
+        failed, done = get_import_jobs(906)
+        assert done.to_dict()["status"] == "done"
+        assert done.rows_inserted == 3 * 288 * 2
+        assert done.elapsed >= 0
+        assert not os.path.exists(done.file_path)
+        assert failed.status == "failed" and failed.error
+
+
+def test_import_job_order(add_meter, monkeypatch):
+    """ Test jobs for a meter run one at a time, oldest first, after a restart
+    """
+    monkeypatch.setitem(app.config, "IMPORT_WORKERS", 0)
+    add_meter(922)
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=2, nmi="Q1")
+    write_nem12("b.csv", start=datetime(2018, 1, 3), days=2, nmi="Q1")
+    with app.app_context():
+        # Left running and queued when the site stopped
+        first = ImportJob(meter_id=922, status="running", file_path="a.csv")
+        second = ImportJob(meter_id=922, status="queued", file_path="b.csv")
+        db.session.add_all([first, second])
+        db.session.commit()
+        assert claim_next_job(922) is None
+
+        resume_import_jobs()
+        first, second = ImportJob.query.order_by(ImportJob.job_id).all()
+        assert first.status == second.status == "done"
+        assert first.rows_inserted == second.rows_inserted == 2 * 288 * 2
+        assert first.finished_at <= second.started_at
+        assert claim_next_job(922) is None
+
+
+@pytest.mark.filterwarnings("ignore:New instance")
+def test_import_job_session_error(add_meter, monkeypatch):
+    """ Test a job is marked failed when the app session fails during a load
+    """
+    monkeypatch.setitem(app.config, "IMPORT_WORKERS", 0)
+    add_meter(923)
+
+    def failing_load(meter_id, nmi, nem_file, progress):
+        # A duplicate job id makes the progress commit fail
+        db.session.add(ImportJob(job_id=1, meter_id=meter_id))
+        progress(1, 0)
+
+    monkeypatch.setattr("energy.jobs.load_nem_data", failing_load)
+    with app.app_context():
+        db.session.add(ImportJob(meter_id=923, status="queued", file_path="a.csv"))
+        db.session.commit()
+        resume_import_jobs()
+        job = ImportJob.query.one()
+        assert job.status == "failed" and job.error
+        assert claim_next_job(923) is None
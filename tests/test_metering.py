@@ -0,0 +1,495 @@
+import gc
+import random
+import sqlite3
+from datetime import datetime, timedelta
+import pytest
+from click.testing import CliRunner
+from sqlalchemy import event
+from context import test_site
+import metering.loader
+from metering import get_db_engine, get_db_session, get_engine_stats
+from metering import dispose_db_engine, get_stored_meter_ids
+from metering import Readings
+from metering import save_energy_reading, save_energy_readings
+from metering import update_monthly_total, get_monthly_energy_readings
+from metering import save_monthly_totals, add_missing_daily_totals
+from metering import save_daily_totals, get_daily_energy_readings
+from metering import get_month_ranges
+from qldtariffs import financial_year_ending
+from metering import get_load_energy_readings, get_grouped_energy_readings
+from metering import get_data_range, get_reading_arrays, get_data_version
+from metering.models import get_db_location
+from metering import load_nem_data, get_meter_info
+from metering import get_usage_stats, STATS_BIN_WIDTH
+from metering import partition_readings, archive_partition, restore_partition
+from metering import get_partition_names, get_archived_partitions
+from metering import get_interval_arrays, get_load_energy_arrays, LOAD_CHS
+from metering.intervals import resample_intervals
+from metering import get_monthly_energy_readings_range
+from metering import get_monthly_bills, save_monthly_bill
+from metering import refresh_interval_totals, get_stale_range
+from metering import has_interval_totals, has_day_stats, backfill_rollups
+from benchmarks.nem12 import write_nem12
+from helpers import update_metering, update_all
+
+
+def test_engine_registry(data_dir):
+    """ Test meter engines are created once and then reused
+    """
+    dispose_db_engine(901)
+
+    before = get_engine_stats()
+    engine = get_db_engine(901)
+    assert get_db_engine(901) is engine
+    session = get_db_session(901)
+    assert session.query(Readings).count() == 0
+    after = get_engine_stats()
+    assert after["misses"] - before["misses"] == 1
+    assert after["hits"] - before["hits"] == 2
+
+    dispose_db_engine(901)
+    assert get_db_engine(901) is not engine
+    dispose_db_engine(901)
+    assert get_stored_meter_ids() == [901]
+
+
+def test_bulk_save_readings(data_dir):
+    """ Test bulk inserts skip readings that already exist
+    """
+    session = get_db_session(902)
+    rows = [
+        {
+            "ch_name": "E1",
+            "read_start": datetime(2018, 1, 1, 0, i * 5),
+            "read_end": datetime(2018, 1, 1, 0, i * 5 + 5),
+            "read_value": 0.1,
+            "quality_method": None,
+        }
+        for i in range(6)
+    ]
+    assert save_energy_readings(session, rows[0:4]) == (4, 0)
+    assert save_energy_readings(session, rows) == (2, 4)
+    session.commit()
+    assert session.query(Readings).count() == 6
+
+
+def readings_query_plans(meter_id):
+    """ Return the query plan of each readings query the hot paths run
+    """
+    engine = get_db_engine(meter_id)
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if "FROM readings" in statement:
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", capture)
+    get_data_range(meter_id)
+    get_reading_arrays(meter_id, datetime(2018, 1, 1), datetime(2018, 2, 1))
+    session = get_db_session(meter_id)
+    start = datetime(2018, 1, 1)
+    save_energy_reading(session, "E1", start, start + timedelta(minutes=5), 1, None)
+    session.rollback()
+    event.remove(engine, "before_cursor_execute", capture)
+
+    plans = {}
+    with engine.connect() as conn:
+        for statement, parameters in statements:
+            plan = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)
+            plans[statement] = [row[3] for row in plan]
+    # The data range is read from the channel summaries, not the readings
+    assert len(plans) == 2
+    return plans
+
+
+def test_readings_query_plans(data_dir):
+    """ Test the hot readings queries never fall back to full table scans
+    """
+    for plan in readings_query_plans(907).values():
+        assert not any(step.startswith("SCAN") for step in plan), plan
+
+    # Databases created before the indexes get them when first opened
+    conn = sqlite3.connect(get_db_location(908))
+    conn.execute(
+        "CREATE TABLE readings (ch_name VARCHAR NOT NULL, "
+        "read_start DATETIME NOT NULL, read_end DATETIME NOT NULL, "
+        "read_value FLOAT, quality_method VARCHAR, "
+        "PRIMARY KEY (ch_name, read_start, read_end))"
+    )
+    conn.close()
+    for statement, plan in readings_query_plans(908).items():
+        assert not any(step.startswith("SCAN") for step in plan), plan
+        if "strftime" in statement:
+            assert "COVERING INDEX ix_readings_channel_time" in plan[0]
+
+
+def test_load_batches(data_dir, monkeypatch):
+    """ Test row by row and bulk ingest match, and keep the batches saved
+    """
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=3, nmi="Q1")
+    engine = get_db_engine(927)
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("SELECT meter_info.partition_by"):
+            statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", capture)
+    with monkeypatch.context() as m:
+        m.setattr("metering.loader.refresh_dirty_days", lambda *args: None)
+        assert load_nem_data(927, "Q1", "a.csv", batch_size=0) == (3 * 288 * 2, 0)
+    event.remove(engine, "before_cursor_execute", capture)
+    # Partitions are looked up once for each channel's batch, not per reading
+    assert len(statements) == 2
+    load_nem_data(928, "Q1", "a.csv")
+    assert get_meter_info(927)["channels"] == get_meter_info(928)["channels"]
+
+    # A failed batch keeps the batches before it, with their rollups
+    save_energy_readings = metering.loader.save_energy_readings
+
+    def fail_second_batch(session, rows):
+        if rows[0]["read_start"] >= datetime(2018, 1, 2):
+            raise ValueError("Disk full")
+        return save_energy_readings(session, rows)
+
+    monkeypatch.setattr("metering.loader.save_energy_readings", fail_second_batch)
+    with pytest.raises(ValueError):
+        load_nem_data(929, "Q1", "a.csv", batch_size=288)
+    assert get_meter_info(929)["channels"] == {"E1": 288}
+    assert get_data_version(929)[0] == 1
+    days = get_daily_energy_readings(929, datetime(2018, 1, 1), datetime(2018, 1, 1))
+    assert len(days) == 1 and not days[0].estimated
+
+
+def test_meter_info(data_dir, monkeypatch):
+    """ Test ingest keeps the channel summaries and data range current
+    """
+    monkeypatch.setattr("metering.loader.refresh_dirty_days", lambda *args: None)
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=3, nmi="Q1")
+    write_nem12("b.csv", start=datetime(2018, 1, 3), days=3, nmi="Q1")
+    load_nem_data(909, "Q1", "a.csv")
+    assert get_data_range(909) == (datetime(2018, 1, 1), datetime(2018, 1, 4))
+    load_nem_data(909, "Q1", "b.csv")
+    assert get_data_range(909) == (datetime(2018, 1, 1), datetime(2018, 1, 6))
+    info = get_meter_info(909)
+    assert info["channels"] == {"B1": 5 * 288, "E1": 5 * 288}
+    assert info["last_ingest"] is not None
+    dispose_db_engine(909)
+
+    # Databases created before the summaries get them when first opened
+    conn = sqlite3.connect(get_db_location(909))
+    conn.execute("DROP TABLE meter_info")
+    conn.execute("DROP TABLE channel_info")
+    conn.close()
+    assert get_meter_info(909)["channels"] == info["channels"]
+    assert get_data_range(909) == (datetime(2018, 1, 1), datetime(2018, 1, 6))
+
+
+def test_grouped_readings(data_dir):
+    """ Test a single grouped scan matches reading each channel group
+    """
+    session = get_db_session(903)
+    rows = []
+    for ch_name in ["E1", "E2", "B1"]:
+        for i in range(12):
+            rows.append(
+                {
+                    "ch_name": ch_name,
+                    "read_start": datetime(2018, 1, 1, i * 2),
+                    "read_end": datetime(2018, 1, 1, i * 2 + 1, 30),
+                    "read_value": i / 10,
+                    "quality_method": None,
+                }
+            )
+    save_energy_readings(session, rows)
+    session.commit()
+
+    start = datetime(2018, 1, 1)
+    end = datetime(2018, 1, 2)
+    groups = {"load": ["E1"], "control": ["E2"], "generation": ["B1", "71"]}
+    grouped = get_grouped_energy_readings(903, start, end, groups)
+    for group, channels in groups.items():
+        expected = list(get_load_energy_readings(903, start, end, channels))
+        assert grouped[group] == expected
+
+
+def test_monthly_total_version(data_dir):
+    """ Test the monthly totals version only changes with the totals
+    """
+    session = get_db_session(904)
+    totals = [31, 300.0, 50.0, 20.0, 2.5, 40.0, 80.0, 30.0, 70.0]
+    update_monthly_total(session, 2018, 1, *totals)
+    session.commit()
+    assert get_monthly_energy_readings(904, 2018, 1).version == 0
+
+    update_monthly_total(session, 2018, 1, *totals)
+    session.commit()
+    assert get_monthly_energy_readings(904, 2018, 1).version == 0
+
+    totals[1] = 310.0
+    update_monthly_total(session, 2018, 1, *totals)
+    session.commit()
+    assert get_monthly_energy_readings(904, 2018, 1).version == 1
+
+
+def test_bulk_rollup_writers(data_dir):
+    """ Test bulk rollups update existing rows and only add missing estimates
+    """
+    session = get_db_session(905)
+    cols = ["load_total", "control_total", "export_total", "load_peak1"]
+    cols += ["load_shoulder1", "load_peak2", "load_shoulder2"]
+    days = [datetime(2018, 1, 1) + timedelta(days=i) for i in range(4)]
+    actual = [dict(dict.fromkeys(cols, 1.0), day=day, estimated=False) for day in days]
+    save_daily_totals(session, actual[0:2])
+    save_daily_totals(session, actual[1:3])
+    estimates = [dict(row, load_total=0.5, estimated=True) for row in actual]
+    assert add_missing_daily_totals(session, estimates) == 1
+    session.commit()
+    dailies = get_daily_energy_readings(905, days[0], days[-1])
+    assert [d.estimated for d in dailies] == [False, False, False, True]
+
+    month = dict.fromkeys(cols + ["demand"], 10.0)
+    month.update(year=2018, month=1, num_days=31)
+    save_monthly_totals(session, [month])
+    save_monthly_totals(session, [month])
+    session.commit()
+    assert get_monthly_energy_readings(905, 2018, 1).version == 0
+    save_monthly_totals(session, [dict(month, demand=None)])
+    session.commit()
+    assert get_monthly_energy_readings(905, 2018, 1).version == 1
+
+
+def test_partitioned_readings(data_dir, monkeypatch):
+    """ Test partitioned meters read the same data, and old years can be archived
+    """
+    monkeypatch.setattr("metering.loader.refresh_dirty_days", lambda *args: None)
+    write_nem12("a.csv", start=datetime(2017, 12, 1), days=62, nmi="Q1")
+    start, end = datetime(2017, 12, 20), datetime(2018, 1, 10)
+    load_nem_data(916, "Q1", "a.csv")
+    expected = get_reading_arrays(916, start, end, ["E1", "B1"])
+
+    monkeypatch.setattr("metering.models.PARTITION_BY", "month")
+    load_nem_data(917, "Q1", "a.csv")
+    with get_db_engine(917).connect() as conn:
+        assert get_partition_names(conn) == ["readings_2017_12", "readings_2018_01"]
+    actual = get_reading_arrays(917, start, end, ["E1", "B1"])
+    assert all((a == b).all() for a, b in zip(actual, expected))
+    # Loading the same file again only finds existing readings
+    assert load_nem_data(917, "Q1", "a.csv") == (0, 62 * 288 * 2)
+
+    assert partition_readings(916) == ["readings_2017", "readings_2018"]
+    assert get_db_session(916).query(Readings).count() == 0
+    assert get_meter_info(916)["channels"] == get_meter_info(917)["channels"]
+    archive_partition(916, "readings_2017")
+    assert get_archived_partitions(916) == ["readings_2017"]
+    assert get_archived_partitions(917) == []
+    assert get_data_range(916)[0] == datetime(2018, 1, 1)
+    assert len(get_reading_arrays(916, start, end, ["E1"])[0]) == 9 * 288
+    restore_partition(916, "readings_2017")
+    assert get_data_range(916)[0] == datetime(2017, 12, 1)
+    assert len(get_reading_arrays(916, start, end, ["E1"])[0]) == 21 * 288
+
+
+def test_usage_stats(data_dir):
+    """ Test the stored day of week stats match the daily totals
+    """
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=40, nmi="Q1", interval_m=30)
+    write_nem12("b.csv", start=datetime(2018, 2, 5), days=30, nmi="Q1", interval_m=30)
+    start, end = datetime(2018, 1, 1), datetime(2018, 3, 31)
+
+    def check_stats():
+        stats = get_usage_stats(912, start, end)
+        dailies = get_daily_energy_readings(912, start, end)
+        actual = [d for d in dailies if not d.estimated]
+        totals = [d.load_total for d in actual]
+        mondays = [d.load_total for d in actual if d.day.weekday() == 0]
+        assert stats["day_of_week"]["Mon"]["days"] == len(mondays)
+        assert abs(stats["day_avgs"]["Mon"] - sum(mondays) / len(mondays)) < 1e-6
+        assert sum(month["days"] for month in stats["month"].values()) == len(totals)
+        summer = stats["season"]["summer"]
+        totals = sorted(d.load_total for d in actual if d.day.month < 3)
+        assert summer["days"] == len(totals)
+        assert abs(summer["median"] - totals[len(totals) // 2]) <= STATS_BIN_WIDTH
+        assert abs(summer["p90"] - totals[int(0.9 * len(totals))]) <= STATS_BIN_WIDTH
+        assert stats["season"]["winter"]["mean"] is None
+        return stats
+
+    load_nem_data(912, "Q1", "a.csv")
+    first = check_stats()
+    load_nem_data(912, "Q1", "b.csv")
+    assert check_stats()["month"]["Feb"]["days"] > first["month"]["Feb"]["days"]
+
+    # Meters loaded before the stats were stored read none until backfilled
+    session = get_db_session(912)
+    session.execute("DELETE FROM day_stats")
+    session.commit()
+    session.close()
+    assert get_usage_stats(912, start, end)["day_avgs"]["Mon"] is None
+    assert not has_day_stats(912)
+    backfill_rollups(912)
+    check_stats()
+
+    # Meters without readings have nothing to build
+    assert get_usage_stats(926, start, end)["day_avgs"]["Mon"] is None
+    backfill_rollups(926)
+    assert not has_day_stats(926)
+
+
+def test_interval_totals(data_dir):
+    """ Test stored interval totals match profiling the readings
+    """
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=10, nmi="Q1", interval_m=5)
+    load_nem_data(916, "Q1", "a.csv")
+    start, end = datetime(2018, 1, 2, 7), datetime(2018, 1, 8)
+
+    def check_intervals(interval_m):
+        expected = get_load_energy_arrays(916, start, end, LOAD_CHS, interval_m=5)
+        if interval_m > 5:
+            expected = resample_intervals(*expected, interval_m)
+        interval_ends, totals = get_interval_arrays(916, "load", start, end, interval_m)
+        assert interval_ends.tolist() == expected[0].tolist()
+        assert abs(totals - expected[1]).max() < 1e-9
+
+    for interval_m in [5, 30, 60, 1440]:
+        check_intervals(interval_m)
+
+    # Meters loaded before the totals were stored read none until backfilled
+    session = get_db_session(916)
+    session.execute("DELETE FROM interval_totals")
+    session.commit()
+    session.close()
+    interval_ends, totals = get_interval_arrays(916, "load", start, end, 30)
+    assert len(interval_ends) == len(totals) == 0
+    assert not has_interval_totals(916)
+    backfill_rollups(916)
+    check_intervals(30)
+
+    # Which update-metering does even when no readings are stale
+    session = get_db_session(916)
+    session.execute("DELETE FROM interval_totals")
+    session.commit()
+    session.close()
+    result = CliRunner().invoke(update_metering, ["--meterid", "916"])
+    assert result.exit_code == 0, result.output
+    check_intervals(30)
+
+
+def day_by_day_month_ranges(start, end):
+    """ The original implementation, stepping through every day
+    """
+    periods = []
+    day = start
+    while day <= end:
+        period = (day.year, day.month, financial_year_ending(day))
+        if period not in periods:
+            periods.append(period)
+        day += timedelta(days=1)
+    return sorted(periods)
+
+
+def test_month_ranges():
+    """ Test month stepping matches stepping through each day
+    """
+    rand = random.Random(1)
+    for _ in range(500):
+        start = datetime(2015, 1, 1) + timedelta(minutes=rand.randint(0, 10 ** 6))
+        end = start + timedelta(minutes=rand.randint(-2000, 10 ** 6))
+        assert get_month_ranges(start, end) == day_by_day_month_ranges(start, end)
+
+    # Ends within a day of the start of a month
+    start = datetime(2018, 1, 31, 12)
+    months = get_month_ranges(start, datetime(2018, 2, 1, 6))
+    assert [(year, month) for year, month, _ in months] == [(2018, 1)]
+    months = get_month_ranges(start, datetime(2018, 2, 1, 12))
+    assert [(year, month) for year, month, _ in months] == [(2018, 1), (2018, 2)]
+
+
+def test_sessions_closed(data_dir):
+    """ Test the metering functions return their connections to the pool
+    """
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=40, nmi="Q1")
+    start, end = datetime(2018, 1, 1), datetime(2018, 2, 10)
+    gc.disable()  # Unclosed sessions would be returned when collected
+    try:
+        load_nem_data(921, "Q1", "a.csv")
+        refresh_interval_totals(921)
+        get_meter_info(921)
+        get_reading_arrays(921, start, end, ["E1"])
+        get_daily_energy_readings(921, start, end)
+        get_monthly_energy_readings(921, 2018, 1)
+        get_monthly_energy_readings_range(921, start, end)
+        save_monthly_bill(921, 2018, 1, 1, 2018, 10.0)
+        get_monthly_bills(921, start, end)
+        get_stale_range(921)
+        assert get_db_engine(921).pool.checkedout() == 0
+    finally:
+        gc.enable()
+
+
+def rollup_rows(meter_id):
+    """ The rows of the rollups an incremental refresh updates, rounded
+    """
+    queries = {
+        "daily_segments": "SELECT * FROM daily_segments ORDER BY day",
+        "interval_totals": "SELECT * FROM interval_totals"
+        " ORDER BY ch_group, interval_m, interval_end",
+        "day_stats": "SELECT * FROM day_stats ORDER BY year, month, weekday",
+        "daily_totals": "SELECT * FROM daily_totals WHERE NOT estimated ORDER BY day",
+    }
+    conn = sqlite3.connect(get_db_location(meter_id))
+    rows = {}
+    for table, sql in queries.items():
+        rows[table] = [
+            tuple(round(v, 9) if isinstance(v, float) else v for v in row)
+            for row in conn.execute(sql)
+        ]
+    conn.close()
+    return rows
+
+
+def test_incremental_rollups(data_dir, monkeypatch):
+    """ Test refreshing the days each file loads matches a full rebuild
+    """
+    files = [
+        ("a.csv", datetime(2018, 1, 1), 20),
+        ("b.csv", datetime(2018, 1, 15), 16),  # Overlaps the first file
+        ("c.csv", datetime(2018, 1, 31), 1),  # Ends at the start of a month
+        ("d.csv", datetime(2018, 2, 1), 5),
+    ]
+    for seed, (filename, start, days) in enumerate(files):
+        write_nem12(filename, start=start, days=days, nmi="Q1", seed=seed)
+    for filename, _, _ in files:
+        load_nem_data(924, "Q1", filename)
+
+    monkeypatch.setattr("metering.loader.refresh_dirty_days", lambda *args: None)
+    for filename, _, _ in files:
+        load_nem_data(925, "Q1", filename)
+    result = CliRunner().invoke(update_metering, ["--meterid", "925", "--full"])
+    assert result.exit_code == 0, result.output
+
+    incremental, full = rollup_rows(924), rollup_rows(925)
+    for table, rows in full.items():
+        assert rows, table
+        assert incremental[table] == rows, table
+
+
+def test_update_all(data_dir, monkeypatch):
+    """ Test update-all builds the rollups for every meter it finds
+    """
+    write_nem12("a.csv", start=datetime(2018, 1, 1), days=10, nmi="Q1")
+    load_nem_data(931, "Q1", "a.csv")
+    with monkeypatch.context() as m:
+        m.setattr("metering.loader.refresh_dirty_days", lambda *args: None)
+        load_nem_data(932, "Q1", "a.csv")
+    get_db_engine(933)  # A database with no readings
+    for meter_id in [931, 932, 933]:
+        dispose_db_engine(meter_id)  # Workers open their own connections
+
+    args = ["--from-dir", "--workers", "2"]
+    result = CliRunner().invoke(update_all, args)
+    assert result.exit_code == 0, result.output
+    assert "Refreshing 3 meters with 2 workers" in result.output
+    assert "Meter 932:" in result.output
+    assert "2 meters refreshed, 1 not refreshed" in result.output
+    assert "  Meter 933: No data" in result.output
+    assert rollup_rows(932) == rollup_rows(931)
@@ -0,0 +1,56 @@
+from datetime import datetime
+from nemreader import read_nem_file
+from context import test_site
+from metering.nem_stream import get_nem12_nmis, iter_nem12_channels
+from benchmarks.nem12 import write_nem12
+
+
+def test_stream_matches_nemreader(tmp_path):
+    """ Test streamed readings match reading the whole file with nemreader
+    """
+    nem_file = str(tmp_path / "nem12.csv")
+    write_nem12(nem_file, start=datetime(2018, 1, 1), days=3, nmi="Q1", seed=1)
+    with open(nem_file) as f:
+        lines = f.read().splitlines()
+    second_nmi = str(tmp_path / "second.csv")
+    write_nem12(second_nmi, start=datetime(2018, 1, 1), days=2, nmi="Q2", seed=2)
+    with open(second_nmi) as f:
+        extra = f.read().splitlines()[1:-1]
+
+    # Add quality events to a day and a second NMI
+    lines.insert(3, "400,1,12,S14,32,")
+    lines.insert(5, "400,13,288,F,,")
+    lines[-1:-1] = extra
+    with open(nem_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+    expected = read_nem_file(nem_file).readings
+    streamed = {}
+    for nmi, ch_name, reads in iter_nem12_channels(nem_file):
+        streamed.setdefault(nmi, {}).setdefault(ch_name, []).extend(reads)
+    assert streamed == expected
+    assert streamed["Q1"]["E1"][0].quality_method == "S14"
+    assert get_nem12_nmis(nem_file) == ["Q1", "Q2"]
+
+
+def test_write_nem12(tmp_path):
+    """ Test synthetic files are repeatable and can hold several NMIs
+    """
+    nem_file = str(tmp_path / "nem12.csv")
+    nmis = ["Q1", "Q2", "Q3"]
+    kwargs = {"days": 2, "nmi": nmis, "channels": ("E1", "E2"), "interval_m": 30}
+    num_reads = write_nem12(nem_file, start=datetime(2018, 1, 1), **kwargs)
+    assert num_reads == 2 * 48 * 2 * 3
+    with open(nem_file) as f:
+        first = f.read()
+    write_nem12(nem_file, start=datetime(2018, 1, 1), **kwargs)
+    with open(nem_file) as f:
+        assert f.read() == first
+
+    assert get_nem12_nmis(nem_file) == nmis
+    reads = [
+        read
+        for nmi, ch_name, ch_reads in iter_nem12_channels(nem_file)
+        for read in ch_reads
+    ]
+    assert len(reads) == num_reads